@@ -0,0 +1,74 @@
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import pandas as pd
+from fake_imap import FakeImapServer, synthetic_mailbox
+from trade_store import open_store
+from cli import STARTUP_BUDGET, LIGHT_COMMANDS
+
+# cold start of the light cli commands in fresh interpreters, fails if one is over cli.STARTUP_BUDGET or imports
+# one of HEAVY_MODULES. count runs against a small trade store (count --imap against a fake_imap mailbox) and summary
+# against a small all_summary.csv
+# run with: python bench_cli.py --runs 5
+
+HEAVY_MODULES = ["pandas", "numpy", "yfinance"]
+CLI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cli.py")
+SUMMARY_CSV = ("ticker,all_pnl,open_pnl,scalp_pnl,open_quantity,open_price,open_notional,last_price,last_trade,abs_all_pnl\n"
+               "NVDA,1250.0,1000.0,250.0,100.0,110.0,12000.0,120.0,2025/07/01,1250.0\n"
+               "UB Sep'25 @CBOT,-300.0,0.0,-300.0,0.0,0.0,0.0,118.5,2025/06/30,300.0\n")
+
+
+def timed_run(arguments):
+    # wall time of one fresh interpreter running cli.py, and the top level modules it imported
+    start_time = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", CLI] + arguments, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start_time
+    if result.returncode != 0:
+        raise RuntimeError(f"cli.py {' '.join(arguments)} failed:\n{result.stdout}{result.stderr}")
+    # -X importtime writes "import time: self | cumulative | package" lines to stderr
+    imported = {line.rsplit("|", 1)[1].strip().split(".")[0] for line in result.stderr.splitlines()
+                if line.startswith("import time:") and "|" in line}
+    return elapsed, imported
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=STARTUP_BUDGET)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix="bench_cli")
+    export = os.path.join(folder, "export")
+    os.makedirs(export)
+    with open(export + r"\all_summary.csv", "w") as f:
+        f.write(SUMMARY_CSV)
+    store = open_store(export)
+    now = int(time.time())
+    store.append(pd.DataFrame({"timestamp": [now - 60, now - 30, now], "ticker": ["NVDA", "NVDA", "AMD"],
+                               "quantity": [10, 10, -5], "price": [120.0, 120.0, 150.0], "contract_size": [1, 1, 1],
+                               "message_id": ["a", "b", "c"]}))
+    store.close()
+    server = FakeImapServer(synthetic_mailbox(200)).start()
+    common = ["--export-folder", export, "--host", "127.0.0.1", "--port", str(server.port), "--no-ssl"]
+    failures = []
+    try:
+        for command in ["--help"] + LIGHT_COMMANDS + ["count --imap"]:
+            arguments = [command] if command == "--help" else common + command.split()
+            runs = [timed_run(arguments) for run in range(args.runs)]
+            median = statistics.median(elapsed for elapsed, imported in runs)
+            heavy = sorted(set(HEAVY_MODULES) & runs[0][1])
+            print(f"{command:<12} median {median:.3f}s  min {min(e for e, i in runs):.3f}s  heavy imports: {heavy or 'none'}")
+            if median > args.budget:
+                failures.append(f"{command} took {median:.3f}s, budget is {args.budget}s")
+            if heavy:
+                failures.append(f"{command} imported {', '.join(heavy)}")
+    finally:
+        server.stop()
+        shutil.rmtree(folder, ignore_errors=True)
+    for failure in failures:
+        print("over budget:", failure)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,73 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from trade_review import PositionKeeper
+from pnl_engine import replay_trades, final_positions
+
+# checks pnl_engine against PositionKeeper on a synthetic corpus and times both
+# run with: python bench_pnl_engine.py --sizes 10000 100000 1000000
+
+FIELDS = ["exposure", "avg_price", "last_price", "market_value", "realised_pnl", "unrealised_pnl"]
+# the PositionKeeper loop is only run up to this size unless --reference-all is given
+REFERENCE_LIMIT = 100000
+
+def synthetic_trades(n, tickers = 200, seed = 0):
+    # newest first like all_trades, skewed ticker popularity, small lots so positions often close and flip through zero
+    rng = np.random.default_rng(seed)
+    names = np.array([f"T{i}" for i in range(tickers)])
+    weights = 1 / np.arange(1, tickers + 1)
+    ticker = names[rng.choice(tickers, size=n, p=weights / weights.sum())]
+    contract_size = np.where(np.char.endswith(ticker, "0"), 1000.0, 1.0)
+    quantity = rng.choice([-300, -100, -50, -10, 0, 10, 50, 100, 300], size=n).astype(float)
+    price = np.round(100 + rng.standard_normal(n).cumsum() * 0.1 + rng.uniform(-5, 5, size=n), 2)
+    dates = pd.date_range("2023-01-01", periods=n, freq="min").strftime("%Y/%m/%d")
+    trades = pd.DataFrame({"date_short": dates, "ticker": ticker, "quantity": quantity, "price": price,
+                           "contract_size": contract_size, "trade_type": "AUTO"})
+    return trades.iloc[::-1].reset_index(drop=True)
+
+def reference_replay(all_trades):
+    # the analyse_trades / get_ticker_trades loop before pnl_engine
+    rows = []
+    for ticker in all_trades.ticker.unique():
+        ticker_trades = all_trades.loc[all_trades.ticker == ticker].iloc[::-1].reset_index(drop=True)
+        ticker_position = PositionKeeper(ticker, ticker_trades.loc[0, "contract_size"])
+        for index, row in ticker_trades.iterrows():
+            ticker_position.add_trade(row.date_short, row.price, row.quantity)
+            ticker_position.update_stats()
+            rows.append({"ticker": ticker, **{field: getattr(ticker_position, field) for field in FIELDS}})
+    return pd.DataFrame(rows)
+
+def check(all_trades):
+    # returns the time the PositionKeeper loop took
+    start_time = time.perf_counter()
+    expected = reference_replay(all_trades)
+    elapsed = time.perf_counter() - start_time
+    expected = expected.sort_values("ticker", kind="stable").reset_index(drop=True)
+    path = replay_trades(all_trades).sort_values("ticker", kind="stable").reset_index(drop=True)
+    for field in FIELDS:
+        # exact equality, the engine does the same float operations in the same order
+        mismatches = (expected[field].to_numpy(dtype=float) != path[field].to_numpy()).sum()
+        assert mismatches == 0, f"{mismatches} {field} values differ from PositionKeeper"
+    return elapsed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--tickers", type=int, default=200)
+    parser.add_argument("--reference-all", action="store_true", help="also run PositionKeeper above REFERENCE_LIMIT")
+    args = parser.parse_args()
+
+    # few tickers so the scalar tail is checked too
+    check(synthetic_trades(5000, tickers=5, seed=1))
+    rows = []
+    for n in args.sizes:
+        trades = synthetic_trades(n, args.tickers)
+        start_time = time.perf_counter()
+        final_positions(trades)
+        row = {"trades": n, "engine_s": round(time.perf_counter() - start_time, 3), "reference_s": None}
+        if n <= REFERENCE_LIMIT or args.reference_all:
+            row["reference_s"] = round(check(trades), 3)
+        rows.append(row)
+        print(row)
+    print(pd.DataFrame(rows).to_string(index=False))
@@ -0,0 +1,103 @@
+import argparse
+import email
+import random
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+import pandas as pd
+from ingest import decode_messages, parse_subjects, normalize_trades, trade_batches, INGEST_BATCH_SIZE
+from trade_counter import parse_header
+
+# compares the old per message pd.concat ingestion against the generator pipeline used by store_trades
+# run with: python bench_store_trades.py --sizes 1000 10000 100000
+
+TICKERS = ["NVDA", "AMD", "SPY", "QQQ", "BABA", "UB Sep'25 @CBOT", "ZN Sep'25 @CBOT", "MES Sep'25 @CME", "USD.HKD"]
+CONTRACT_SIZE_TABLE = {"ZN": 1000, "UB": 1000, "MES": 5} # the legacy path's table, the pipeline uses instruments.csv
+# the old path is quadratic, sizes above this are skipped unless --legacy-all is given
+LEGACY_LIMIT = 10000
+
+def synthetic_messages(n, seed = 0):
+    # n header only confirmations, newest first like the reversed imap id list
+    rnd = random.Random(seed)
+    date = datetime(2023, 1, 3, tzinfo=timezone.utc)
+    messages = []
+    for i in range(n):
+        date += timedelta(minutes=rnd.randint(1, 120))
+        side = rnd.choice(["BOUGHT", "SOLD"])
+        header = (f"Date: {format_datetime(date)} (UTC)\r\n"
+                  f"Subject: {side} {rnd.randint(1, 2000):,} {rnd.choice(TICKERS)} @ {rnd.uniform(10, 500):.2f} (U1234567)\r\n"
+                  f"Message-ID: <{i}.synthetic@ib>\r\n\r\n")
+        messages.append((str(i + 1).encode(), email.message_from_string(header)))
+    messages.reverse()
+    return messages
+
+def legacy_store(messages):
+    # the pre pipeline loop, one single row DataFrame and one pd.concat per message
+    all_trades = None
+    for id, msg in messages:
+        date_long, subject = parse_header(msg)
+        subject_split = subject.split()
+        quantity = round((1 if subject_split[0] == "BOUGHT" else -1) * float(subject_split[1].replace(",","")),0)
+        ticker = ''
+        for x in range(2, subject_split.index("@")):
+            ticker += subject_split[x] + " "
+        ticker = ticker[:-1]
+        if ticker.split()[0] in CONTRACT_SIZE_TABLE:
+            contract_size = CONTRACT_SIZE_TABLE[ticker.split()[0]]
+        else:
+            contract_size = 1
+        trade = pd.DataFrame({
+            "date_short": [date_long.strftime("%Y/%m/%d")],
+            "ticker": [ticker],
+            "quantity": [quantity],
+            "price": [float(subject_split[subject_split.index("@") + 1])],
+            "contract_size" : [contract_size],
+            "trade_type": "AUTO",
+            "message_id": [msg["Message-ID"]],
+        })
+        if all_trades is None:
+            all_trades = trade
+        else:
+            all_trades = pd.concat([trade,all_trades], ignore_index = True)
+    return all_trades
+
+def pipeline_store(messages, batch_size = INGEST_BATCH_SIZE):
+    records = normalize_trades(parse_subjects(decode_messages(messages, datetime(2000, 1, 1), verbose = False)))
+    return pd.concat(list(trade_batches(records, batch_size)), ignore_index = True)
+
+def measure(function, messages):
+    # timed without tracemalloc since tracing slows python allocations down several times, peak memory from a second run
+    start_time = time.perf_counter()
+    result = function(messages)
+    elapsed = time.perf_counter() - start_time
+    tracemalloc.start()
+    function(messages)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    parser.add_argument("--legacy-all", action="store_true", help="also run the old path above LEGACY_LIMIT")
+    args = parser.parse_args()
+
+    rows = []
+    for n in args.sizes:
+        messages = synthetic_messages(n)
+        new, new_time, new_peak = measure(lambda m: pipeline_store(m, args.batch_size), messages)
+        row = {"trades": n, "pipeline_s": round(new_time, 3), "pipeline_peak_mb": round(new_peak / 2**20, 1),
+               "legacy_s": None, "legacy_peak_mb": None, "speedup": None}
+        if n <= LEGACY_LIMIT or args.legacy_all:
+            old, old_time, old_peak = measure(legacy_store, messages)
+            # the old loop prepends each older trade so its rows come out oldest first, it had no timestamp column and
+            # int contract sizes (the store keeps them as REAL either way)
+            old = old.iloc[::-1].reset_index(drop=True).astype({"contract_size": float})
+            assert old.equals(new[old.columns]), "pipeline output differs from the old path"
+            row.update({"legacy_s": round(old_time, 3), "legacy_peak_mb": round(old_peak / 2**20, 1),
+                        "speedup": round(old_time / new_time, 1)})
+        rows.append(row)
+        print(row)
+    print(pd.DataFrame(rows).to_string(index=False))
@@ -0,0 +1,258 @@
+import argparse
+import email
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from functools import partial
+import numpy as np
+import pandas as pd
+import trade_review
+from trade_review import (find_trades, analyse_trades, exposure_breakdown, ticker_history, trade_rollup,
+                          get_ticker_trades, EXCLUSION_LIST)
+from ingest import store_trades, INGEST_BATCH_SIZE
+from trade_counter import connect_imap, parse_header
+from trade_store import open_store
+from trade_table import load_table
+from price_service import PriceCache, CloseHistory
+from equity_curve import update_curve
+from scenarios import scenario_grid, stress_test
+from fake_imap import FakeImapServer, synthetic_mailbox, synthetic_confirmation
+
+# end to end benchmark of ingestion and analysis on a synthetic mailbox served by fake_imap, prices are stubbed.
+# Every stage reports throughput, latency percentiles and peak RSS, results are written as json for comparing versions
+# run with: python bench_suite.py --sizes 1000 10000 100000 1000000 --output bench.json --baseline previous.json
+
+SIZES = [1000, 10000, 100000, 1000000]
+REPEATS = 3 # runs of each analysis stage, the latency percentiles are taken over these
+NEW_MESSAGES = 100 # confirmations delivered before the warm find_trades run
+RSS_INTERVAL = 0.005 # seconds between RSS samples
+TOLERANCE = 0.25 # slowdown or memory growth against the baseline that counts as a regression
+
+
+class StubPriceProvider:
+    # deterministic prices so mark to market never touches the network
+    def latest(self, symbols):
+        return {symbol: 100.0 + len(symbol) for symbol in symbols}
+
+    def history(self, symbols, start, end):
+        dates = pd.bdate_range(start, end).strftime("%Y-%m-%d")
+        return pd.DataFrame({symbol: 100.0 + len(symbol) for symbol in symbols}, index=dates)
+
+
+def current_rss():
+    # resident set size in bytes, psutil if installed, otherwise /proc on linux, None if neither is available
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+class RssSampler:
+    # peak RSS while the with block runs, sampled from a background thread
+    def __enter__(self):
+        self.peak = current_rss()
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def sample(self):
+        while self.running:
+            rss = current_rss()
+            if rss is not None:
+                self.peak = max(self.peak, rss)
+            time.sleep(RSS_INTERVAL)
+
+    def __exit__(self, *exc):
+        self.running = False
+        self.thread.join()
+
+
+def percentiles(latencies):
+    latencies = np.array(latencies) * 1000
+    return {f"p{q}_ms": round(float(np.percentile(latencies, q)), 3) for q in (50, 95, 99)}
+
+def measure(stage, trades, run, repeats = REPEATS, setup = None, per_batch = False):
+    # runs stage repeats times, latency is per run, or per batch when run returns a list of batch latencies
+    latencies, elapsed = [], 0.0
+    with RssSampler() as rss, open(os.devnull, "w") as devnull:
+        for repeat in range(repeats):
+            if setup is not None:
+                setup()
+            start_time = time.perf_counter()
+            with redirect_stdout(devnull):
+                inner = run()
+            run_time = time.perf_counter() - start_time
+            elapsed += run_time
+            latencies.extend(inner if per_batch else [run_time])
+    result = {"stage": stage, "trades": trades, "runs": repeats, "seconds": round(elapsed / repeats, 4),
+              "trades_per_s": round(trades * repeats / elapsed, 1), **percentiles(latencies),
+              "peak_rss_mb": round(rss.peak / 2**20, 1) if rss.peak is not None else None}
+    print(result)
+    return result
+
+class TimedStore:
+    # trade store proxy that records when each ingestion batch reaches the store
+    def __init__(self, store):
+        self.store = store
+        self.batch_times = []
+
+    def append(self, trades):
+        self.batch_times.append(time.perf_counter())
+        return self.store.append(trades)
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+
+def run_size(n, workdir, repeats, seed = 0):
+    messages = synthetic_mailbox(n, seed=seed)
+    server = FakeImapServer(messages).start()
+    connect = partial(connect_imap, "127.0.0.1", "bench", "bench", port=server.port, ssl=False)
+    file_location = os.path.join(workdir, f"size{n}")
+    results = []
+    try:
+        # cold build, the same path find_trades takes on an empty store
+        def cold_setup():
+            shutil.rmtree(file_location, ignore_errors=True)
+            os.makedirs(os.path.join(file_location, "backups"))
+            # file_location + r"\trades.db" is a plain file name next to file_location outside windows, and
+            # file_location + r"\backups" a folder
+            for name in os.listdir(workdir):
+                if name.startswith(f"size{n}\\"):
+                    path = os.path.join(workdir, name)
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+        def cold_run():
+            store = TimedStore(open_store(file_location))
+            start_time = time.perf_counter()
+            store_trades(store = store, parallel = True, connect = connect)
+            store.close()
+            # time from the start to the first batch, then between batches of INGEST_BATCH_SIZE trades
+            return list(np.diff([start_time] + store.batch_times))
+        results.append(measure("store_trades", n, cold_run, 1, cold_setup, per_batch = True))
+        store = open_store(file_location)
+        trades = store.count()
+        results[-1]["trades"] = trades
+        results[-1]["trades_per_s"] = round(trades / results[-1]["seconds"], 1)
+
+        # warm rerun after a few new confirmations arrive, dated after the rest of the mailbox
+        start = parse_header(email.message_from_bytes(messages[-1]))[0] + timedelta(days=1)
+        def deliver():
+            for i in range(NEW_MESSAGES):
+                server.append(synthetic_confirmation(start + timedelta(seconds=i), "BOUGHT", 10, "NVDA", 120.0,
+                                                     f"new.{time.time_ns()}.{i}"))
+        results.append(measure("find_trades", NEW_MESSAGES, lambda: find_trades(store, file_location, connect),
+                               repeats, deliver))
+        trades = store.count()
+        results.append(measure("load", trades, lambda: store.load(), repeats))
+        # the column files are current after find_trades, so this is the memory mapped open
+        results.append(measure("load_table", trades, lambda: load_table(store, file_location).frame(), repeats))
+        all_trades = load_table(store, file_location).frame()
+        # full replay, then the checkpointed path on a store whose snapshots are current
+        results.append(measure("analyse_trades", trades, lambda: analyse_trades(all_trades, None, file_location),
+                               repeats))
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            analyse_trades(None, store, file_location)
+        results.append(measure("analyse_trades_checkpointed", trades,
+                               lambda: analyse_trades(None, store, file_location), repeats))
+        open_df = pd.read_csv(file_location + r"\open_summary.csv")
+        results.append(measure("exposure_breakdown", trades, lambda: exposure_breakdown(open_df), repeats))
+        grid = scenario_grid()
+        results.append(measure("stress_test", len(grid) * len(open_df), lambda: stress_test(open_df, grid), repeats))
+        results.append(measure("ticker_history", trades, lambda: ticker_history(store), repeats))
+        results.append(measure("trade_rollup", trades, lambda: trade_rollup(store), repeats))
+        ticker = all_trades["ticker"].value_counts().index[0]
+        # cold replays the ticker, the second lookup is served from the memoized path, mark and printed lookup
+        results.append(measure("get_ticker_trades", trades, lambda: get_ticker_trades(all_trades, ticker), repeats,
+                               setup = trade_review.ticker_drilldown.clear))
+        results.append(measure("get_ticker_trades_repeat", trades, lambda: get_ticker_trades(all_trades, ticker), repeats))
+        # the whole equity curve, then extending it by the last day of the mailbox
+        last_day = store.last_trade_date()
+        def curve(end):
+            return update_curve(store, file_location, trade_review.price_service.close_history, EXCLUSION_LIST, end)
+        def reset_curve(end = None):
+            # without its meta file the next update_curve rebuilds the curve
+            if os.path.isfile(file_location + r"\equity_curve.json"):
+                os.remove(file_location + r"\equity_curve.json")
+            if end is not None:
+                curve(end)
+        results.append(measure("equity_curve", trades, lambda: curve(last_day - timedelta(days=1)), repeats,
+                               setup = reset_curve))
+        results.append(measure("equity_curve_append", trades, lambda: curve(last_day), repeats,
+                               setup = lambda: reset_curve(last_day - timedelta(days=1))))
+        store.close()
+    finally:
+        server.stop()
+    return results
+
+def git_version():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(results, baseline, tolerance = TOLERANCE):
+    # stages that got slower or bigger than baseline by more than tolerance
+    previous = {(result["stage"], result["size"]): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get((result["stage"], result["size"]))
+        if before is None:
+            continue
+        for metric in ("seconds", "p95_ms", "peak_rss_mb"):
+            if before.get(metric) and result.get(metric) and result[metric] > before[metric] * (1 + tolerance):
+                regressions.append(f"{result['stage']} at {result['size']} messages: {metric} "
+                                   f"{before[metric]} -> {result[metric]}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="messages in the synthetic mailbox")
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="earlier --output file, exits with 1 if a stage regressed")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    trade_review.price_service.provider = StubPriceProvider()
+    trade_review.price_service.cache = PriceCache(None)
+    trade_review.price_service.history = CloseHistory(None)
+    workdir = tempfile.mkdtemp(prefix="bench_suite")
+    results = []
+    try:
+        for n in args.sizes:
+            for result in run_size(n, workdir, args.repeats):
+                results.append({"size": n, **result})
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    report = {"version": git_version(), "created": datetime.now().isoformat(timespec="seconds"),
+              "python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__,
+              "platform": platform.platform(), "ingest_batch_size": INGEST_BATCH_SIZE, "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    print(pd.DataFrame(results).to_string(index=False))
+    print(f"results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("regression:", regression)
+        sys.exit(1 if regressions else 0)
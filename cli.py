@@ -0,0 +1,259 @@
+import argparse
+import csv
+import os
+import sys
+from credentials import export_folder, imap_host
+
+# Non interactive entry point for cron jobs and quick lookups, trade_review.py keeps the interactive menu.
+# Heavy modules (pandas, numpy, the trade store and pnl engine) are only imported by the subcommands that use them, so
+# the light commands (summary, count) start in well under STARTUP_BUDGET, see bench_cli.py.
+# run with: python cli.py sync [--account] | summary [--open --account] | ticker NVDA | history
+#           | report [--period --by --start --end] | curve [--ticker --days] | stress | count [--start --end --by]
+#           | reparse [--fill] | wipe-day [--yes] | restore [--at --to --list]
+
+STARTUP_BUDGET = 0.5 # seconds from launch to the light commands doing their work, checked by bench_cli.py
+LIGHT_COMMANDS = ["summary", "count"]
+
+
+def connector(args):
+    from functools import partial
+    from trade_counter import connect_imap
+    return partial(connect_imap, args.host, port = args.port, ssl = not args.no_ssl)
+
+def open_trade_store(args):
+    from trade_review import display_options
+    from trade_store import open_store
+    display_options()
+    return open_store(args.export_folder)
+
+
+def sync(args):
+    # ingest new confirmations and manual trades, then rewrite the summaries, the same as a trade_review run
+    import instrumentation
+    from trade_review import (find_trades, manual_trades, analyse_trades, analyse_accounts, daily_pnl, PROFILE,
+                              EQUITY_CURVE)
+    store = open_trade_store(args)
+    instrumentation.start(PROFILE)
+    try:
+        find_trades(store, args.export_folder, connector(args), args.account)
+        # without a terminal to confirm on, manual trades wait for a run with --yes
+        manual_trades(store, args.export_folder, True if args.yes else None if sys.stdin.isatty() else False)
+        # --account only limits what is fetched, the summaries cover every account
+        if any(store.accounts()):
+            analyse_accounts(store, args.export_folder)
+        else:
+            analyse_trades(None, store, args.export_folder)
+        if EQUITY_CURVE:
+            daily_pnl(store.portfolio(), args.export_folder)
+    finally:
+        instrumentation.finish(args.export_folder + r"\run_report.json")
+        store.close()
+
+def summary(args):
+    # prints the summary written by the last sync or trade_review run, csv module only so it starts instantly. With
+    # several accounts it is the consolidated one, --account prints that account's own
+    suffix = "" if args.account is None else "_" + (args.account or "default")
+    path = args.export_folder + (r"\open_summary" if args.open else r"\all_summary") + suffix + ".csv"
+    if not os.path.isfile(path):
+        print(f"{path} not found, run sync first")
+        return 1
+    with open(path, newline="") as f:
+        rows = list(csv.reader(f))
+    header, rows = rows[0], rows[1:]
+    if "abs_all_pnl" in header:
+        keep = [index for index, column in enumerate(header) if column != "abs_all_pnl"]
+        header, rows = [header[index] for index in keep], [[row[index] for index in keep] for row in rows]
+    widths = [max(len(value) for value in column) for column in zip(header, *rows)]
+    for row in [header] + rows:
+        print("  ".join(value.rjust(width) for value, width in zip(row, widths)))
+    totals = {column: sum(float(row[header.index(column)] or 0) for row in rows) for column in ("open_pnl", "scalp_pnl")}
+    print(f"\nTotal Open PL is {round(totals['open_pnl'], 1)}\nTotal Scalp PL is {round(totals['scalp_pnl'], 1)}")
+
+def ticker(args):
+    from trade_review import get_ticker_trades
+    store = open_trade_store(args)
+    name = args.ticker if " " in args.ticker else args.ticker.upper()
+    # only the rows of the one ticker are read from the store, over every account
+    get_ticker_trades(store.portfolio().load(ticker = name), name)
+    store.close()
+
+def history(args):
+    from trade_review import ticker_history
+    store = open_trade_store(args)
+    ticker_history(store.portfolio())
+    store.close()
+
+def report(args):
+    # rollups of the daily cube, no raw trades are loaded
+    from datetime import datetime
+    from trade_review import trade_rollup
+    store = open_trade_store(args)
+    try:
+        print(trade_rollup(store.portfolio(), args.period, args.by,
+                           args.start and datetime.strptime(args.start, "%Y/%m/%d"),
+                           args.end and datetime.strptime(args.end, "%Y/%m/%d")).to_string(index = False))
+    finally:
+        store.close()
+
+def curve(args):
+    # daily PL and exposure of the portfolio or of one ticker, brought up to yesterday first
+    from trade_review import daily_pnl
+    from equity_curve import read_curve
+    store = open_trade_store(args)
+    try:
+        if args.ticker is None:
+            daily_pnl(store.portfolio(), args.export_folder, args.days)
+            return
+        daily_pnl(store.portfolio(), args.export_folder, 0)
+        name = args.ticker if " " in args.ticker else args.ticker.upper()
+        rows = read_curve(args.export_folder, ticker = True)
+        print(rows.loc[rows["ticker"] == name].tail(args.days).to_string(index = False))
+    finally:
+        store.close()
+
+def stress(args):
+    # scenario grid over the open summary written by the last sync or trade_review run
+    import pandas as pd
+    from trade_review import display_options, stress_report
+    path = args.export_folder + r"\open_summary.csv"
+    if not os.path.isfile(path):
+        print(f"{path} not found, run sync first")
+        return 1
+    display_options()
+    stress_report(pd.read_csv(path))
+
+def count(args):
+    from datetime import datetime
+    from trade_counter import count_trades
+    if args.imap:
+        count_trades(connect = connector(args))
+        return
+    from trade_store import open_store
+    # straight from the order index in the store, no pandas or IMAP needed
+    store = open_store(args.export_folder)
+    try:
+        count_trades(store.portfolio(), args.start and datetime.strptime(args.start, "%Y/%m/%d"),
+                     args.end and datetime.strptime(args.end, "%Y/%m/%d"), args.by)
+    finally:
+        store.close()
+
+def reparse(args):
+    # rebuild the trades from the mail cache, offline unless --fill tops the cache up from IMAP first
+    from trade_review import reparse_trades
+    from ingest import START_DATE, CACHE_FULL_MESSAGES
+    store = open_trade_store(args)
+    try:
+        if args.fill:
+            from mail_cache import MailCache, fill_cache, cache_name
+            from trade_counter import HEADER_FETCH, MESSAGE_FETCH
+            from ingest import load_sources, source_connector
+            # the cache of every configured account, the default one through --host and --port
+            for source in load_sources():
+                cache = MailCache(args.export_folder, cache_name(source["account"]))
+                try:
+                    fill_cache(cache, START_DATE, source_connector(source) if source["account"] else connector(args),
+                               items = MESSAGE_FETCH if CACHE_FULL_MESSAGES else HEADER_FETCH,
+                               mailbox = source["folder"], sender = source["sender"])
+                finally:
+                    cache.close()
+        reparse_trades(store, args.export_folder)
+    finally:
+        store.close()
+
+def wipe_day(args):
+    from trade_review import wipe_last_day
+    store = open_trade_store(args)
+    try:
+        # the most recent day of every account
+        portfolio = store.portfolio()
+        last_trade_date = portfolio.last_trade_date()
+        if last_trade_date is None:
+            print("trade database is empty")
+            return 1
+        print(f"{len(portfolio.load(start_date = last_trade_date))} trades on {last_trade_date:%Y/%m/%d} "
+              "will be deleted")
+        confirmed = args.yes or (sys.stdin.isatty() and input("type y to confirm:\n").lower() == "y")
+        if not confirmed:
+            print("nothing done, pass --yes to wipe without a terminal")
+            return 1
+        wipe_last_day(portfolio, args.export_folder)
+    finally:
+        store.close()
+
+def restore(args):
+    # point in time copy of the trade store from the snapshots and journal in backups\, trades.db is left alone
+    from datetime import datetime
+    from store_journal import Journal, restore_store
+    directory = args.export_folder + r"\backups"
+    if args.list:
+        journal = Journal(directory)
+        for seq, taken, name in journal.snapshots():
+            print(f"{taken:%Y/%m/%d %H:%M:%S}  {name}")
+        for first, name in journal.segments():
+            print(f"records from {first}  {name}")
+        return
+    at = args.at and datetime.strptime(args.at, "%Y/%m/%d %H:%M" if " " in args.at else "%Y/%m/%d")
+    path = args.to or args.export_folder + r"\trades_restored.db"
+    try:
+        restore_store(directory, path, at)
+    except ValueError as error:
+        print(error)
+        return 1
+    print("replace trades.db with it to go back to that point, the journal starts over from it")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="trade_review commands")
+    parser.add_argument("--export-folder", default=export_folder)
+    parser.add_argument("--host", default=imap_host)
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--no-ssl", action="store_true", help="plain IMAP, e.g. for fake_imap.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("sync", help="fetch new trades and update the summaries")
+    command.add_argument("--yes", action="store_true", help="insert manual_trades.csv without asking")
+    command.add_argument("--account", action="append", help="only fetch this account of credentials.accounts, "
+                         "repeatable")
+    command.set_defaults(run=sync)
+    command = commands.add_parser("summary", help="print the last per ticker summary")
+    command.add_argument("--open", action="store_true", help="open positions only")
+    command.add_argument("--account", help="one account's summary, \"default\" for trades without an account")
+    command.set_defaults(run=summary)
+    command = commands.add_parser("ticker", help="trades and running PL of one ticker")
+    command.add_argument("ticker")
+    command.set_defaults(run=ticker)
+    command = commands.add_parser("history", help="tickers traded per month")
+    command.set_defaults(run=history)
+    command = commands.add_parser("report", help="fills, volume, turnover and scalp PL per period")
+    command.add_argument("--period", choices=["day", "month", "year"], default="month")
+    command.add_argument("--by", nargs="*", choices=["ticker", "root", "exposure"], default=["root", "exposure"])
+    command.add_argument("--start", help="first day, YYYY/MM/DD")
+    command.add_argument("--end", help="last day, YYYY/MM/DD")
+    command.set_defaults(run=report)
+    command = commands.add_parser("curve", help="daily PL and gross and net exposure")
+    command.add_argument("--ticker", help="one ticker instead of the portfolio")
+    command.add_argument("--days", type=int, default=30)
+    command.set_defaults(run=curve)
+    command = commands.add_parser("stress", help="PL of the open positions over a grid of market shocks")
+    command.set_defaults(run=stress)
+    command = commands.add_parser("count", help="count orders and fills, the current month by default")
+    command.add_argument("--start", help="first day, YYYY/MM/DD")
+    command.add_argument("--end", help="last day, YYYY/MM/DD")
+    command.add_argument("--by", choices=["ticker", "day"])
+    command.add_argument("--imap", action="store_true", help="scan the mailbox instead of the trade store")
+    command.set_defaults(run=count)
+    command = commands.add_parser("reparse", help="rebuild the trades from the mail cache without IMAP")
+    command.add_argument("--fill", action="store_true", help="first fetch the messages the cache doesn't have")
+    command.set_defaults(run=reparse)
+    command = commands.add_parser("wipe-day", help="delete the most recent day of trades")
+    command.add_argument("--yes", action="store_true", help="don't ask for confirmation")
+    command.set_defaults(run=wipe_day)
+    command = commands.add_parser("restore", help="rebuild the trade store as of a time from backups")
+    command.add_argument("--at", help="YYYY/MM/DD [HH:MM] local time, the latest journal record by default")
+    command.add_argument("--to", help="path of the restored store, trades_restored.db by default")
+    command.add_argument("--list", action="store_true", help="list the snapshots and journal segments")
+    command.set_defaults(run=restore)
+    return parser
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    sys.exit(args.run(args))
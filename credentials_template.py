@@ -1,4 +1,12 @@
 imap_host = 'imap.gmail.com'
 imap_user = 'example@gmail.com'
 imap_pass = 'abcd abcd abcd abcd'
-export_folder = r"C:\Users\name\exports"
\ No newline at end of file
+export_folder = r"C:\Users\name\exports"
+
+# optional, one source per IBKR account whose confirmations arrive in another mailbox or label (see ingest.py). Missing
+# keys take the values above, the port from ssl, folder 'Inbox' and sender 'IB Trading Assistant'
+# accounts = [
+#     {"account": "U1234567", "host": 'imap.gmail.com', "user": 'example@gmail.com', "password": 'abcd abcd abcd abcd',
+#      "folder": 'Inbox', "sender": 'IB Trading Assistant'},
+#     {"account": "U7654321", "folder": 'IBKR/U7654321'},
+# ]
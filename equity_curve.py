@@ -0,0 +1,181 @@
+import io
+import json
+import os
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from trade_store import UTC_OFFSET
+from pnl_engine import replay_trades
+
+# Daily PL time series: every ticker's end of day position marked at that day's close, for each ticker and summed for
+# the portfolio. The positions and marks of all days are laid out as a days x tickers grid and filled forward in one
+# numpy pass instead of replaying and marking day by day. Closes come from the price service's close history
+# (yfinance, or the csv fixture offline).
+# The series are kept next to the store as equity_curve.csv (portfolio) and ticker_pnl.csv (per ticker, the days with a
+# trade or an open position), with the end of day states in equity_curve.json, so a new day is replayed from those
+# states and appended to the files. Trades added before the end of the series or any removal (wipe, reparse) rebuild
+# the series.
+
+CURVE_COLUMNS = ["date", "realised_pnl", "unrealised_pnl", "total_pnl", "gross_exposure", "net_exposure"]
+TICKER_COLUMNS = ["date", "ticker", "exposure", "avg_price", "close", "realised_pnl", "unrealised_pnl", "total_pnl",
+                  "gross_exposure", "net_exposure"]
+STATE_KEYS = ["contract_size", "exposure", "avg_price", "last_price", "realised_pnl"] # kept per ticker between runs
+CLOSE_LOOKBACK = 10 # days of closes before the first new day, carried into it over weekends and holidays
+
+
+def to_day(timestamps):
+    # epoch seconds -> Hong Kong day number (days since 1970/01/01)
+    return (np.asarray(timestamps, dtype="int64") + UTC_OFFSET) // 86400
+
+def day_date(day):
+    return datetime(1970, 1, 1) + pd.Timedelta(days=int(day))
+
+def fill_forward(values, first):
+    # NaN cells of a days x tickers grid take the last value above them, first is the row before the grid
+    values = np.vstack([first, values])
+    rows = np.where(np.isnan(values), 0, np.arange(len(values))[:, None])
+    np.maximum.accumulate(rows, axis=0, out=rows)
+    return values[rows, np.arange(values.shape[1])][1:]
+
+def mark_days(trades, initial, days, close_history):
+    # positions after trades (newest first) at the end of each of the day numbers days, starting from initial
+    # (ticker -> STATE_KEYS at the end of the day before days[0]), marked with close_history(tickers, start, end).
+    # Returns the per ticker rows, the portfolio rows and the states after the last day
+    path = replay_trades(trades, initial)
+    tickers = np.array(sorted(set(initial) | set(path["ticker"].astype(str))), dtype=object)
+    columns = {ticker: column for column, ticker in enumerate(tickers)}
+    grid = (len(days), len(tickers))
+
+    # last row of every (ticker, day), path is grouped by ticker and chronological
+    path_days = to_day(path["last_timestamp"].to_numpy())
+    path_tickers = path["ticker"].astype(str).to_numpy()
+    last = np.r_[(path_tickers[1:] != path_tickers[:-1]) | (path_days[1:] != path_days[:-1]), True] if len(path) else []
+    rows = np.searchsorted(days, path_days[last])
+    cols = np.array([columns[ticker] for ticker in path_tickers[last]], dtype=int)
+    traded = np.zeros(grid, dtype=bool)
+    traded[rows, cols] = True
+    state = {}
+    for key in STATE_KEYS:
+        values = np.full(grid, np.nan)
+        values[rows, cols] = path[key].to_numpy()[last]
+        state[key] = fill_forward(values, [initial.get(ticker, {}).get(key, np.nan) for ticker in tickers])
+    exposure = np.nan_to_num(state["exposure"])
+    open_position = exposure != 0
+
+    # closes of the tickers held at some point, carried forward over days without a close, the last trade price
+    # until a ticker has one
+    dates = pd.DatetimeIndex([day_date(day) for day in days])
+    held = tickers[open_position.any(axis=0)]
+    marks = np.full(grid, np.nan)
+    if len(held):
+        closes = close_history(list(held), (dates[0] - pd.Timedelta(days=CLOSE_LOOKBACK)).strftime("%Y-%m-%d"),
+                               dates[-1].strftime("%Y-%m-%d"))
+        closes = closes.reindex(closes.index.union(dates)).ffill().reindex(dates)
+        marks[:, [columns[ticker] for ticker in held]] = closes.to_numpy(dtype=float)
+    marks = np.where(np.isnan(marks), state["last_price"], marks)
+
+    contract_size = np.nan_to_num(state["contract_size"], nan=1.0)
+    with np.errstate(invalid="ignore"):
+        net = np.where(open_position, exposure * marks * contract_size, 0.0)
+        unrealised = np.where(open_position, (exposure * marks - exposure * state["avg_price"]) * contract_size, 0.0)
+    realised = np.nan_to_num(state["realised_pnl"])
+
+    day_labels = dates.strftime("%Y/%m/%d").to_numpy(dtype=object)
+    row, col = np.nonzero(traded | open_position)
+    ticker_rows = pd.DataFrame({
+        "date": day_labels[row],
+        "ticker": tickers[col],
+        "exposure": exposure[row, col],
+        "avg_price": np.nan_to_num(state["avg_price"])[row, col],
+        "close": np.where(open_position[row, col], marks[row, col], np.nan),
+        "realised_pnl": realised[row, col],
+        "unrealised_pnl": unrealised[row, col],
+        "total_pnl": realised[row, col] + unrealised[row, col],
+        "gross_exposure": np.abs(net[row, col]),
+        "net_exposure": net[row, col],
+    })
+    curve_rows = pd.DataFrame({
+        "date": day_labels,
+        "realised_pnl": realised.sum(axis=1),
+        "unrealised_pnl": unrealised.sum(axis=1),
+        "total_pnl": realised.sum(axis=1) + unrealised.sum(axis=1),
+        "gross_exposure": np.abs(net).sum(axis=1),
+        "net_exposure": net.sum(axis=1),
+    })
+    states = {ticker: {key: float(state[key][-1, column]) for key in STATE_KEYS}
+              for column, ticker in enumerate(tickers) if not np.isnan(state["exposure"][-1, column])}
+    return ticker_rows, curve_rows, states
+
+def read_meta(file_location):
+    path = file_location + r"\equity_curve.json"
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def write_meta(file_location, meta):
+    # the meta file is the commit point, anything past the sizes it records is cut off by the next append
+    path = file_location + r"\equity_curve.json"
+    with open(path + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(path + ".tmp", path)
+
+def append_rows(path, rows, size):
+    # cut path back to size bytes and append rows, with the header when the file starts empty. Returns the new size
+    with open(path, "r+b" if os.path.isfile(path) else "wb") as f:
+        f.truncate(size)
+        f.seek(0, os.SEEK_END)
+        f.write(rows.to_csv(index=False, header=size == 0, lineterminator="\n").encode())
+        return f.tell()
+
+def update_curve(store, file_location, close_history, exclude = (), end_date = None):
+    # brings equity_curve.csv and ticker_pnl.csv up to end_date (the last full Hong Kong day by default) and returns
+    # the portfolio curve. close_history is PriceService.close_history or a function like it
+    if end_date is None:
+        end_day = (int(time.time()) + UTC_OFFSET) // 86400 - 1
+    else:
+        end_day = (pd.Timestamp(end_date).normalize() - pd.Timestamp(0)).days
+    exclude = sorted(exclude)
+    meta = read_meta(file_location)
+    if meta is not None:
+        new, _ = store.load_columns(meta["max_id"])
+        # trades removed, or added to days already in the series
+        if (meta["generation"] != store.generation() or meta["exclude"] != exclude or
+                (to_day(new["timestamp"]) <= meta["last_day"]).any()):
+            print("trades changed before the end of the equity curve, rebuilding it")
+            meta = None
+    if meta is None:
+        trades = store.load(end_date = day_date(end_day))
+        meta = {"last_day": None, "max_id": 0, "generation": store.generation(), "exclude": exclude, "states": {},
+                "curve_size": 0, "ticker_size": 0}
+    elif meta["last_day"] < end_day:
+        trades = store.load(start_date = day_date(meta["last_day"] + 1), end_date = day_date(end_day))
+    else:
+        return read_curve(file_location)
+    # every trade up to end_day is covered, the excluded ones too, so max_id only marks later inserts as new
+    max_id = max(meta["max_id"], int(trades["trade_id"].max()) if len(trades) else 0)
+    trades = trades.loc[~trades["ticker"].isin(exclude)]
+    if meta["last_day"] is None and len(trades) == 0:
+        return read_curve(file_location)
+
+    first_day = meta["last_day"] + 1 if meta["last_day"] is not None else int(to_day(trades["timestamp"].min()))
+    all_days = np.arange(first_day, end_day + 1)
+    # weekdays, and weekend days with trades (a US Friday session ends on a Hong Kong Saturday)
+    days = all_days[((all_days + 3) % 7 < 5) | np.isin(all_days, to_day(trades["timestamp"].to_numpy()))]
+    ticker_rows, curve_rows, states = mark_days(trades, meta["states"], days, close_history)
+    meta = dict(meta, last_day = int(end_day), states = dict(meta["states"], **states),
+                max_id = max_id,
+                ticker_size = append_rows(file_location + r"\ticker_pnl.csv", ticker_rows, meta["ticker_size"]),
+                curve_size = append_rows(file_location + r"\equity_curve.csv", curve_rows, meta["curve_size"]))
+    write_meta(file_location, meta)
+    return read_curve(file_location)
+
+def read_curve(file_location, ticker = False):
+    # the portfolio curve, or the per ticker rows, as far as the last update_curve committed them
+    meta = read_meta(file_location)
+    size = meta and meta["ticker_size" if ticker else "curve_size"]
+    if not size:
+        return pd.DataFrame(columns = TICKER_COLUMNS if ticker else CURVE_COLUMNS)
+    with open(file_location + (r"\ticker_pnl.csv" if ticker else r"\equity_curve.csv"), "rb") as f:
+        return pd.read_csv(io.BytesIO(f.read(size)))
@@ -0,0 +1,306 @@
+import re
+import random
+import select
+import socketserver
+import threading
+import time
+import email
+from email.utils import format_datetime, parsedate_to_datetime
+from datetime import datetime, timedelta, timezone
+
+# Local stand-in for the Gmail IMAP server, loaded with synthetic IB Trading Assistant confirmations. It speaks the
+# subset of IMAP4rev1 that trade_review uses (LOGIN, SELECT, STATUS, SEARCH, FETCH, their UID forms, NOOP, IDLE and
+# LOGOUT) over plain TCP, so imaplib.IMAP4 can connect to it with connect_imap(host, port=..., ssl=False).
+# run with: python fake_imap.py --messages 10000 --port 1143
+
+UIDVALIDITY = 1
+STOCKS = ["NVDA", "AMD", "ARM", "SMCI", "SPY", "QQQ", "BABA", "TCEHY", "GLD", "SGOV"]
+FUTURES = ["UB Sep'25 @CBOT", "ZN Sep'25 @CBOT", "ZT Sep'25 @CBOT", "CL Oct'25 @NYMEX", "SOFR3 Dec'25 @CME"]
+FX = ["USD.HKD", "USD.CNH", "EUR.USD"]
+
+
+def synthetic_confirmation(date, side, quantity, ticker, price, message_id, account = "U1234567"):
+    # raw RFC822 bytes in the shape of an IB Trading Assistant trade confirmation
+    return (f"From: IB Trading Assistant <tradingassistant@interactivebrokers.com>\r\n"
+            f"To: trader@example.com\r\n"
+            f"Subject: {side} {quantity:,} {ticker} @ {price:g} ({account})\r\n"
+            f"Date: {format_datetime(date.astimezone(timezone.utc))} (UTC)\r\n"
+            f"Message-ID: <{message_id}@synthetic.ibkr>\r\n"
+            f"Content-Type: text/plain; charset=utf-8\r\n"
+            f"\r\n"
+            f"{side} {quantity:,} {ticker} @ {price:g} ({account})\r\n").encode()
+
+def synthetic_mailbox(n, start = datetime(2023, 1, 3, tzinfo=timezone.utc), seed = 0, noise = 0.05, split_fills = 0.2):
+    # n trade confirmations in arrival order: stocks, futures, FX pairs from EXCLUSION_LIST and orders split into
+    # several fills at the same price, with a share of unrelated emails mixed in
+    rnd = random.Random(seed)
+    prices = {ticker: rnd.uniform(20, 500) for ticker in STOCKS + FUTURES}
+    prices.update({"USD.HKD": 7.8, "USD.CNH": 7.2, "EUR.USD": 1.09})
+    date = start
+    messages = []
+    while len(messages) < n:
+        date += timedelta(seconds=rnd.randint(30, 6 * 3600))
+        if rnd.random() < noise:
+            messages.append((f"From: Newsletter <news@example.com>\r\nSubject: Market wrap\r\n"
+                             f"Date: {format_datetime(date)} (UTC)\r\nMessage-ID: <noise{len(messages)}@example.com>\r\n"
+                             f"\r\nnothing to see\r\n").encode())
+            continue
+        kind = rnd.random()
+        ticker = rnd.choice(STOCKS if kind < 0.6 else FUTURES if kind < 0.9 else FX)
+        prices[ticker] *= 1 + rnd.gauss(0, 0.01)
+        price = round(prices[ticker], 4 if ticker in FX else 2)
+        side = rnd.choice(["BOUGHT", "SOLD"])
+        quantity = rnd.choice([1, 2, 5, 10]) if ticker in FUTURES else rnd.choice([10, 50, 100, 250]) * (1000 if ticker in FX else 1)
+        fills = rnd.randint(2, 4) if rnd.random() < split_fills else 1
+        for fill in range(fills):
+            if len(messages) == n:
+                break
+            messages.append(synthetic_confirmation(date + timedelta(seconds=fill), side, quantity, ticker, price,
+                                                   f"{seed}.{len(messages)}"))
+    return messages
+
+
+class Mailbox:
+    # messages with their UIDs, shared by every connection of the server
+    def __init__(self, messages = (), uidvalidity = UIDVALIDITY):
+        self.uidvalidity = uidvalidity
+        self.lock = threading.Lock()
+        self.uids, self.raw, self.headers = [], [], []
+        self.next_uid = 1
+        for message in messages:
+            self.append(message)
+
+    def append(self, raw):
+        # new messages get the next UID, like a mail arriving
+        header = email.message_from_bytes(raw.split(b"\r\n\r\n", 1)[0] + b"\r\n\r\n")
+        with self.lock:
+            self.uids.append(self.next_uid)
+            self.raw.append(raw)
+            self.headers.append(header)
+            self.next_uid += 1
+
+    def expunge(self, uids):
+        # remove messages by UID, like a mail deleted in another client. Later messages move down a sequence number
+        uids = set(uids)
+        with self.lock:
+            kept = [index for index, uid in enumerate(self.uids) if uid not in uids]
+            self.uids, self.raw, self.headers = ([items[index] for index in kept]
+                                                 for items in (self.uids, self.raw, self.headers))
+
+    def __len__(self):
+        return len(self.uids)
+
+
+def parse_set(message_set, largest):
+    # imap message set "1:3,7,9:*" -> sorted numbers, n:* with n above the largest still matches the largest
+    numbers = set()
+    for part in message_set.split(","):
+        low, _, high = part.partition(":")
+        low = largest if low == "*" else int(low)
+        high = low if not _ else largest if high == "*" else int(high)
+        low, high = min(low, high), max(low, high)
+        numbers.update(range(low, high + 1))
+    return sorted(numbers)
+
+def tokenize(line):
+    # split a command line on spaces, keeping "quoted strings" and (parenthesized lists) together
+    return [token[1:-1] if token.startswith('"') else token
+            for token in re.findall(r'"(?:[^"\\]|\\.)*"|\((?:[^()]|\([^()]*\))*\)|\S+', line)]
+
+def header_fields(raw, fields):
+    # the requested header lines of a message, like BODY[HEADER.FIELDS (...)]
+    lines = re.split(rb"\r\n(?![ \t])", raw.split(b"\r\n\r\n", 1)[0])
+    wanted = {field.upper().encode() for field in fields}
+    return b"".join(line + b"\r\n" for line in lines if line.split(b":", 1)[0].upper() in wanted) + b"\r\n"
+
+
+class ImapHandler(socketserver.StreamRequestHandler):
+    def send(self, line):
+        self.wfile.write(line if isinstance(line, bytes) else line.encode() + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        self.selected = False
+        self.known = 0
+        self.send("* OK [CAPABILITY IMAP4rev1 IDLE] fake imap ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, _, rest = line.decode().rstrip("\r\n").partition(" ")
+            command, _, arguments = rest.partition(" ")
+            command = command.upper()
+            uid = command == "UID"
+            if uid:
+                command, _, arguments = arguments.partition(" ")
+                command = command.upper()
+            if command == "FETCH" and server.drop_fetches > 0:
+                # simulated network failure for retry/reconnect testing
+                server.drop_fetches -= 1
+                return
+            server.commands += 1
+            if server.latency:
+                time.sleep(server.latency)
+            handler = getattr(self, "do_" + command.lower(), None)
+            if handler is None:
+                self.send(f"{tag} BAD unknown command {command}")
+            elif handler(tag, arguments, uid) == "logout":
+                return
+
+    def do_capability(self, tag, arguments, uid):
+        self.send("* CAPABILITY IMAP4rev1 IDLE")
+        self.send(f"{tag} OK CAPABILITY completed")
+
+    def do_login(self, tag, arguments, uid):
+        self.send(f"{tag} OK LOGIN completed")
+
+    def do_noop(self, tag, arguments, uid):
+        self.report_exists()
+        self.send(f"{tag} OK NOOP completed")
+
+    def do_logout(self, tag, arguments, uid):
+        self.send("* BYE logging out")
+        self.send(f"{tag} OK LOGOUT completed")
+        return "logout"
+
+    def do_select(self, tag, arguments, uid):
+        mailbox = self.server.mailbox
+        self.selected = True
+        self.known = len(mailbox)
+        self.send(f"* {len(mailbox)} EXISTS")
+        self.send("* 0 RECENT")
+        self.send(f"* OK [UIDVALIDITY {mailbox.uidvalidity}] UIDs valid")
+        self.send(f"* OK [UIDNEXT {mailbox.next_uid}] next UID")
+        self.send(f"{tag} OK [READ-WRITE] SELECT completed")
+
+    do_examine = do_select
+
+    def do_status(self, tag, arguments, uid):
+        mailbox = self.server.mailbox
+        name = tokenize(arguments)[0]
+        self.send(f'* STATUS "{name}" (MESSAGES {len(mailbox)} UIDNEXT {mailbox.next_uid} UIDVALIDITY {mailbox.uidvalidity})')
+        self.send(f"{tag} OK STATUS completed")
+
+    def do_search(self, tag, arguments, uid):
+        mailbox = self.server.mailbox
+        with mailbox.lock:
+            uids, headers = list(mailbox.uids), list(mailbox.headers)
+        selected = set(range(1, len(uids) + 1))
+        tokens = tokenize(arguments)
+        index = 0
+        while index < len(tokens):
+            key = tokens[index].upper()
+            if key == "ALL":
+                index += 1
+            elif key == "FROM":
+                sender = tokens[index + 1].lower()
+                selected &= {number for number in selected if sender in str(headers[number - 1]["From"]).lower()}
+                index += 2
+            elif key == "SINCE":
+                since = datetime.strptime(tokens[index + 1], "%d-%b-%Y").date()
+                selected &= {number for number in selected
+                             if parsedate_to_datetime(headers[number - 1]["Date"]).date() >= since}
+                index += 2
+            elif key == "UID":
+                wanted = set(parse_set(tokens[index + 1], uids[-1] if uids else 0))
+                selected &= {number for number in selected if uids[number - 1] in wanted}
+                index += 2
+            else:
+                wanted = set(parse_set(tokens[index], len(uids)))
+                selected &= wanted
+                index += 1
+        found = [uids[number - 1] if uid else number for number in sorted(selected)]
+        self.send("* SEARCH" + "".join(f" {number}" for number in found))
+        self.send(f"{tag} OK SEARCH completed")
+
+    def do_fetch(self, tag, arguments, uid):
+        mailbox = self.server.mailbox
+        message_set, _, items = arguments.partition(" ")
+        items = items.upper()
+        with mailbox.lock:
+            uids, raw = list(mailbox.uids), list(mailbox.raw)
+        if uid:
+            positions = {message_uid: number for number, message_uid in enumerate(uids, 1)}
+            numbers = [positions[message_uid] for message_uid in parse_set(message_set, uids[-1] if uids else 0)
+                       if message_uid in positions]
+        else:
+            numbers = [number for number in parse_set(message_set, len(uids)) if number <= len(uids)]
+        fields = re.search(r"HEADER\.FIELDS \(([^)]*)\)", items)
+        for number in numbers:
+            parts = [f"UID {uids[number - 1]}"] if uid or "UID" in items else []
+            if fields:
+                literal = header_fields(raw[number - 1], fields.group(1).split())
+                name = f"BODY[HEADER.FIELDS ({fields.group(1)})]"
+            elif "RFC822" in items or "BODY" in items:
+                literal = raw[number - 1]
+                name = "RFC822" if "RFC822" in items else "BODY[]"
+            else:
+                self.send(f"* {number} FETCH ({' '.join(parts)})")
+                continue
+            self.send(f"* {number} FETCH ({' '.join(parts + [name])} {{{len(literal)}}}\r\n".encode() + literal + b")\r\n")
+        self.send(f"{tag} OK FETCH completed")
+
+    def do_idle(self, tag, arguments, uid):
+        # push EXISTS updates until the client sends DONE
+        self.send("+ idling")
+        while True:
+            self.report_exists()
+            readable, _, _ = select.select([self.rfile], [], [], self.server.idle_poll)
+            if readable:
+                line = self.rfile.readline()
+                if not line or line.strip().upper() == b"DONE":
+                    break
+        self.send(f"{tag} OK IDLE terminated")
+
+    def report_exists(self):
+        count = len(self.server.mailbox)
+        if self.selected and count != self.known:
+            self.known = count
+            self.send(f"* {count} EXISTS")
+
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, messages = (), host = "127.0.0.1", port = 0, drop_fetches = 0, idle_poll = 0.05, latency = 0.0):
+        super().__init__((host, port), ImapHandler)
+        self.mailbox = Mailbox(messages)
+        self.drop_fetches = drop_fetches # the next n FETCH commands close the connection instead of answering
+        self.latency = latency # seconds added to every command to mimic the round trip to a remote server
+        self.idle_poll = idle_poll
+        self.commands = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def append(self, raw):
+        self.mailbox.append(raw)
+
+    def expunge(self, uids):
+        self.mailbox.expunge(uids)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--port", type=int, default=1143)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every command")
+    args = parser.parse_args()
+    server = FakeImapServer(synthetic_mailbox(args.messages, seed=args.seed), port=args.port, latency=args.latency)
+    print(f"serving {args.messages} synthetic messages on 127.0.0.1:{server.port}, Ctrl+C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,106 @@
+import imaplib
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import email
+from trade_counter import connect_imap, fetch_headers, parse_header, FETCH_CHUNK_SIZE, HEADER_FETCH
+from instrumentation import timed
+
+# Cold rebuild ingestion: the UID list is split into shards that are fetched and decoded concurrently over a small pool
+# of authenticated IMAP connections, then merged back into one deterministic newest first order.
+
+POOL_SIZE = 4 # concurrent IMAP connections, gmail allows up to 15 per account
+SHARD_SIZE = 2000 # UIDs per shard, each shard is fetched by one connection in FETCH_CHUNK_SIZE chunks
+SHARD_RETRIES = 3 # reconnect and refetch a shard this many times before giving up
+# errors after which a connection is dropped and replaced
+CONNECTION_ERRORS = (imaplib.IMAP4.abort, imaplib.IMAP4.error, OSError, EOFError)
+
+
+class ImapPool:
+    # authenticated connections with the mailbox already selected, opened lazily up to size.
+    # The queue holds either an idle connection or None for a slot that still needs to connect.
+    def __init__(self, connect = connect_imap, size = POOL_SIZE, mailbox = 'Inbox'):
+        self.connect = connect
+        self.mailbox = mailbox
+        self.connections = queue.Queue()
+        for slot in range(size):
+            self.connections.put(None)
+
+    def acquire(self):
+        imap = self.connections.get()
+        if imap is not None:
+            return imap
+        try:
+            imap = self.connect()
+            imap.select(self.mailbox)
+        except BaseException:
+            self.connections.put(None)
+            raise
+        return imap
+
+    def release(self, imap, broken = False):
+        if not broken:
+            self.connections.put(imap)
+            return
+        # give the slot back empty so the next acquire reconnects
+        try:
+            imap.shutdown()
+        except Exception:
+            pass
+        self.connections.put(None)
+
+    def close(self):
+        while not self.connections.empty():
+            imap = self.connections.get_nowait()
+            if imap is None:
+                continue
+            try:
+                imap.logout()
+            except Exception:
+                pass
+
+
+@timed
+def fetch_shard(pool, uids, chunk_size = FETCH_CHUNK_SIZE, retries = SHARD_RETRIES, raw = False, items = HEADER_FETCH):
+    # fetch and decode the headers of one shard of UIDs, (uid, date_long, subject, message_id) in UID order,
+    # with raw = True the fetched bytes are added as a fifth item
+    for attempt in range(retries + 1):
+        imap = None
+        try:
+            imap = pool.acquire()
+            decoded = []
+            for uid, data in fetch_headers(imap, uids, chunk_size, uid = True, report = False, raw = True, items = items):
+                msg = email.message_from_bytes(data)
+                date_long, subject = parse_header(msg)
+                decoded.append((int(uid), date_long, subject, msg["Message-ID"]) + ((data,) if raw else ()))
+        except CONNECTION_ERRORS as error:
+            if imap is not None:
+                pool.release(imap, broken = True)
+            print(f"shard {int(uids[0])}:{int(uids[-1])} failed ({error!r}), attempt {attempt + 1} of {retries + 1}")
+            if attempt == retries:
+                raise
+            continue
+        pool.release(imap)
+        return decoded
+
+def parallel_fetch(uids, connect = connect_imap, pool_size = POOL_SIZE, shard_size = SHARD_SIZE,
+                   chunk_size = FETCH_CHUNK_SIZE, retries = SHARD_RETRIES, mailbox = 'Inbox', on_shard = None,
+                   items = HEADER_FETCH):
+    # decoded headers of every UID, newest first by (date, uid) whatever order the shards finish in.
+    # on_shard is called from this thread with each shard's decoded headers plus the raw bytes, e.g. to cache them
+    uids = sorted(uids, key=int)
+    shards = [uids[i:i + shard_size] for i in range(0, len(uids), shard_size)]
+    pool = ImapPool(connect, pool_size, mailbox)
+    results = []
+    try:
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+            for shard in executor.map(lambda shard: fetch_shard(pool, shard, chunk_size, retries, on_shard is not None,
+                                                                items), shards):
+                if on_shard is not None:
+                    on_shard(shard)
+                    shard = [message[:4] for message in shard]
+                results.append(shard)
+    finally:
+        pool.close()
+    decoded = [message for shard in results for message in shard]
+    decoded.sort(key=lambda message: (message[1], message[0]), reverse=True)
+    return decoded
@@ -0,0 +1,293 @@
+import multiprocessing
+import os
+from queue import Empty
+from datetime import datetime, timedelta
+from functools import partial
+import pandas as pd
+import credentials
+from trade_counter import (connect_imap, fetch_headers, get_uidvalidity, parse_header, FETCH_CHUNK_SIZE, HEADER_FETCH,
+                           MESSAGE_FETCH, SENDER)
+from imap_pool import parallel_fetch, POOL_SIZE, SHARD_SIZE
+from mail_cache import MailCache, cached_headers, cached_parallel_fetch, cache_name
+from instruments import instrument_master
+import instrumentation
+from instrumentation import span, timed, timed_iter, count
+
+# Ingestion of the IB Trading Assistant confirmations into the trade store: the fetch -> decode -> parse -> normalize
+# generator stages behind store_trades, shared by trade_review, watch.py and the account workers below.
+#
+# For several IBKR accounts whose confirmations arrive in different mailboxes or labels, accounts in credentials.py
+# lists one source per account, each is searched and fetched in its own worker process through its own mail cache
+# (mail_cache_<account>.db/.pack). The workers send each batch of parsed trades back over a bounded queue as it is
+# ready and the parent appends it to the one trade store under the source's account, so the store and its journal keep
+# a single writer. Without accounts the imap_host/imap_user mailbox is the only source and its trades belong to the
+# default account "".
+
+START_DATE = datetime(2023, 1, 1)
+INGEST_BATCH_SIZE = 5000 # trades materialized into a DataFrame at a time during ingestion
+EXPORT_CSV = False # also write all_trades.csv after every change to the trade store
+MAIL_CACHE = True # keep every fetched confirmation in mail_cache.pack, IMAP is only asked for messages it doesn't have
+CACHE_FULL_MESSAGES = False # cache whole confirmations instead of the DATE, SUBJECT and MESSAGE-ID headers
+QUEUED_BATCHES = 2 # batches of INGEST_BATCH_SIZE trades each account worker can get ahead of the store writes
+
+SOURCE_DEFAULTS = {"account": "", "host": credentials.imap_host, "user": credentials.imap_user,
+                   "password": credentials.imap_pass, "port": None, "ssl": True, "folder": "Inbox", "sender": SENDER}
+
+
+def decode_messages(messages, start_date = START_DATE, verbose = True):
+    # decode the headers of (id, message) pairs coming newest first, stops at the first message before start_date
+    decoded = ((id, *parse_header(msg), msg["Message-ID"]) for id, msg in messages)
+    return take_since(decoded, start_date, verbose)
+
+def take_since(decoded, start_date = START_DATE, verbose = True):
+    # (id, date_long, subject, message_id) newest first -> (date_long, subject, message_id) until start_date
+    for id, date_long, subject, message_id in decoded:
+        if datetime(date_long.year, date_long.month, date_long.day) < start_date:
+            return
+        if verbose:
+            print(date_long, subject)
+        yield date_long, subject, message_id
+
+def parse_subjects(decoded):
+    # split a subject like "BOUGHT 1,000 UB Sep'25 @CBOT @ 118.5 (U1234)" into side, quantity, ticker and price
+    for date_long, subject, message_id in decoded:
+        subject_split = subject.split()
+        at = subject_split.index("@")
+        yield {
+            "date_long": date_long,
+            "quantity": round((1 if subject_split[0] == "BOUGHT" else -1) * float(subject_split[1].replace(",","")),0),
+            "ticker": " ".join(subject_split[2:at]),
+            "price": float(subject_split[at + 1]),
+            "message_id": message_id,
+        }
+
+def normalize_trades(parsed):
+    # turn parsed subjects into records with the columns of the trade database, contract_size comes from trade_frame
+    for trade in parsed:
+        yield {
+            "timestamp": int(trade["date_long"].timestamp()),
+            "date_short": trade["date_long"].strftime("%Y/%m/%d"),
+            "ticker": trade["ticker"],
+            "quantity": trade["quantity"],
+            "price": trade["price"],
+            "trade_type": "AUTO",
+            "message_id": trade["message_id"],
+        }
+
+def trade_frame(records):
+    # records -> DataFrame, the contract sizes are joined from the instrument master for the whole column at once
+    trades = pd.DataFrame.from_records(records)
+    if len(trades):
+        trades.insert(5, "contract_size", instrument_master.contract_sizes(trades["ticker"]))
+    return trades
+
+def trade_batches(records, batch_size = INGEST_BATCH_SIZE):
+    # materialize a record stream into DataFrames of at most batch_size trades
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            count("trades_parsed", len(batch))
+            yield trade_frame(batch)
+            batch = []
+    if batch:
+        count("trades_parsed", len(batch))
+        yield trade_frame(batch)
+
+def fetch_trades(start_date = START_DATE, sync_state = None, chunk_size = FETCH_CHUNK_SIZE,
+                 batch_size = INGEST_BATCH_SIZE, parallel = False, pool_size = POOL_SIZE, shard_size = SHARD_SIZE,
+                 connect = connect_imap, cache = None, mailbox = 'Inbox', sender = SENDER):
+    # the IMAP half of store_trades: (batches of new trades, sync_state to save once they are stored), the batches
+    # are fetched as they are consumed
+    with span("imap_connect"):
+        imap = connect()
+        imap.select(mailbox)
+        uidvalidity = get_uidvalidity(imap, mailbox)
+    #fetch all trades on the account, on reruns only new messages are requested
+    with span("imap_search"):
+        if sync_state is not None and sync_state["uidvalidity"] == uidvalidity:
+            # only ask the server for messages that arrived after the last ingested UID
+            result, data = imap.uid('search', None, f'UID {sync_state["last_uid"] + 1}:* FROM "{sender}"')
+            # n:* always matches the newest message even if its UID is below n
+            id_list = [id for id in data[0].split() if int(id) > sync_state["last_uid"]]
+        elif parallel:
+            # cold rebuild, let the server drop everything before start_date (SINCE is by day, a day of slack for timezones)
+            since = (start_date - timedelta(days=1)).strftime("%d-%b-%Y")
+            result, data = imap.uid('search', None, f'FROM "{sender}" SINCE {since}')
+            id_list = data[0].split()
+        else:
+            result, data = imap.uid('search', None, f'FROM "{sender}"')
+            id_list = data[0].split()
+    id_list.reverse()
+    last_uid = sync_state["last_uid"] if sync_state is not None and sync_state["uidvalidity"] == uidvalidity else 0
+    if id_list:
+        last_uid = max(last_uid, int(id_list[0]))
+
+    # fetch -> decode -> parse -> normalize, each stage is a generator so only one batch of trades is held at a time
+    # and each batch is appended to the store as soon as it is complete
+    items = MESSAGE_FETCH if CACHE_FULL_MESSAGES else HEADER_FETCH
+    if cache is not None and (sync_state is None or sync_state["uidvalidity"] != uidvalidity):
+        # the cache may still hold these messages under the UIDs of an earlier UIDVALIDITY
+        cache.relink(imap, id_list, uidvalidity, chunk_size)
+    if parallel:
+        # shards of UIDs fetched and decoded concurrently over a pool of connections, merged newest first
+        with span("parallel_fetch"):
+            if cache is not None:
+                decoded = cached_parallel_fetch(id_list, cache, uidvalidity, connect, pool_size, shard_size, chunk_size,
+                                                items, mailbox)
+            else:
+                decoded = parallel_fetch(id_list, connect, pool_size, shard_size, chunk_size, mailbox = mailbox)
+        decoded = timed_iter("decode", take_since(decoded, start_date))
+    else:
+        if cache is not None:
+            messages = timed_iter("fetch", cached_headers(imap, id_list, cache, uidvalidity, chunk_size, items))
+        else:
+            messages = timed_iter("fetch", fetch_headers(imap, id_list, chunk_size, uid = True))
+        decoded = timed_iter("decode", decode_messages(messages, start_date))
+    parsed = timed_iter("parse", parse_subjects(decoded))
+    records = timed_iter("normalize", normalize_trades(parsed))
+    return timed_iter("batch", trade_batches(records, batch_size)), {"uidvalidity": uidvalidity, "last_uid": last_uid}
+
+@timed
+def store_trades(start_date = START_DATE, store = None, chunk_size = FETCH_CHUNK_SIZE, sync_state = None,
+                 batch_size = INGEST_BATCH_SIZE, parallel = False, pool_size = POOL_SIZE, shard_size = SHARD_SIZE,
+                 connect = connect_imap, cache = None, mailbox = 'Inbox', sender = SENDER):
+    if store is None:
+        print("No trade store")
+        return 0
+    batches, sync_state = fetch_trades(start_date, sync_state, chunk_size, batch_size, parallel, pool_size,
+                                       shard_size, connect, cache, mailbox, sender)
+    new_trades = 0
+    for batch in batches:
+        # messages that are already in the store are skipped so replaying a day is a no-op
+        with span("append"):
+            new_trades += store.append(batch)
+    count("trades_stored", new_trades)
+    with span("index_orders"):
+        # fill to order grouping for count_trades, done once after all batches since they arrive newest first
+        store.index_orders()
+    store.set_meta("sync_state", sync_state)
+    return new_trades
+
+@timed
+def backup_store(store, file_location):
+    # the journal in backups\ already holds every change, a compressed snapshot of the store is taken every
+    # SNAPSHOT_DAYS so a restore replays at most that many days of it (see store_journal.py)
+    if store.journal is None:
+        backup_path = file_location + r"\backups\trades" + f"{datetime.now().strftime("%Y_%m_%d")}" + ".db"
+        if not os.path.isfile(backup_path):
+            store.backup(backup_path)
+    elif store.journal.snapshot_due():
+        print(f"backed up the trade store to {store.journal.snapshot(store)}")
+
+def save_trades(store, file_location):
+    # common tail of every write to the store
+    backup_store(store, file_location)
+    if EXPORT_CSV:
+        with span("export_csv"):
+            store.portfolio().export_csv(file_location + r"\all_trades.csv")
+
+def resume_point(store):
+    # start date of the next ingestion into store, None for an empty store which is built from START_DATE in parallel
+    last_trade_date = store.last_trade_date()
+    if last_trade_date is None:
+        return None
+    # trades without a message_id can't be deduplicated so only re-read the last day if it is fully keyed
+    last_day = store.load(start_date = last_trade_date)
+    if last_day["message_id"].notna().all():
+        return last_trade_date
+    return last_trade_date + timedelta(days=1)
+
+def account_label(account):
+    return account or "default"
+
+
+def load_sources(accounts = None):
+    # the configured sources with defaults filled in, only the given accounts if any
+    sources = [dict(SOURCE_DEFAULTS, **source) for source in getattr(credentials, "accounts", None) or [{}]]
+    names = [source["account"] for source in sources]
+    if len(set(names)) != len(names):
+        raise ValueError(f"accounts in credentials.py need one source each, got {names}")
+    if accounts:
+        unknown = sorted(set(accounts) - set(names))
+        if unknown:
+            raise ValueError(f"no source configured for {', '.join(unknown)}, the accounts are {names}")
+        sources = [source for source in sources if source["account"] in accounts]
+    return sources
+
+def source_connector(source):
+    return partial(connect_imap, source["host"], source["user"], source["password"], port = source["port"],
+                   ssl = source["ssl"])
+
+def fetch_source(source, file_location, start_date, sync_state, queue):
+    # worker process: puts ("batch", account, trades) for every batch of the source's new trades as soon as it is
+    # parsed, then ("done", account, sync_state to save once they are stored, instrumentation) or ("failed", account,
+    # error, instrumentation). The queue is bounded, so the worker waits while the parent catches up
+    account = source["account"]
+    instrumentation.start()
+    cache = None
+    try:
+        cache = MailCache(file_location, cache_name(account)) if MAIL_CACHE else None
+        batches, sync_state = fetch_trades(start_date or START_DATE, sync_state, parallel = start_date is None,
+                                           connect = source_connector(source), cache = cache,
+                                           mailbox = source["folder"], sender = source["sender"])
+        for batch in batches:
+            queue.put(("batch", account, batch))
+        queue.put(("done", account, sync_state, instrumentation.snapshot()))
+    except Exception as error:
+        queue.put(("failed", account, repr(error), instrumentation.snapshot()))
+    finally:
+        if cache is not None:
+            cache.close()
+
+@timed
+def ingest_sources(store, file_location, sources, processes = None):
+    # fetch every source in parallel and append each batch of trades as it arrives, a source that fails keeps its
+    # sync_state and is fetched again by the next run. Returns account -> new trades
+    context = multiprocessing.get_context()
+    queue = context.Queue(maxsize = QUEUED_BATCHES * len(sources))
+    pending, running, new_trades = list(sources), {}, {}
+    while pending or running:
+        while pending and len(running) < (processes or len(sources)):
+            source = pending.pop(0)
+            view = store.view(source["account"])
+            # batches arrive newest first, so until the source is done the next run has to start where this one did
+            interrupted = view.get_meta("interrupted_start")
+            if interrupted is not None:
+                start_date = interrupted["start"] and datetime.strptime(interrupted["start"], "%Y/%m/%d")
+            else:
+                start_date = resume_point(view)
+                view.set_meta("interrupted_start", {"start": start_date and f"{start_date:%Y/%m/%d}"})
+            running[source["account"]] = context.Process(
+                target = fetch_source, args = (source, file_location, start_date, view.get_meta("sync_state"), queue),
+                daemon = True)
+            running[source["account"]].start()
+            new_trades[source["account"]] = 0
+        # a worker that was gone before the wait has nothing left in the queue once it comes back empty
+        exited = [account for account, process in running.items() if not process.is_alive()]
+        try:
+            message = queue.get(timeout = 1)
+        except Empty:
+            for account in exited:
+                print(f"account {account_label(account)}: ingestion worker exited with {running.pop(account).exitcode}"
+                      f", retried on the next run")
+            continue
+        kind, account = message[:2]
+        view = store.view(account)
+        if kind == "batch":
+            with span("append"):
+                new_trades[account] += view.append(message[2])
+            continue
+        running.pop(account).join()
+        instrumentation.merge(message[3], f"account_{account_label(account)}")
+        if kind == "failed":
+            print(f"account {account_label(account)}: ingestion failed ({message[2]}), retried on the next run")
+            continue
+        count("trades_stored", new_trades[account])
+        view.index_orders()
+        view.set_meta("sync_state", message[2])
+        view.set_meta("interrupted_start", None)
+        print(f"account {account_label(account)}: {new_trades[account]} new trades")
+    if any(new_trades.values()):
+        save_trades(store, file_location)
+    return new_trades
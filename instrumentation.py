@@ -0,0 +1,193 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+
+# Run instrumentation for trade_review: nested timing spans, counters and an optional cProfile or tracemalloc capture.
+# Spans nest by call stack (per thread) so "find_trades/store_trades/fetch" is the fetch stage of the ingestion in
+# find_trades, and each span reports its own time with the time of the spans inside it taken out.
+# usage: start() once, span/timed/timed_iter/count while running, finish(path) writes the json report and prints a table
+
+PROFILE_TOP = 25 # functions or allocation sites kept in the report when profiling
+
+
+class Run:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, profile = None):
+        self.local = threading.local() # a forked worker starts without the stack of the thread that forked it
+        self.started_at = datetime.now()
+        self.start_time = time.perf_counter()
+        self.spans = {} # "a/b/c" -> [calls, seconds]
+        self.counters = {}
+        self.profile = profile
+        self.profiler = None
+
+    def stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def enter(self, path):
+        # spans are listed in the order they were first entered, so a parent comes before its children
+        if path not in self.spans:
+            with self.lock:
+                self.spans.setdefault(path, [0, 0.0])
+
+    def record(self, path, elapsed):
+        with self.lock:
+            span = self.spans[path]
+            span[0] += 1
+            span[1] += elapsed
+
+    def count(self, name, value = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+run = Run()
+
+
+@contextmanager
+def span(name):
+    stack = run.stack()
+    stack.append(name)
+    path = "/".join(stack)
+    run.enter(path)
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        run.record(path, time.perf_counter() - start_time)
+        stack.pop()
+
+def timed(function):
+    # decorator, the whole call is a span named after the function
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with span(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+def timed_iter(name, iterable):
+    # span around each next() of a generator stage, upstream stages pulled inside it show up as its children
+    iterator = iter(iterable)
+    stack = run.stack()
+    while True:
+        stack.append(name)
+        path = "/".join(stack)
+        run.enter(path)
+        start_time = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            run.record(path, time.perf_counter() - start_time)
+            stack.pop()
+        yield item
+
+def count(name, value = 1):
+    run.count(name, value)
+
+def snapshot():
+    # spans, counters and run time recorded so far, for merge() in another process, e.g. from an ingest.py worker
+    with run.lock:
+        return {"spans": {path: list(values) for path, values in run.spans.items()}, "counters": dict(run.counters),
+                "wall_s": time.perf_counter() - run.start_time}
+
+def merge(recorded, name):
+    # add a snapshot() of another process as a top level span called name, its spans nested under it and its counters
+    # summed into this run's
+    with run.lock:
+        for path, (calls, seconds) in [(name, (1, recorded["wall_s"]))] + [
+                (name + "/" + path, values) for path, values in recorded["spans"].items()]:
+            span = run.spans.setdefault(path, [0, 0.0])
+            span[0] += calls
+            span[1] += seconds
+        for counter, value in recorded["counters"].items():
+            run.counters[counter] = run.counters.get(counter, 0) + value
+
+
+def start(profile = None):
+    # profile = "cpu" for cProfile, "memory" for tracemalloc, None for spans and counters only
+    run.reset(profile)
+    if profile == "cpu":
+        import cProfile
+        run.profiler = cProfile.Profile()
+        run.profiler.enable()
+    elif profile == "memory":
+        import tracemalloc
+        tracemalloc.start()
+
+def profile_report(path = None):
+    if run.profile == "cpu":
+        import pstats
+        run.profiler.disable()
+        if path is not None:
+            # full profile next to the report for snakeviz or pstats
+            run.profiler.dump_stats(path.rsplit(".", 1)[0] + ".prof")
+        stats = pstats.Stats(run.profiler)
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP]
+        return [{"function": f"{file}:{line}({function})", "calls": calls, "total_s": round(total, 4),
+                 "cumulative_s": round(cumulative, 4)}
+                for (file, line, function), (primitive, calls, total, cumulative, callers) in rows]
+    if run.profile == "memory":
+        import tracemalloc
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {"peak_mb": round(peak / 2**20, 2), "current_mb": round(current / 2**20, 2),
+                "top": [{"line": str(stat.traceback[0]), "size_mb": round(stat.size / 2**20, 3), "count": stat.count}
+                        for stat in snapshot.statistics("lineno")[:PROFILE_TOP]]}
+    return None
+
+def report(path = None):
+    # spans with their self time (total minus direct children), counters and the profile if one was started
+    with run.lock:
+        spans = {path: list(values) for path, values in run.spans.items()}
+        counters = dict(run.counters)
+    children = {}
+    for span_path, (calls, seconds) in spans.items():
+        parent = span_path.rpartition("/")[0]
+        if parent:
+            children[parent] = children.get(parent, 0) + seconds
+    # tree order, children right after their parent and siblings in the order they were first entered
+    entered = {span_path: index for index, span_path in enumerate(spans)}
+    parts = {span_path: span_path.split("/") for span_path in spans}
+    order = sorted(spans, key=lambda span_path: [entered.get("/".join(parts[span_path][:depth + 1]), -1)
+                                                 for depth in range(len(parts[span_path]))])
+    return {
+        "started_at": run.started_at.isoformat(timespec="seconds"),
+        "wall_s": round(time.perf_counter() - run.start_time, 4),
+        "spans": [{"span": span_path, "calls": calls, "total_s": round(seconds, 4),
+                   "self_s": round(seconds - children.get(span_path, 0), 4)}
+                  for span_path, (calls, seconds) in ((span_path, spans[span_path]) for span_path in order)],
+        "counters": counters,
+        "profile": profile_report(path),
+    }
+
+def summary_table(run_report):
+    # short text table of the spans in call order, indented by depth, and the counters
+    lines = [f"{'stage':<48}{'calls':>9}{'total s':>10}{'self s':>10}"]
+    for span_report in run_report["spans"]:
+        depth = span_report["span"].count("/")
+        name = "  " * depth + span_report["span"].rpartition("/")[2]
+        lines.append(f"{name:<48}{span_report['calls']:>9}{span_report['total_s']:>10.3f}{span_report['self_s']:>10.3f}")
+    lines.append(f"{'wall time':<48}{'':>9}{run_report['wall_s']:>10.3f}")
+    for name, value in run_report["counters"].items():
+        lines.append(f"{name:<48}{value:>9}")
+    return "\n".join(lines)
+
+def finish(path = None):
+    # write the json report to path, print the summary table and return the report
+    run_report = report(path)
+    if path is not None:
+        with open(path, "w") as f:
+            json.dump(run_report, f, indent=1)
+    print(summary_table(run_report))
+    return run_report
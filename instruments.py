@@ -0,0 +1,90 @@
+import os
+import threading
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+# Instrument master: contract size, exposure bucket, beta, price feed and rate tenor of every instrument, loaded once
+# from instruments.csv. A row is either a root ("UB") or a root and expiry ("UC Sep'25") that overrides the fields it
+# fills in for that one contract. Lookups take whole ticker columns, each distinct ticker is parsed and joined against
+# the table once and remembered, so a column is resolved with one hash lookup per row.
+
+INSTRUMENTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "instruments.csv")
+CURRENCY_TABLE = {
+    "EURUSD" : 1.09,
+    "USDCNH" : 7.23,
+}
+# a contract multiplier is converted to USD by multiplying with USD_RATES and dividing by USD_DIVISORS of its
+# currency, the way each pair is quoted
+USD_RATES = {"USD": 1.0, "EUR": CURRENCY_TABLE["EURUSD"], "CNH": 1.0}
+USD_DIVISORS = {"USD": 1.0, "EUR": 1.0, "CNH": CURRENCY_TABLE["USDCNH"]}
+DV01_BETA_SCALE = 10000 # DV01 betas in instruments.csv are USD per bp per 10000 USD of notional
+# "UB Sep'25 @CBOT" -> root UB, expiry Sep'25, exchange CBOT, stocks and FX pairs are only a root
+TICKER_PATTERN = r"^(?P<root>\S+)(?:\s+(?P<expiry>[^\s@]+))?(?:\s+@(?P<exchange>\S+))?"
+FIELDS = ["contract_size", "exposure", "beta", "feed_symbol", "carry_rate", "feed_expiry", "tenor"]
+
+
+class InstrumentMaster:
+    def __init__(self, path = INSTRUMENTS_FILE):
+        table = pd.read_csv(path, dtype={"instrument": str, "currency": str, "exposure": str, "feed_symbol": str,
+                                         "feed_expiry": str})
+        table["contract_size"] = (table["multiplier"] * table["currency"].map(USD_RATES) /
+                                  table["currency"].map(USD_DIVISORS))
+        dv01 = table["exposure"] == "DV01"
+        table.loc[dv01, "beta"] = table.loc[dv01, "beta"] / DV01_BETA_SCALE
+        self.table = table.set_index("instrument")[FIELDS]
+        # ticker -> root, expiry, exchange and FIELDS of every ticker seen so far
+        self.resolved = None
+        self.lock = threading.Lock() # watch.py prices from several threads, each may add new tickers to resolved
+
+    def parse(self, tickers):
+        # split tickers and join them against the table, a contract row wins over its root row field by field
+        tickers = pd.Series(tickers, dtype=object)
+        parts = tickers.str.extract(TICKER_PATTERN)
+        contract = self.table.reindex(parts["root"] + " " + parts["expiry"]).reset_index(drop=True)
+        root = self.table.reindex(parts["root"]).reset_index(drop=True)
+        resolved = pd.concat([parts, contract.combine_first(root)[FIELDS]], axis=1)
+        resolved["contract_size"] = resolved["contract_size"].fillna(1.0).astype(float)
+        resolved["expiry"] = pd.to_datetime(resolved["expiry"], format="%b'%y", errors="coerce")
+        resolved.index = pd.Index(tickers, dtype=object, name="ticker")
+        return resolved
+
+    def lookup(self, tickers):
+        # root, expiry (first of the month), exchange and FIELDS for a column of tickers, aligned with its index.
+        # Unknown roots get a contract size of 1 and no exposure, beta or feed
+        tickers = pd.Series(tickers)
+        codes, uniques = pd.factorize(tickers)
+        uniques = pd.Index(np.asarray(uniques, dtype=object))
+        with self.lock:
+            resolved = self.resolved
+            new = uniques if resolved is None else uniques[~uniques.isin(resolved.index)]
+            if len(new) or resolved is None:
+                resolved = self.parse(new) if resolved is None else pd.concat([resolved, self.parse(new)])
+                self.resolved = resolved
+        info = resolved.reindex(uniques).iloc[codes]
+        info.index = tickers.index
+        return info
+
+    def contract_sizes(self, tickers):
+        return self.lookup(tickers)["contract_size"].to_numpy()
+
+    def price_feeds(self, tickers):
+        # (feed symbol, compound factor) columns for tickers, a stock is its own symbol and a future needs a feed_symbol
+        # (None otherwise). Futures on a carry are scaled by (1 + carry_rate / 365) ** days to feed_expiry
+        tickers = pd.Series(tickers)
+        info = self.lookup(tickers)
+        names = tickers.astype(object)
+        symbols = info["feed_symbol"].where(info["feed_symbol"].notna(), names.where(~names.str.contains(" ")))
+        return pd.DataFrame({"feed_symbol": symbols.astype(object).where(symbols.notna(), None),
+                             "compound_factor": self.compound_factors(tickers, [datetime.now()])[0]}, index=info.index)
+
+    def compound_factors(self, tickers, dates):
+        # len(dates) x len(tickers) price feed factors (1 + carry_rate / 365) ** whole days from each date to
+        # feed_expiry, 1 for tickers without a carry
+        info = self.lookup(tickers)
+        expiry = pd.to_datetime(info["feed_expiry"], format="%Y/%m/%d").to_numpy()
+        days = np.floor((expiry[None, :] - pd.DatetimeIndex(dates).to_numpy()[:, None]) / np.timedelta64(1, "D"))
+        factors = (1 + info["carry_rate"].to_numpy(dtype=float)[None, :] / 365) ** days
+        return np.where(np.isnan(factors), 1.0, factors)
+
+instrument_master = InstrumentMaster()
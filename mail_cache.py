@@ -0,0 +1,252 @@
+import email
+import hashlib
+import mmap
+import os
+import sqlite3
+import zlib
+from trade_counter import (connect_imap, fetch_headers, get_uidvalidity, parse_header, FETCH_CHUNK_SIZE, HEADER_FETCH,
+                           SENDER)
+from imap_pool import parallel_fetch, POOL_SIZE, SHARD_SIZE
+from instrumentation import span, count
+
+# Local cache of the raw confirmation emails, so IMAP is only asked for messages that have never been fetched and a
+# reparse of the whole history runs offline (see reparse_trades in trade_review.py).
+# Messages are content addressed: every distinct message is zlib compressed once into the append only mail_cache.pack
+# and mail_cache.db maps (uidvalidity, uid) and Message-ID to the sha1 of its bytes and its offset and length in the
+# pack. Reads go through an mmap of the pack, a full reparse is one pass over the file without a read call per message.
+
+CACHE_CHUNK_SIZE = 500 # UIDs looked up in the index per query
+COMPRESS_LEVEL = 9
+# preset dictionary for the compressor, a confirmation header is ~200 bytes so most of the saving comes from text
+# every confirmation shares. Existing packs can only be read with the same bytes, never edit it
+ZDICT = (b"Content-Type: text/plain; charset=utf-8\r\nFrom: IB Trading Assistant <tradingassistant@interactivebrokers.com>"
+         b"\r\nTo: \r\n@gmail.com>\r\n@mail.gmail.com>\r\n@synthetic.ibkr>\r\n@interactivebrokers.com>\r\nMessage-ID: <"
+         b"\r\nDate: Mon, Tue, Wed, Thu, Fri, Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec 2023 2024 2025 2026 "
+         b"+0000 (UTC)\r\n-0400 (EDT)\r\n-0500 (EST)\r\nSubject: SOLD 1,000 UB Sep'25 @CBOT @ 118.5 (U1234567)"
+         b"\r\nSubject: BOUGHT 100 NVDA @ 120.5 (U1234567)\r\n")
+
+
+def compress(raw):
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zdict=ZDICT)
+    return compressor.compress(raw) + compressor.flush()
+
+def decompress(data):
+    return zlib.decompressobj(zdict=ZDICT).decompress(data)
+
+def cache_name(account):
+    # every account's mailbox has its own cache, the default account keeps the original name
+    return "mail_cache" if account == "" else f"mail_cache_{account}"
+
+
+class MailCache:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS blobs (
+            digest BLOB PRIMARY KEY,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            size INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS messages (
+            uidvalidity INTEGER NOT NULL,
+            uid INTEGER NOT NULL,
+            message_id TEXT,
+            timestamp INTEGER NOT NULL,
+            digest BLOB NOT NULL REFERENCES blobs(digest),
+            PRIMARY KEY (uidvalidity, uid)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS messages_message_id ON messages(message_id);
+    """
+
+    def __init__(self, file_location, name = "mail_cache"):
+        # one cache per mailbox, UIDs of different mailboxes overlap
+        self.conn = sqlite3.connect(file_location + "\\" + name + ".db")
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        # appends go through the file object, reads through a map that is widened when they pass its end
+        self.pack = open(file_location + "\\" + name + ".pack", "ab+")
+        self.end = self.pack.seek(0, os.SEEK_END)
+        self.map = None
+
+    def read(self, offset, length):
+        # decompressed bytes of a pack record, None if the pack lost it (written after the last flush before a crash)
+        if self.map is None or offset + length > len(self.map):
+            self.pack.flush()
+            if offset + length > os.fstat(self.pack.fileno()).st_size:
+                return None
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.pack.fileno(), 0, access=mmap.ACCESS_READ)
+        return decompress(self.map[offset:offset + length])
+
+    def uids(self, uidvalidity):
+        return {uid for uid, in self.conn.execute("SELECT uid FROM messages WHERE uidvalidity = ?", (uidvalidity,))}
+
+    def get_many(self, uidvalidity, uids):
+        # uid -> raw bytes of the cached ones among uids
+        uids = [int(uid) for uid in uids]
+        found = {}
+        for i in range(0, len(uids), CACHE_CHUNK_SIZE):
+            chunk = uids[i:i + CACHE_CHUNK_SIZE]
+            rows = self.conn.execute(
+                f"SELECT uid, offset, length FROM messages JOIN blobs USING (digest) WHERE uidvalidity = ? "
+                f"AND uid IN ({','.join('?' * len(chunk))}) ORDER BY offset", [uidvalidity] + chunk).fetchall()
+            for uid, offset, length in rows:
+                raw = self.read(offset, length)
+                if raw is not None:
+                    found[uid] = raw
+        count("mail_cache_hits", len(found))
+        return found
+
+    def put_many(self, uidvalidity, messages):
+        # messages are (uid, raw, timestamp, message_id), raw bytes already in the pack are not written again
+        rows, blobs = [], {}
+        # another MailCache on the same files (watch and its find_trades) may have appended since
+        self.end = self.pack.seek(0, os.SEEK_END)
+        for uid, raw, timestamp, message_id in messages:
+            digest = hashlib.sha1(raw).digest()
+            if digest not in blobs and self.conn.execute("SELECT 1 FROM blobs WHERE digest = ?", (digest,)).fetchone() is None:
+                data = compress(raw)
+                self.pack.write(data)
+                blobs[digest] = (digest, self.end, len(data), len(raw))
+                self.end += len(data)
+            rows.append((uidvalidity, int(uid), message_id, timestamp, digest))
+        # the pack is on disk before the index points into it, otherwise a crash can leave committed offsets past the
+        # end of the pack that the next put_many hands out again
+        self.pack.flush()
+        if blobs:
+            os.fsync(self.pack.fileno())
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO blobs (digest, offset, length, size) VALUES (?, ?, ?, ?)",
+                                  blobs.values())
+            self.conn.executemany("INSERT OR REPLACE INTO messages (uidvalidity, uid, message_id, timestamp, digest) "
+                                  "VALUES (?, ?, ?, ?, ?)", rows)
+        count("mail_cache_writes", len(rows))
+        return len(blobs)
+
+    def put_decoded(self, uidvalidity, decoded):
+        # put_many for parallel_fetch shards, (uid, date_long, subject, message_id, raw)
+        with span("mail_cache"):
+            return self.put_many(uidvalidity, [(uid, raw, int(date_long.timestamp()), message_id)
+                                               for uid, date_long, subject, message_id, raw in decoded])
+
+    def relink(self, imap, uids, uidvalidity, chunk_size = FETCH_CHUNK_SIZE):
+        # after a UIDVALIDITY change every cached message has a new UID, only the Message-ID header of the uncached
+        # UIDs is fetched and the messages that are already in the pack are filed under their new UID
+        if not uids or self.conn.execute("SELECT 1 FROM messages WHERE uidvalidity != ? LIMIT 1",
+                                         (uidvalidity,)).fetchone() is None:
+            return 0
+        cached = self.uids(uidvalidity)
+        uids = [uid for uid in uids if int(uid) not in cached]
+        if not uids:
+            return 0
+        rows = []
+        with span("mail_cache_relink"):
+            for uid, msg in fetch_headers(imap, uids, chunk_size, uid = True, report = False,
+                                          items = "(BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])"):
+                cached = self.conn.execute("SELECT timestamp, digest FROM messages WHERE message_id = ? LIMIT 1",
+                                           (msg["Message-ID"],)).fetchone()
+                if msg["Message-ID"] is not None and cached is not None:
+                    rows.append((uidvalidity, int(uid), msg["Message-ID"], *cached))
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO messages (uidvalidity, uid, message_id, timestamp, digest) "
+                                      "VALUES (?, ?, ?, ?, ?)", rows)
+        print(f"{len(rows)} of {len(uids)} messages found in the mail cache under an earlier UIDVALIDITY")
+        return len(rows)
+
+    def messages(self):
+        # (uid, message) of every distinct cached message newest first, the input decode_messages expects
+        rows = self.conn.execute(
+            "SELECT uid, offset, length, MAX(uidvalidity) FROM messages JOIN blobs USING (digest) GROUP BY digest "
+            "ORDER BY timestamp DESC, uid DESC")
+        for uid, offset, length, uidvalidity in rows:
+            raw = self.read(offset, length)
+            if raw is not None:
+                yield uid, email.message_from_bytes(raw)
+
+    def message_ids(self):
+        return {message_id for message_id, in self.conn.execute("SELECT DISTINCT message_id FROM messages")
+                if message_id is not None}
+
+    def stats(self):
+        messages, raw_bytes = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        return {"messages": messages, "raw_bytes": raw_bytes, "pack_bytes": self.end}
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.pack.close()
+        self.conn.close()
+
+
+def cached_entry(uid, raw):
+    # (uid, raw, timestamp, message_id) for put_many and the parsed message
+    msg = email.message_from_bytes(raw)
+    return (uid, raw, int(parse_header(msg)[0].timestamp()), msg["Message-ID"]), msg
+
+def cached_headers(imap, id_list, cache, uidvalidity, chunk_size = FETCH_CHUNK_SIZE, items = HEADER_FETCH):
+    # fetch_headers through the cache: (uid, message) in the order of id_list, the messages the cache doesn't have
+    # are fetched chunk_size at a time and added to it
+    hits = fetched = 0
+    try:
+        for i in range(0, len(id_list), chunk_size):
+            chunk = id_list[i:i + chunk_size]
+            with span("mail_cache"):
+                messages = {uid: email.message_from_bytes(raw) for uid, raw in cache.get_many(uidvalidity, chunk).items()}
+            hits += len(messages)
+            missing = [uid for uid in chunk if int(uid) not in messages]
+            if missing:
+                entries = []
+                for uid, raw in fetch_headers(imap, missing, chunk_size, uid = True, report = False, raw = True,
+                                              items = items):
+                    entry, messages[int(uid)] = cached_entry(int(uid), raw)
+                    entries.append(entry)
+                fetched += len(entries)
+                with span("mail_cache"):
+                    cache.put_many(uidvalidity, entries)
+            for uid in chunk:
+                # fetch_headers skips messages expunged since the search
+                if int(uid) in messages:
+                    yield uid, messages[int(uid)]
+    finally:
+        if hits + fetched:
+            print(f"{hits} messages read from the mail cache, {fetched} fetched")
+
+def cached_parallel_fetch(id_list, cache, uidvalidity, connect = connect_imap, pool_size = POOL_SIZE,
+                          shard_size = SHARD_SIZE, chunk_size = FETCH_CHUNK_SIZE, items = HEADER_FETCH,
+                          mailbox = 'Inbox'):
+    # parallel_fetch through the cache, the cached messages are decoded locally and only the others are fetched
+    with span("mail_cache"):
+        decoded = []
+        for uid, raw in cache.get_many(uidvalidity, id_list).items():
+            msg = email.message_from_bytes(raw)
+            decoded.append((uid, *parse_header(msg), msg["Message-ID"]))
+    cached = {uid for uid, date_long, subject, message_id in decoded}
+    missing = [uid for uid in id_list if int(uid) not in cached]
+    if missing:
+        decoded += parallel_fetch(missing, connect, pool_size, shard_size, chunk_size, mailbox = mailbox,
+                                  on_shard = lambda shard: cache.put_decoded(uidvalidity, shard), items = items)
+    print(f"{len(cached)} messages read from the mail cache, {len(missing)} fetched")
+    decoded.sort(key=lambda message: (message[1], message[0]), reverse=True)
+    return decoded
+
+def fill_cache(cache, since, connect = connect_imap, pool_size = POOL_SIZE, shard_size = SHARD_SIZE,
+               chunk_size = FETCH_CHUNK_SIZE, items = HEADER_FETCH, mailbox = 'Inbox', sender = SENDER):
+    # fetch the confirmations since the date since that the cache doesn't have, e.g. the ones ingested before it
+    # existed, without touching the trade store. Returns the number of fetched messages
+    imap = connect()
+    try:
+        imap.select(mailbox)
+        uidvalidity = get_uidvalidity(imap, mailbox)
+        result, data = imap.uid('search', None, f'FROM "{sender}" SINCE {since:%d-%b-%Y}')
+        id_list = data[0].split()
+        cache.relink(imap, id_list, uidvalidity, chunk_size)
+    finally:
+        imap.logout()
+    cached = cache.uids(uidvalidity)
+    missing = [uid for uid in id_list if int(uid) not in cached]
+    if missing:
+        parallel_fetch(missing, connect, pool_size, shard_size, chunk_size, mailbox = mailbox,
+                       on_shard = lambda shard: cache.put_decoded(uidvalidity, shard), items = items)
+    print(f"{len(id_list) - len(missing)} messages already in the mail cache, {len(missing)} fetched")
+    return len(missing)
@@ -0,0 +1,214 @@
+import numpy as np
+import pandas as pd
+from trade_store import UTC_OFFSET
+
+# Batch version of PositionKeeper. All tickers are replayed together: trades are grouped by ticker once and the k-th
+# trade of every ticker is applied in one numpy step, so the python loop runs max(trades per ticker) times instead of
+# once per trade. The arithmetic is the same as PositionKeeper.add_trade/update_stats operation for operation, so the
+# results match it exactly, including flips through zero.
+
+# once fewer tickers than this are still being replayed the rest of their trades are applied one by one,
+# a numpy step has a fixed cost of about 50 plain python trades so it only pays off with many lanes active
+MIN_VECTOR_LANES = 64
+# fields that fully describe a PositionKeeper, everything else is derived by update_stats
+STATE_FIELDS = ["ticker", "contract_size", "exposure", "avg_price", "last_price", "realised_pnl", "timestamp"]
+
+
+def group_trades(all_trades):
+    # chronological order (all_trades is newest first) grouped by ticker, stable so each ticker keeps trade order
+    trades = all_trades.iloc[::-1]
+    if isinstance(trades["ticker"].dtype, pd.CategoricalDtype):
+        codes, tickers = trades["ticker"].cat.codes.to_numpy(), trades["ticker"].cat.categories
+    else:
+        codes, tickers = pd.factorize(trades["ticker"])
+    order = np.argsort(codes, kind="stable")
+    codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.array([], dtype=int)
+    lengths = np.diff(np.r_[starts, len(codes)])
+    return trades.iloc[order], np.asarray(tickers)[codes[starts]], starts, lengths
+
+def apply_step(exposure, avg_price, realised, price, quantity, contract_size):
+    # one trade for every lane, the np.select branches mirror PositionKeeper.add_trade
+    new_exposure = exposure + quantity
+    opening = (exposure == 0) & (quantity != 0)
+    adding = exposure * quantity > 0
+    closing = exposure * quantity < 0
+    reducing = closing & ((new_exposure == 0) | ((new_exposure > 0) == (exposure > 0)))
+    flipping = closing & ~reducing
+    with np.errstate(divide="ignore", invalid="ignore"):
+        added_avg = ((exposure * avg_price) + (quantity * price)) / new_exposure
+    profit = np.where(reducing, -quantity * (price - avg_price), exposure * (price - avg_price))
+    realised = np.where(closing, realised + profit * contract_size, realised)
+    avg_price = np.select([opening, adding, reducing & (new_exposure == 0), flipping],
+                          [price, added_avg, 0.0, price], avg_price)
+    exposure = np.where(quantity != 0, new_exposure, exposure)
+    return exposure, avg_price, realised
+
+def apply_trade(exposure, avg_price, realised, price, quantity, contract_size):
+    # scalar copy of PositionKeeper.add_trade on plain floats
+    if quantity > 0:
+        if exposure == 0:
+            avg_price = price
+            exposure += quantity
+        elif exposure > 0:
+            total_cost = (exposure * avg_price) + (quantity * price)
+            exposure += quantity
+            avg_price = total_cost / exposure
+        elif exposure + quantity <= 0:
+            realised += -quantity * (price - avg_price) * contract_size
+            exposure += quantity
+            if exposure == 0:
+                avg_price = 0.0
+        else:
+            realised += exposure * (price - avg_price) * contract_size
+            exposure += quantity
+            avg_price = price
+    elif quantity < 0:
+        if exposure == 0:
+            avg_price = price
+            exposure += quantity
+        elif exposure < 0:
+            total_cost = (exposure * avg_price) + (quantity * price)
+            exposure += quantity
+            avg_price = total_cost / exposure
+        elif exposure + quantity >= 0:
+            realised += -quantity * (price - avg_price) * contract_size
+            exposure += quantity
+            if exposure == 0:
+                avg_price = 0.0
+        else:
+            realised += exposure * (price - avg_price) * contract_size
+            exposure += quantity
+            avg_price = price
+    return exposure, avg_price, realised
+
+def replay_trades(all_trades, initial = None):
+    # running position after every trade, one row per trade in chronological order grouped by ticker
+    # initial maps ticker -> PositionKeeper state (STATE_FIELDS) to resume from instead of a flat position
+    initial = initial or {}
+    trades, tickers, starts, lengths = group_trades(all_trades)
+    prices = trades["price"].to_numpy(dtype="float64")
+    quantities = trades["quantity"].to_numpy(dtype="float64")
+    contract_sizes = trades["contract_size"].to_numpy(dtype="float64")
+    n = len(trades)
+    exposure_path, avg_path, realised_path = np.zeros(n), np.zeros(n), np.zeros(n)
+    # PositionKeeper takes the contract size of the first trade of the ticker
+    group_contract_size = contract_sizes[starts]
+    group_state = np.zeros((len(starts), 3))
+    for group, ticker in enumerate(tickers):
+        if ticker in initial:
+            state = initial[ticker]
+            group_contract_size[group] = state["contract_size"]
+            group_state[group] = state["exposure"], state["avg_price"], state["realised_pnl"]
+
+    # longest tickers first so the tickers still active at step k are always a prefix of the lanes
+    lanes = np.argsort(-lengths, kind="stable")
+    lane_starts, lane_lengths = starts[lanes], lengths[lanes]
+    lane_contract_size = group_contract_size[lanes]
+    exposure, avg_price, realised = (group_state[lanes, column].copy() for column in range(3))
+    step = 0
+    active = len(lanes)
+    while active >= MIN_VECTOR_LANES:
+        index = lane_starts[:active] + step
+        exposure[:active], avg_price[:active], realised[:active] = apply_step(
+            exposure[:active], avg_price[:active], realised[:active], prices[index], quantities[index],
+            lane_contract_size[:active])
+        exposure_path[index], avg_path[index], realised_path[index] = exposure[:active], avg_price[:active], realised[:active]
+        step += 1
+        while active and lane_lengths[active - 1] <= step:
+            active -= 1
+
+    # long tail of a few tickers with many trades, plain python floats
+    price_list, quantity_list = prices.tolist(), quantities.tolist()
+    for lane in range(active):
+        e, a, r = float(exposure[lane]), float(avg_price[lane]), float(realised[lane])
+        size = float(lane_contract_size[lane])
+        for index in range(lane_starts[lane] + step, lane_starts[lane] + lane_lengths[lane]):
+            e, a, r = apply_trade(e, a, r, price_list[index], quantity_list[index], size)
+            exposure_path[index], avg_path[index], realised_path[index] = e, a, r
+
+    # update_stats after every trade, marked at the trade price
+    path = position_frame(np.repeat(tickers, lengths), trades["date_short"].to_numpy(),
+                          np.repeat(group_contract_size, lengths), exposure_path, prices, avg_path, realised_path)
+    # trade store rows also carry the epoch timestamp and id of the trade, used to stamp snapshots
+    if "trade_id" in trades:
+        path["last_timestamp"] = trades["timestamp"].to_numpy()
+        path["last_trade_id"] = trades["trade_id"].to_numpy()
+    return path
+
+def position_frame(ticker, timestamp, contract_size, exposure, last_price, avg_price, realised_pnl):
+    # PositionKeeper fields plus the update_stats values
+    market_value = exposure * last_price
+    return pd.DataFrame({
+        "ticker": ticker,
+        "timestamp": timestamp,
+        "contract_size": contract_size,
+        "exposure": exposure,
+        "last_price": last_price,
+        "avg_price": avg_price,
+        "market_value": market_value,
+        "realised_pnl": realised_pnl,
+        "unrealised_pnl": (market_value - exposure * avg_price) * contract_size,
+    })
+
+def final_positions(all_trades, initial = None):
+    # state after the last trade of every ticker, same fields as PositionKeeper
+    return final_rows(replay_trades(all_trades, initial))
+
+def final_rows(path):
+    last = np.r_[np.flatnonzero(path["ticker"].to_numpy()[1:] != path["ticker"].to_numpy()[:-1]), len(path) - 1]
+    return path.iloc[last].reset_index(drop=True) if len(path) else path
+
+def daily_realised(path, initial = None):
+    # [(day, ticker, realised PL)] made by the trades of a replay_trades path on each Hong Kong day, relative to the
+    # realised PL each ticker resumed from
+    initial = initial or {}
+    if len(path) == 0:
+        return []
+    tickers = path["ticker"].to_numpy()
+    realised = path["realised_pnl"].to_numpy()
+    starts = np.r_[True, tickers[1:] != tickers[:-1]]
+    previous = np.r_[0.0, realised[:-1]]
+    previous[starts] = [initial[ticker]["realised_pnl"] if ticker in initial else 0.0 for ticker in tickers[starts]]
+    days = (path["last_timestamp"].to_numpy() + UTC_OFFSET) // 86400
+    made = pd.Series(realised - previous).groupby([days, tickers], sort=False).sum()
+    return [(day, ticker, pnl) for (day, ticker), pnl in made.items() if pnl != 0]
+
+def checkpointed_positions(store):
+    # final position of every ticker in the store, resumed from the per ticker snapshots so only trades after each
+    # snapshot are read and replayed. The store drops a snapshot whenever a trade at or before it is added or removed.
+    snapshots = store.load_snapshots()
+    new_trades = store.load_since({ticker: (snapshot["last_timestamp"], snapshot["last_trade_id"])
+                                   for ticker, snapshot in snapshots.items()})
+    initial = {ticker: snapshot["state"] for ticker, snapshot in snapshots.items()}
+    path = replay_trades(new_trades, initial)
+    positions = final_rows(path)
+    if len(positions):
+        # the realised PL of the replayed trades goes into the store's daily cube with the new snapshots
+        store.save_snapshots({
+            position.ticker: (int(position.last_timestamp), int(position.last_trade_id),
+                              {field: getattr(position, field) for field in STATE_FIELDS})
+            for position in positions.itertuples(index = False)}, daily_realised(path, initial))
+
+    # tickers without new trades are served from their snapshot
+    unchanged = [state for ticker, state in initial.items() if ticker not in set(positions["ticker"])]
+    if unchanged:
+        columns = {field: np.array([state[field] for state in unchanged]) for field in STATE_FIELDS}
+        unchanged = position_frame(**{field: columns[field] for field in STATE_FIELDS})
+        positions = pd.concat([positions.drop(columns = ["last_timestamp", "last_trade_id"], errors = "ignore"),
+                               unchanged], ignore_index = True)
+    return positions.drop(columns = ["last_timestamp", "last_trade_id"], errors = "ignore")
+
+def position_info_frame(path):
+    # replay_trades rows in the PositionKeeper.get_position_info layout, rounded the same way
+    realised, unrealised = path["realised_pnl"].tolist(), path["unrealised_pnl"].tolist()
+    return pd.DataFrame({
+        "timestamp": path["timestamp"].to_numpy(),
+        "exposure": path["exposure"].to_numpy(),
+        "last_price": path["last_price"].to_numpy(),
+        "avg_price": path["avg_price"].to_numpy(),
+        "market_value": path["market_value"].to_numpy(),
+        "realised_pnl": [round(float(r), 2) for r in realised],
+        "unrealised_pnl": [round(float(u), 2) for u in unrealised],
+        "total_pnl": [round(float(r + u), 2) for r, u in zip(realised, unrealised)],
+    })
@@ -0,0 +1,214 @@
+import os
+import json
+import threading
+import time
+from datetime import datetime
+import pandas as pd
+from instrumentation import span, count
+from instruments import instrument_master
+
+# Mark to market prices for IB tickers. Tickers are resolved to price feed symbols by the instrument master first, every symbol that is not in
+# the on disk cache is then fetched in one batched request from the provider, and the result is cached per symbol and
+# date so repeated runs inside PRICE_TTL make no network calls.
+# Daily close histories for the equity curve go through the same providers and are kept per symbol with the date
+# range already fetched, so extending a series by a day only asks the provider for the new days.
+
+PRICE_TTL = 15 * 60 # seconds a price fetched today stays fresh, closes of past days never expire
+
+class YFinanceProvider:
+    # all symbols in one yf.download call
+    def latest(self, symbols):
+        import yfinance as yf
+        stock_data = yf.download(list(symbols), period="3d", auto_adjust=True, progress=False)
+        closes = stock_data["Close"]
+        if isinstance(closes, pd.Series):
+            closes = closes.to_frame(symbols[0])
+        prices = {}
+        for symbol in symbols:
+            close = closes[symbol].dropna() if symbol in closes else pd.Series(dtype=float)
+            if len(close):
+                prices[symbol] = float(close.iloc[-1])
+            else:
+                print(f"Something went wrong with finding last price for {symbol}, defaulting to open_price")
+        return prices
+
+    def history(self, symbols, start, end):
+        # daily closes from start to end inclusive ("%Y-%m-%d"), one row per date and one column per symbol
+        import yfinance as yf
+        stop = (pd.Timestamp(end) + pd.Timedelta(days=1)).strftime("%Y-%m-%d") # yfinance's end is exclusive
+        stock_data = yf.download(list(symbols), start=start, end=stop, auto_adjust=True, progress=False)
+        closes = stock_data["Close"]
+        if isinstance(closes, pd.Series):
+            closes = closes.to_frame(symbols[0])
+        closes.index = pd.DatetimeIndex(closes.index).strftime("%Y-%m-%d")
+        return closes.reindex(columns=list(symbols))
+
+
+class CsvPriceProvider:
+    # offline prices from a csv with symbol, date (%Y-%m-%d) and close columns, for tests and running without network
+    def __init__(self, path):
+        self.path = path
+        self.closes = pd.read_csv(path).sort_values(["symbol", "date"])
+
+    def latest(self, symbols):
+        latest = self.closes.groupby("symbol")["close"].last()
+        return {symbol: float(latest[symbol]) for symbol in symbols if symbol in latest.index}
+
+    def history(self, symbols, start, end):
+        closes = self.closes.loc[(self.closes["date"] >= start) & (self.closes["date"] <= end)]
+        return closes.pivot_table(index="date", columns="symbol", values="close").reindex(columns=list(symbols))
+
+
+class PriceCache:
+    # json file of "symbol|date" -> {"close", "fetched_at"}
+    def __init__(self, path, ttl = PRICE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}
+        if path is not None and os.path.isfile(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def get(self, symbol, date):
+        entry = self.entries.get(f"{symbol}|{date}")
+        if entry is None:
+            return None
+        if date == datetime.now().strftime("%Y-%m-%d") and time.time() - entry["fetched_at"] > self.ttl:
+            return None
+        return entry["close"]
+
+    def put(self, symbol, date, close):
+        self.entries[f"{symbol}|{date}"] = {"close": close, "fetched_at": time.time()}
+
+    def save(self):
+        if self.path is None:
+            return
+        # write to a temporary file first so an interrupted run can't leave a truncated cache
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.entries, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+class CloseHistory:
+    # json file of symbol -> {"from", "through", "closes": {date: close}}, every date from..through has been fetched
+    # and the dates without a close had none. Only closes before today are kept, today's can still move
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if path is not None and os.path.isfile(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def fetch_start(self, symbol, start, end):
+        # first date that has to be fetched to have start..end of symbol, None if all of it is cached. A range after
+        # the cached one is fetched from the end of the cached one so the cached dates stay contiguous
+        entry = self.entries.get(symbol)
+        if entry is None or start < entry["from"]:
+            return start
+        if entry["through"] >= end:
+            return None
+        return (pd.Timestamp(entry["through"]) + pd.Timedelta(days=1)).strftime("%Y-%m-%d")
+
+    def put(self, symbol, start, end, closes):
+        # closes is a date -> close Series fetched for start..end
+        today = datetime.now().strftime("%Y-%m-%d")
+        through = min(end, (pd.Timestamp(today) - pd.Timedelta(days=1)).strftime("%Y-%m-%d"))
+        if through < start:
+            return
+        entry = self.entries.setdefault(symbol, {"from": start, "through": through, "closes": {}})
+        if through < (pd.Timestamp(entry["from"]) - pd.Timedelta(days=1)).strftime("%Y-%m-%d"):
+            # fetched before the cached range without reaching it, the dates in between were never fetched
+            entry.update({"through": through, "closes": {}})
+        entry["closes"].update({date: float(close) for date, close in closes.items() if date < today})
+        entry["from"] = min(entry["from"], start)
+        entry["through"] = max(entry["through"], through)
+
+    def frame(self, symbols, start, end):
+        # dates x symbols of the cached closes from start to end, today's come from the last fetch
+        return pd.DataFrame({symbol: pd.Series(self.entries.get(symbol, {}).get("closes", {}), dtype=float)
+                             for symbol in symbols}).sort_index().loc[start:end]
+
+    def save(self):
+        if self.path is None:
+            return
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.entries, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+class PriceService:
+    def __init__(self, provider, cache_path = None, ttl = PRICE_TTL, history_path = None):
+        self.provider = provider
+        self.cache = PriceCache(cache_path, ttl)
+        self.history = CloseHistory(history_path)
+        self.network_calls = 0
+        self.lock = threading.Lock() # watch.py looks up prices from several threads
+
+    def get_prices(self, tickers):
+        # IB ticker -> last price (None if unresolved or missing) for many tickers with at most one provider call
+        today = datetime.now().strftime("%Y-%m-%d")
+        tickers = list(tickers)
+        feeds = instrument_master.price_feeds(tickers)
+        resolved = {}
+        for ticker, symbol, compound_factor in zip(tickers, feeds["feed_symbol"], feeds["compound_factor"]):
+            resolved[ticker] = None if symbol is None else (symbol, compound_factor)
+            if resolved[ticker] is None:
+                print(f"Future not resolved for {ticker}, not marking to market")
+        symbols = {symbol_factor[0] for symbol_factor in resolved.values() if symbol_factor is not None}
+        # one lookup at a time, so threads don't download the same symbols or write the cache file together
+        with self.lock:
+            closes = {symbol: self.cache.get(symbol, today) for symbol in symbols}
+            missing = sorted(symbol for symbol, close in closes.items() if close is None)
+            count("price_lookups", len(closes))
+            count("price_cache_hits", len(closes) - len(missing))
+            if missing:
+                self.network_calls += 1
+                count("price_calls")
+                with span("price_download"):
+                    fetched = self.provider.latest(missing)
+                for symbol, close in fetched.items():
+                    self.cache.put(symbol, today, close)
+                    closes[symbol] = close
+                self.cache.save()
+        prices = {}
+        for ticker, symbol_factor in resolved.items():
+            if symbol_factor is None or closes.get(symbol_factor[0]) is None:
+                prices[ticker] = None
+            else:
+                prices[ticker] = closes[symbol_factor[0]] * symbol_factor[1]
+        return prices
+
+    def get_price(self, ticker):
+        return self.get_prices([ticker])[ticker]
+
+    def close_history(self, tickers, start, end):
+        # daily closes of IB tickers from start to end inclusive ("%Y-%m-%d"), a DatetimeIndex of the dates with any
+        # close x tickers, NaN for no close or an unresolved ticker. Carry futures get the factor of each date.
+        # The dates not in the close history cache are fetched in one provider call
+        tickers = list(tickers)
+        feeds = instrument_master.price_feeds(tickers)
+        symbols = sorted({symbol for symbol in feeds["feed_symbol"] if symbol is not None})
+        with self.lock:
+            fetch = {symbol: self.history.fetch_start(symbol, start, end) for symbol in symbols}
+            fetch = {symbol: first for symbol, first in fetch.items() if first is not None}
+            count("close_history_lookups", len(symbols))
+            count("close_history_hits", len(symbols) - len(fetch))
+            fetched_today = {}
+            if fetch:
+                self.network_calls += 1
+                count("price_calls")
+                with span("close_history_download"):
+                    fetched = self.provider.history(sorted(fetch), min(fetch.values()), end)
+                for symbol, first in fetch.items():
+                    closes = fetched[symbol].dropna() if symbol in fetched else pd.Series(dtype=float)
+                    self.history.put(symbol, first, end, closes.loc[first:])
+                    fetched_today[symbol] = closes.loc[datetime.now().strftime("%Y-%m-%d"):]
+                self.history.save()
+            closes = self.history.frame(symbols, start, end)
+        if any(len(close) for close in fetched_today.values()):
+            closes = closes.combine_first(pd.DataFrame(fetched_today))
+        closes.index = pd.DatetimeIndex(closes.index)
+        columns = {ticker: closes[symbol] if symbol is not None else pd.Series(float("nan"), index=closes.index)
+                   for ticker, symbol in zip(tickers, feeds["feed_symbol"])}
+        frame = pd.DataFrame(columns, index=closes.index, columns=tickers)
+        return frame * instrument_master.compound_factors(tickers, frame.index)
@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+from instruments import instrument_master
+
+# Stress grid over the open positions. Every position gets a linear PL per unit of each risk factor from its exposure
+# bucket, beta and tenor in instruments.csv, and the PL of every scenario and position is one matrix product of the
+# scenarios x factors grid with the positions x factors sensitivities, so thousands of scenarios take milliseconds.
+# Equity buckets move by beta x the equity shock and the FX, gold and oil buckets by beta x their own shock (percent).
+# DV01 futures have beta = USD per bp per USD of notional and lose notional x beta for every bp their tenor's yield
+# rises, the yield move of a tenor is rates + twist x (tenor - TWIST_PIVOT) / TWIST_SPAN.
+
+FACTORS = ["equity", "rates", "twist", "usdcnh", "gold", "oil"] # equity, FX, gold and oil in %, rates and twist in bp
+BUCKET_FACTORS = {"US": "equity", "CH": "equity", "IN": "equity", "USDCNH": "usdcnh", "XAU": "gold", "CL": "oil"}
+RATES_BUCKET = "DV01"
+TWIST_PIVOT = 2 # tenor in years that only moves with rates
+TWIST_SPAN = 8 # a twist of x bp moves the TWIST_PIVOT + TWIST_SPAN year yield x bp more than the pivot (2s10s)
+DEFAULT_SHOCKS = {
+    "equity": np.linspace(-30, 10, 9),
+    "rates": np.linspace(-100, 100, 9),
+    "twist": np.linspace(-50, 50, 5),
+    "usdcnh": np.linspace(-5, 5, 5),
+    "gold": np.array([-15.0, 0.0, 15.0]),
+    "oil": np.array([-30.0, 0.0, 30.0]),
+}
+PERCENTILES = [1, 5, 50, 95]
+
+
+def scenario_grid(shocks = None):
+    # every combination of the shocks given per factor, one scenario per row, factors not given stay at 0
+    shocks = DEFAULT_SHOCKS if shocks is None else shocks
+    values = [np.asarray(shocks.get(factor, [0.0]), dtype=float) for factor in FACTORS]
+    return pd.DataFrame({factor: axis.ravel() for factor, axis in zip(FACTORS, np.meshgrid(*values, indexing="ij"))})
+
+def sensitivities(open_df):
+    # positions x FACTORS PL per unit of each factor, from the signed USD open_notional of the open summary
+    info = instrument_master.lookup(open_df["ticker"])
+    buckets = info["exposure"].to_numpy(dtype=object)
+    notional = open_df["open_notional"].to_numpy(dtype=float)
+    beta_notional = np.nan_to_num(notional * info["beta"].to_numpy(dtype=float))
+    sensitivity = np.zeros((len(open_df), len(FACTORS)))
+    for bucket, factor in BUCKET_FACTORS.items():
+        rows = buckets == bucket
+        sensitivity[rows, FACTORS.index(factor)] = beta_notional[rows] / 100
+    rates = buckets == RATES_BUCKET
+    tenor = np.nan_to_num(info["tenor"].to_numpy(dtype=float), nan=TWIST_PIVOT)
+    sensitivity[rates, FACTORS.index("rates")] = -beta_notional[rates]
+    sensitivity[rates, FACTORS.index("twist")] = -beta_notional[rates] * (tenor[rates] - TWIST_PIVOT) / TWIST_SPAN
+    return sensitivity
+
+def scenario_pnl(open_df, grid):
+    # scenarios x positions PL matrix
+    return grid[FACTORS].to_numpy(dtype=float) @ sensitivities(open_df).T
+
+def stress_test(open_df, grid = None):
+    # (scenarios, buckets): the grid with the portfolio PL of every scenario, worst first, and per exposure bucket the
+    # PL in the portfolio's worst scenario, the bucket's own worst case and PERCENTILES of its PL over the grid
+    grid = scenario_grid() if grid is None else grid
+    pnl = scenario_pnl(open_df, grid)
+    buckets = instrument_master.lookup(open_df["ticker"])["exposure"].fillna("unshocked").to_numpy(dtype=object)
+    codes, names = pd.factorize(buckets)
+    # scenarios x buckets, summed over the positions of each bucket
+    bucket_pnl = pnl @ (codes[:, None] == np.arange(len(names))[None, :])
+    total = pnl.sum(axis=1)
+    worst = int(np.argmin(total))
+    scenarios = grid.assign(total_pnl=total).sort_values("total_pnl", kind="stable").reset_index(drop=True)
+    summary = pd.DataFrame({
+        "exposure": names,
+        "components": [open_df["ticker"].to_numpy()[codes == code].tolist() for code in range(len(names))],
+        "worst_scenario_pnl": bucket_pnl[worst],
+        "worst_case_pnl": bucket_pnl.min(axis=0),
+    })
+    for percentile, values in zip(PERCENTILES, np.percentile(bucket_pnl, PERCENTILES, axis=0)):
+        summary[f"p{percentile}_pnl"] = values
+    return scenarios, summary
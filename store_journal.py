@@ -0,0 +1,234 @@
+import gzip
+import json
+import os
+import shutil
+import time
+from datetime import datetime
+
+# Write ahead journal and incremental backups of the trade store. Every insert, manual insert, reparse and day wipe is
+# appended as one json line to the open journal segment in the backups folder and fsynced before the store applies it,
+# and the store saves the record's position in the same transaction as the change. A crash in between leaves a record
+# past the saved position, which the next open_store applies, and a torn last line is cut off.
+# Backups are a gzip compressed copy of the store every SNAPSHOT_DAYS (or once the open segment passes SEGMENT_BYTES)
+# plus the segments written since, compressed once the next snapshot closes them, so a run writes its own changes
+# instead of the whole history. restore_store rebuilds the store as of any time after the oldest kept snapshot.
+# Files: snapshot_<seq>_<%Y_%m_%d_%H%M%S>.db.gz holds every record up to seq, journal_<seq>.jsonl(.gz) starts at seq.
+
+SNAPSHOT_DAYS = 7 # days between compressed snapshots of the store
+SEGMENT_BYTES = 16 * 2**20 # an open segment past this size is closed by a snapshot early, e.g. after a reparse
+KEEP_SNAPSHOTS = 12 # older snapshots and the segments before them are deleted
+JOURNAL_COLUMNS = ["timestamp", "ticker", "quantity", "price", "contract_size", "trade_type", "message_id"]
+COMPRESS_LEVEL = 6
+
+
+def encode(record):
+    # json line of a record, trades frames become column lists
+    record = dict(record)
+    if "trades" in record:
+        trades = record["trades"]
+        record["trades"] = {column: (trades[column].astype(str) if column == "ticker" else
+                                     trades[column].astype(object).where(trades[column].notna(), None)).tolist()
+                            for column in JOURNAL_COLUMNS if column in trades}
+    if "date" in record:
+        record["date"] = record["date"].strftime("%Y/%m/%d")
+    return (json.dumps(record, separators=(",", ":")) + "\n").encode()
+
+def decode(line):
+    import pandas as pd
+    record = json.loads(line)
+    if "trades" in record:
+        record["trades"] = pd.DataFrame(record["trades"])
+    if "date" in record:
+        record["date"] = datetime.strptime(record["date"], "%Y/%m/%d")
+    return record
+
+def read_lines(path, offset = 0):
+    # (record line, end offset) of every complete line from offset, a .gz segment is read whole
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as f:
+            data = f.read()
+    else:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+    end = offset
+    for line in data.splitlines(keepends=True):
+        if not line.endswith(b"\n"):
+            # torn write of the last record
+            break
+        end += len(line)
+        yield line, end
+
+def compress_file(source, destination):
+    # gzip source to destination, complete or not at all
+    with open(source, "rb") as f, gzip.open(destination + ".tmp", "wb", compresslevel=COMPRESS_LEVEL) as out:
+        shutil.copyfileobj(f, out, 2**20)
+    with open(destination + ".tmp", "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(destination + ".tmp", destination)
+
+
+class Journal:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.position = None # {"seq", "segment", "offset"} of the last record the store applied
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def snapshots(self):
+        # [(seq, datetime, name)] oldest first
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if name.startswith("snapshot_") and name.endswith(".db.gz"):
+                seq, taken = name[len("snapshot_"):-len(".db.gz")].split("_", 1)
+                snapshots.append((int(seq), datetime.strptime(taken, "%Y_%m_%d_%H%M%S"), name))
+        return sorted(snapshots)
+
+    def segments(self):
+        # [(first seq, name)] oldest first, the open segment is the one without .gz
+        segments = {}
+        for name in os.listdir(self.directory):
+            if name.startswith("journal_") and name.endswith((".jsonl", ".jsonl.gz")):
+                first = int(name[len("journal_"):].split(".")[0])
+                # a segment compressed by a snapshot that crashed before removing the plain file
+                if name.endswith(".jsonl") and os.path.isfile(self.path(name + ".gz")):
+                    os.remove(self.path(name))
+                    continue
+                segments[first] = name
+        return sorted(segments.items())
+
+    def open_segment(self):
+        segments = self.segments()
+        return segments[-1][1] if segments and not segments[-1][1].endswith(".gz") else None
+
+    def last_seq(self):
+        # the highest seq written to the journal or covered by a snapshot
+        last = max((seq for seq, _, _ in self.snapshots()), default=0)
+        segment = self.open_segment()
+        if segment is not None:
+            for line, _ in read_lines(self.path(segment)):
+                last = max(last, json.loads(line)["seq"])
+        return last
+
+    def attach(self, store):
+        # picks up where the store left off: applies the records written after its position, or starts the journal
+        # with a snapshot when the store has never been journaled (a new store, one from before the journal or a
+        # restored copy). Returns the number of applied records
+        self.position = store.get_meta("journal")
+        if self.position is None:
+            self.snapshot(store, self.last_seq())
+            return 0
+        segment = self.open_segment()
+        if segment is None:
+            return 0
+        size = os.path.getsize(self.path(segment))
+        offset = self.position["offset"] if segment == self.position["segment"] else 0
+        if offset == size:
+            return 0
+        applied, end = 0, offset
+        for line, end in read_lines(self.path(segment), offset):
+            record = decode(line)
+            if record["seq"] > self.position["seq"]:
+                store.commit(record, {"seq": record["seq"], "segment": segment, "offset": end})
+                applied += 1
+        if end < size:
+            with open(self.path(segment), "r+b") as f:
+                f.truncate(end)
+        if applied:
+            print(f"applied {applied} journal records the trade store was missing")
+        return applied
+
+    def write(self, record):
+        # appends record with the next seq and returns the position the store saves once it has applied it
+        seq = self.position["seq"] + 1
+        segment = self.open_segment() or f"journal_{seq:010d}.jsonl"
+        record = {"seq": seq, "time": time.time(), **record}
+        with open(self.path(segment), "ab") as f:
+            f.write(encode(record))
+            f.flush()
+            os.fsync(f.fileno())
+            return {"seq": seq, "segment": segment, "offset": f.tell()}
+
+    def discard(self, position):
+        # drops the record at position after the store failed to apply it, it starts where the last applied one ended
+        with open(self.path(position["segment"]), "r+b") as f:
+            f.truncate(self.position["offset"] if self.position["segment"] == position["segment"] else 0)
+
+    def snapshot_due(self):
+        snapshots = self.snapshots()
+        segment = self.open_segment()
+        return (not snapshots or (datetime.now() - snapshots[-1][1]).days >= SNAPSHOT_DAYS or
+                (segment is not None and os.path.getsize(self.path(segment)) > SEGMENT_BYTES))
+
+    def snapshot(self, store, seq = None):
+        # compressed copy of the store as of seq (its position by default), closes the open segment and prunes
+        seq = self.position["seq"] if seq is None else seq
+        copy = self.path("snapshot.db.tmp")
+        store.backup(copy)
+        name = f"snapshot_{seq:010d}_{datetime.now().strftime('%Y_%m_%d_%H%M%S')}.db.gz"
+        compress_file(copy, self.path(name))
+        os.remove(copy)
+        segment = self.open_segment()
+        if segment is not None:
+            compress_file(self.path(segment), self.path(segment + ".gz"))
+            os.remove(self.path(segment))
+        if self.position is None or self.position["seq"] != seq:
+            # a store starting on the journal, its records begin after the snapshot
+            self.position = {"seq": seq, "segment": None, "offset": 0}
+            store.set_meta("journal", self.position)
+        self.prune()
+        return name
+
+    def prune(self):
+        snapshots = self.snapshots()
+        if len(snapshots) <= KEEP_SNAPSHOTS:
+            return
+        oldest = snapshots[-KEEP_SNAPSHOTS][0]
+        for _, _, name in snapshots[:-KEEP_SNAPSHOTS]:
+            os.remove(self.path(name))
+        # segments are closed by snapshots, so one starting at or before the oldest kept snapshot ends before it
+        for first, name in self.segments():
+            if first <= oldest:
+                os.remove(self.path(name))
+
+    def records(self, after_seq):
+        # decoded records with a seq above after_seq, oldest first
+        segments = self.segments()
+        for index, (first, name) in enumerate(segments):
+            # every record of this segment comes before the next one starts
+            if index + 1 < len(segments) and segments[index + 1][0] <= after_seq + 1:
+                continue
+            for line, _ in read_lines(self.path(name)):
+                record = decode(line)
+                if record["seq"] > after_seq:
+                    yield record
+
+
+def restore_store(directory, path, at = None):
+    # writes the trade store as of the datetime at (the latest journal record by default) to path: the newest
+    # snapshot taken at or before it plus the journal records up to it. The copy starts a new journal history when it
+    # is opened in place of trades.db, so the records after at are not applied to it again
+    from trade_store import SqliteTradeStore
+    journal = Journal(directory)
+    snapshots = [snapshot for snapshot in journal.snapshots() if at is None or snapshot[1] <= at]
+    if not snapshots:
+        raise ValueError(f"no snapshot in {directory} was taken before {at}")
+    seq, taken, name = snapshots[-1]
+    with gzip.open(journal.path(name), "rb") as f, open(path + ".tmp", "wb") as out:
+        shutil.copyfileobj(f, out, 2**20)
+    store = SqliteTradeStore(path + ".tmp")
+    applied = 0
+    try:
+        for record in journal.records(seq):
+            if at is not None and record["time"] > at.timestamp():
+                break
+            store.commit(record, None)
+            applied += 1
+        store.set_meta("journal", None)
+    finally:
+        store.close()
+    os.replace(path + ".tmp", path)
+    print(f"restored {path} from the snapshot of {taken:%Y/%m/%d %H:%M:%S} and {applied} journal records")
+    return applied
@@ -0,0 +1,16 @@
+import os
+import sys
+import tempfile
+import types
+
+# the modules are at the root of the repository, the tests never use the real mailbox or export folder so
+# credentials.py is replaced by the values of credentials_template.py with a scratch export folder
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import credentials_template
+credentials = types.ModuleType("credentials")
+credentials.__dict__.update({name: value for name, value in vars(credentials_template).items()
+                             if not name.startswith("__")})
+credentials.export_folder = tempfile.mkdtemp(prefix="trade_review_tests")
+sys.modules["credentials"] = credentials
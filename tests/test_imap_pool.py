@@ -0,0 +1,64 @@
+from datetime import datetime
+from functools import partial
+import pandas as pd
+import pytest
+from fake_imap import FakeImapServer, synthetic_mailbox
+from trade_counter import connect_imap
+from imap_pool import parallel_fetch
+from ingest import fetch_trades
+
+# parallel_fetch against fake_imap.py: small shards so a few hundred messages are split over several connections
+
+MESSAGES = 300
+SHARD_SIZE = 40
+POOL_SIZE = 3
+
+
+@pytest.fixture
+def server():
+    server = FakeImapServer(synthetic_mailbox(MESSAGES, seed=5)).start()
+    yield server
+    server.stop()
+
+def connector(server):
+    return partial(connect_imap, "127.0.0.1", "test", "test", port=server.port, ssl=False)
+
+def fetched_trades(server, parallel):
+    batches, sync_state = fetch_trades(datetime(2023, 1, 1), connect=connector(server), batch_size=100,
+                                       parallel=parallel, pool_size=POOL_SIZE, shard_size=SHARD_SIZE)
+    return pd.concat(list(batches), ignore_index=True), sync_state
+
+def assert_newest_first(decoded):
+    keys = [(date_long, uid) for uid, date_long, subject, message_id in decoded]
+    assert keys == sorted(keys, reverse=True)
+
+def test_parallel_matches_serial(server):
+    serial, serial_state = fetched_trades(server, parallel=False)
+    parallel, parallel_state = fetched_trades(server, parallel=True)
+    assert len(serial) > 0
+    assert serial_state == parallel_state
+    pd.testing.assert_frame_equal(serial, parallel)
+
+def test_parallel_fetch_order(server):
+    uids = [str(uid) for uid in server.mailbox.uids]
+    decoded = parallel_fetch(uids, connector(server), POOL_SIZE, SHARD_SIZE, chunk_size=15)
+    assert sorted(uid for uid, *_ in decoded) == [int(uid) for uid in uids]
+    assert_newest_first(decoded)
+
+def test_retried_shard(server):
+    # the first fetches close their connection, the shards reconnect and fetch again
+    uids = [str(uid) for uid in server.mailbox.uids]
+    server.drop_fetches = 2
+    decoded = parallel_fetch(uids, connector(server), POOL_SIZE, SHARD_SIZE)
+    assert server.drop_fetches == 0
+    assert sorted(uid for uid, *_ in decoded) == [int(uid) for uid in uids]
+    assert_newest_first(decoded)
+
+def test_expunged_shard(server):
+    # a whole shard and part of another are deleted between the SEARCH and the FETCH, only they are left out
+    uids = [str(uid) for uid in server.mailbox.uids]
+    expunged = set(range(SHARD_SIZE + 1, 2 * SHARD_SIZE + 1)) | {5, 7}
+    server.expunge(expunged)
+    decoded = parallel_fetch(uids, connector(server), POOL_SIZE, SHARD_SIZE)
+    assert sorted(uid for uid, *_ in decoded) == [int(uid) for uid in uids if int(uid) not in expunged]
+    assert_newest_first(decoded)
@@ -0,0 +1,40 @@
+from bench_pnl_engine import synthetic_trades, reference_replay, FIELDS
+from pnl_engine import replay_trades, final_positions, MIN_VECTOR_LANES
+
+# pnl_engine has to match the PositionKeeper loop exactly, on the numpy steps taken while at least MIN_VECTOR_LANES
+# tickers are active and on the one by one tail of the tickers with the most trades
+
+
+def replayed(all_trades):
+    # (PositionKeeper path, pnl_engine path), both ordered by ticker then trade
+    expected = reference_replay(all_trades).sort_values("ticker", kind="stable").reset_index(drop=True)
+    path = replay_trades(all_trades).sort_values("ticker", kind="stable").reset_index(drop=True)
+    return expected, path
+
+def assert_same_path(expected, path):
+    assert expected["ticker"].tolist() == path["ticker"].tolist()
+    for field in FIELDS:
+        # exact, the engine does the same float operations in the same order
+        mismatches = (expected[field].to_numpy(dtype=float) != path[field].to_numpy(dtype=float)).sum()
+        assert mismatches == 0, f"{mismatches} {field} values differ from PositionKeeper"
+
+def test_vector_lanes_and_tail_match_position_keeper():
+    # skewed popularity over more tickers than MIN_VECTOR_LANES: the rare tickers finish inside the numpy steps,
+    # the popular ones continue in the tail
+    all_trades = synthetic_trades(5000, tickers=2 * MIN_VECTOR_LANES, seed=3)
+    trades_per_ticker = all_trades["ticker"].value_counts()
+    assert trades_per_ticker.min() < MIN_VECTOR_LANES < trades_per_ticker.max()
+    assert_same_path(*replayed(all_trades))
+
+def test_few_tickers_match_position_keeper():
+    # fewer tickers than MIN_VECTOR_LANES, everything is replayed one by one
+    all_trades = synthetic_trades(2000, tickers=5, seed=1)
+    assert_same_path(*replayed(all_trades))
+
+def test_final_positions_match_position_keeper():
+    all_trades = synthetic_trades(5000, tickers=2 * MIN_VECTOR_LANES, seed=4)
+    expected = reference_replay(all_trades).groupby("ticker", sort=True).last()
+    final = final_positions(all_trades).set_index("ticker").sort_index()
+    assert expected.index.tolist() == final.index.tolist()
+    for field in ["exposure", "realised_pnl", "unrealised_pnl"]:
+        assert (expected[field].to_numpy(dtype=float) == final[field].to_numpy(dtype=float)).all(), field
@@ -1,47 +1,149 @@
 import imaplib
 import email
-from datetime import datetime
+import re
+import time
+from datetime import datetime, timedelta
 import pytz
 import calendar
 from credentials import imap_host, imap_user, imap_pass
+from instrumentation import span, timed, count
 
-def connect_imap():
-    # connect to host using SSL
-    imap = imaplib.IMAP4_SSL(imap_host)
+# number of messages requested per FETCH command, one round trip per chunk instead of one per message
+FETCH_CHUNK_SIZE = 500
+# only the headers we parse are downloaded, PEEK so the confirmations are not flagged as read
+HEADER_FETCH = "(BODY.PEEK[HEADER.FIELDS (DATE SUBJECT MESSAGE-ID)])"
+# whole confirmations, for a mail cache that should keep the message bodies too
+MESSAGE_FETCH = "(BODY.PEEK[])"
+# confirmations are searched FROM this sender
+SENDER = "IB Trading Assistant"
+
+def connect_imap(host = imap_host, user = imap_user, password = imap_pass, port = None, ssl = True):
+    # connect to host using SSL, ssl = False for a local server such as fake_imap
+    if ssl:
+        imap = imaplib.IMAP4_SSL(host, port or imaplib.IMAP4_SSL_PORT)
+    else:
+        imap = imaplib.IMAP4(host, port or imaplib.IMAP4_PORT)
     ## login to server
-    imap.login(imap_user, imap_pass)
+    imap.login(user, password)
     return imap
 
-def count_trades():
+def message_set(id_list):
+    # compress a list of message ids into an imap message set, e.g. [1,2,3,7] -> "1:3,7"
+    ids = sorted(int(id) for id in id_list)
+    ranges = []
+    start = last = ids[0]
+    for id in ids[1:]:
+        if id != last + 1:
+            ranges.append(f"{start}:{last}" if start != last else f"{start}")
+            start = id
+        last = id
+    ranges.append(f"{start}:{last}" if start != last else f"{start}")
+    return ",".join(ranges)
+
+def fetch_headers(imap, id_list, chunk_size = FETCH_CHUNK_SIZE, uid = False, report = True, raw = False,
+                  items = HEADER_FETCH):
+    # fetch the DATE, SUBJECT and MESSAGE-ID headers for id_list in chunks of chunk_size messages per FETCH command
+    # yields (id, message) in the order of id_list so newest first lists can still stop early at a start date
+    # with uid = True the ids are imap UIDs and UID FETCH is used, report prints the fetch rate at the end
+    # raw = True yields the fetched bytes instead of a parsed message, items = MESSAGE_FETCH fetches whole messages
+    fetched, start_time = 0, time.perf_counter()
+    try:
+        for i in range(0, len(id_list), chunk_size):
+            chunk = id_list[i:i + chunk_size]
+            with span("fetch_chunk"):
+                if uid:
+                    result, data = imap.uid('fetch', message_set(chunk), items)
+                else:
+                    result, data = imap.fetch(message_set(chunk), items)
+            count("messages_fetched", len(chunk))
+            count("bytes_downloaded", sum(len(item[1]) for item in data if isinstance(item, tuple)))
+            headers = {}
+            for index, item in enumerate(data):
+                # the server answers with (b'<id> (UID <uid> BODY[...] {size}', b'<header bytes>') tuples and b')' separators
+                if not isinstance(item, tuple):
+                    continue
+                if uid:
+                    # the UID item can come before or after the header literal
+                    trailer = data[index + 1] if index + 1 < len(data) and isinstance(data[index + 1], bytes) else b""
+                    key = int((re.search(rb"UID (\d+)", item[0]) or re.search(rb"UID (\d+)", trailer)).group(1))
+                else:
+                    key = int(re.match(rb"\d+", item[0]).group())
+                headers[key] = item[1] if raw else email.message_from_bytes(item[1])
+            # a message expunged between the SEARCH and the FETCH is left out of the answer
+            missing = [id for id in chunk if int(id) not in headers]
+            if missing:
+                count("messages_missing", len(missing))
+                print(f"skipped {len(missing)} messages the server no longer has: {' '.join(str(int(id)) for id in missing)}")
+            for id in chunk:
+                if int(id) in headers:
+                    fetched += 1
+                    yield id, headers[int(id)]
+    finally:
+        elapsed = time.perf_counter() - start_time
+        if fetched and report:
+            print(f"fetched {fetched} message headers in {elapsed:.1f}s ({fetched / max(elapsed, 1e-9):.0f} messages/s)")
+
+def get_uidvalidity(imap, mailbox = 'Inbox'):
+    # UIDVALIDITY of the selected mailbox, UIDs are only comparable between runs while it stays the same
+    result, data = imap.response('UIDVALIDITY')
+    if data[0] is None:
+        result, data = imap.status(mailbox, '(UIDVALIDITY)')
+        return int(re.search(rb"UIDVALIDITY (\d+)", data[0]).group(1))
+    return int(data[-1])
+
+def parse_header(msg):
+    # remove the english of timezone to input into timezone aware datetime object
+    new_msg = " ".join(msg['Date'].split(" ")[:-1])
+    date_long = datetime.strptime(new_msg, "%a, %d %b %Y %H:%M:%S %z")
+    date_long = date_long.astimezone(pytz.timezone("Asia/Hong_Kong"))
+    subject = str(email.header.make_header(email.header.decode_header(msg['Subject'])))
+    return date_long, subject
+
+@timed
+def count_trades(store = None, start_date = None, end_date = None, by = None, chunk_size = FETCH_CHUNK_SIZE,
+                 connect = connect_imap):
+    # unique orders and fills from start_date to end_date (default the current month) out of the order index of the
+    # trade store, by = "ticker" or "day" breaks them down. Without a store the mailbox is scanned like before
+    if store is None:
+        return scan_trades(chunk_size, connect)
+    if start_date is None:
+        start_date = datetime(datetime.now().year, datetime.now().month, 1)
+        period = f"{calendar.month_name[start_date.month]} {start_date.year}"
+    else:
+        period = f"{start_date:%Y/%m/%d} to {(end_date or datetime.now()):%Y/%m/%d}"
+    counts = store.count_orders(start_date, end_date, by)
+    if by is not None:
+        print(f"{by:<24}{'orders':>8}{'fills':>8}")
+        for key, orders, fills in counts:
+            print(f"{key:<24}{orders:>8}{fills:>8}")
+    # the totals come from the whole range, a split by ticker can count an order on two futures expiries twice
+    key, unique_trades, num_trades = counts[0] if by is None else store.count_orders(start_date, end_date)[0]
+    trade = "trade" if (num_trades - unique_trades) == 1 else "trades"
+    print(f"There are {unique_trades} unique trades found in {period}."
+          f"\n{num_trades - unique_trades} {trade} have been filtered out.")
+    return counts
+
+def scan_trades(chunk_size = FETCH_CHUNK_SIZE, connect = connect_imap):
     # look for trades After current month
     current_month = datetime.now().month
     current_year = datetime.now().year
 
-    imap = connect_imap()
+    imap = connect()
     imap.select('Inbox')
-    result, data = imap.search(None, 'FROM "IB Trading Assistant"' )
+    # the server only returns this month's messages (a day of slack for timezones), the loop below still checks the month
+    since = (datetime(current_year, current_month, 1) - timedelta(days=1)).strftime("%d-%b-%Y")
+    result, data = imap.search(None, f'FROM "{SENDER}" SINCE {since}')
 
     # fetch trades for the current month
     id_list = data[0].split()
     id_list.reverse()
     num_trades,unique_trades = 0, 0
     last_price, last_ticker, last_date = 0, 0, 0
-    for id in id_list:
-        result, data = imap.fetch(id, '(RFC822)')
-        raw_email = data[0][1]                                 # Returns a byte
-        msg = email.message_from_string(data[0][1].decode('utf-8'))
-
-        # remove the english of timezone to input into timezone aware datetime object
-        new_msg = " ".join(msg['Date'].split(" ")[:-1])
-        date_long = datetime.strptime(new_msg, "%a, %d %b %Y %H:%M:%S %z")
-        date_long = date_long.astimezone(pytz.timezone("Asia/Hong_Kong"))
+    for id, msg in fetch_headers(imap, id_list, chunk_size):
+        date_long, subject = parse_header(msg)
 
         # get this month's trades
-        subject = str(email.header.make_header(email.header.decode_header(msg['Subject'])))
         if (date_long.month < current_month) | (date_long.year <current_year) :
-            trade = "trade" if (num_trades - unique_trades) == 1 else "trades"
-            print(f"There are {unique_trades} unique trades found in {calendar.month_name[current_month]} {current_year}."
-                  f"\n{num_trades - unique_trades} {trade} have been filtered out.")
             break
         print(date_long, subject)
         subject_split = subject.split()
@@ -50,5 +152,8 @@ def count_trades():
             unique_trades+=1
         last_price,last_ticker, last_date = float(subject_split[subject_split.index("@") + 1]), subject_split[2], date_long.date()
         num_trades+=1
+    trade = "trade" if (num_trades - unique_trades) == 1 else "trades"
+    print(f"There are {unique_trades} unique trades found in {calendar.month_name[current_month]} {current_year}."
+          f"\n{num_trades - unique_trades} {trade} have been filtered out.")
 if __name__ in "__main__":
-    count_trades()
\ No newline at end of file
+    count_trades()
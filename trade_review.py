@@ -7,20 +7,43 @@ import numpy as np
 import os
 from trade_counter import connect_imap, count_trades
 from credentials import export_folder
-import yfinance as yf
-pd.options.mode.chained_assignment = None  # default='warn'
-pd.set_option('display.max_rows', 500)
-pd.set_option('display.max_columns', None)  # Show all columns
-pd.set_option('display.width', 1000)  # Increase width to fit your screen
-pd.set_option('display.expand_frame_repr', False)  # Prevent wrapping
-pd.set_option('display.max_colwidth', None)  # Show full content of each column
+from trade_store import open_store, from_date_short
+from trade_table import load_table
+from mail_cache import MailCache, cache_name
+from ingest import (decode_messages, parse_subjects, normalize_trades, trade_frame, store_trades, save_trades,
+                    backup_store, resume_point, account_label, load_sources, ingest_sources, START_DATE, EXPORT_CSV,
+                    MAIL_CACHE)
+from price_service import PriceService, YFinanceProvider, CsvPriceProvider, PRICE_TTL
+from instruments import instrument_master
+from pnl_engine import replay_trades, final_positions, checkpointed_positions, position_info_frame, STATE_FIELDS
+from equity_curve import update_curve
+from scenarios import stress_test, PERCENTILES
+import instrumentation
+from instrumentation import span, timed, timed_iter, count
 
 
 # Set Variables
 
-START_DATE = datetime(2023, 1, 1)
+# START_DATE and the other ingestion settings are in ingest.py
 MIN_SCALP = 100
 EXCLUSION_LIST = ["USD.HKD", "AUD.USD", "EUR.USD", "USD.CNH"]
+PRICE_FIXTURE = None # csv of symbol,date,close to mark to market offline instead of yfinance
+PROFILE = None # "cpu" (cProfile) or "memory" (tracemalloc) to add a profile to run_report.json
+EQUITY_CURVE = True # extend the daily equity_curve.csv and ticker_pnl.csv with the days since the last run
+
+
+price_service = PriceService(CsvPriceProvider(PRICE_FIXTURE) if PRICE_FIXTURE else YFinanceProvider(),
+                             export_folder + r"\price_cache.json", history_path = export_folder + r"\close_history.json")
+
+
+def display_options():
+    # called by the entry points (trade_review, cli, watch) rather than on import
+    pd.options.mode.chained_assignment = None  # default='warn'
+    pd.set_option('display.max_rows', 500)
+    pd.set_option('display.max_columns', None)  # Show all columns
+    pd.set_option('display.width', 1000)  # Increase width to fit your screen
+    pd.set_option('display.expand_frame_repr', False)  # Prevent wrapping
+    pd.set_option('display.max_colwidth', None)  # Show full content of each column
 
 
 # Todo
@@ -33,6 +56,10 @@ class PositionKeeper:
     # Can also mark to market
     # Can be changed to manage exchange dual listings through adding a self.position dictionary variable
     # pnl includes contract size but exposure and market value is in contract units
+    # slots keep the one instance per ticker small and its attribute access fast
+    __slots__ = ("ticker", "contract_size", "exposure", "last_price", "avg_price", "market_value", "realised_pnl",
+                 "unrealised_pnl", "timestamp")
+
     def __init__(self, ticker, contract_size):
         self.ticker = ticker # name of symbol
         self.contract_size = contract_size # contract size
@@ -96,13 +123,34 @@ class PositionKeeper:
                 self.exposure += quantity
                 self.avg_price = price
 
+    @classmethod
+    def restore(cls, ticker, contract_size, exposure, avg_price, last_price, realised_pnl, timestamp):
+        # rebuild a PositionKeeper from an already replayed state (e.g. pnl_engine) without adding every trade again
+        position = cls(ticker, contract_size)
+        position.exposure = exposure
+        position.avg_price = avg_price
+        position.last_price = last_price
+        position.realised_pnl = realised_pnl
+        position.timestamp = timestamp
+        position.update_stats()
+        return position
+
+    def to_dict(self):
+        # serializable state, everything else is recomputed by update_stats
+        return {field: getattr(self, field) for field in STATE_FIELDS}
+
+    @classmethod
+    def from_dict(cls, state):
+        return cls.restore(**state)
+
     def update_stats(self):
         self.market_value = self.exposure * self.last_price
         self.unrealised_pnl = (self.market_value - self.exposure * self.avg_price) * self.contract_size
 
-    def mark_to_market(self):
-        # mark to market for open position otherwise do nth
-        market_price = get_last_price(self.ticker)
+    def mark_to_market(self, market_price = None):
+        # mark to market for open position otherwise do nth, market_price can be passed in when prices were batch fetched
+        if market_price is None:
+            market_price = get_last_price(self.ticker)
         # all the error handling is done in get_last_price so it just returns None if error
         if market_price is not None:
             self.last_price = market_price
@@ -121,128 +169,150 @@ class PositionKeeper:
             "total_pnl": round(float(self.realised_pnl + self.unrealised_pnl),2)
         }
 
-def store_trades(start_date = START_DATE, all_trades = None, file_location = None):
-    if file_location is None:
-        print("No file location")
-        return "0"
-    currency_table = {
-        "EURUSD" : 1.09,
-        "USDCNH" : 7.23,
-    }
-    contract_size_table = {
-        "ZT": 2000,
-        "ZF": 1000,
-        "ZN": 1000,
-        "TN": 1000,
-        "ZB": 1000,
-        "UB": 1000,
-        "MES" : 5,
-        "M2K" : 5,
-        "MNQ" : 2,
-        "SOFR3" : 2500,
-        "GBS" : 1000*currency_table["EURUSD"],
-        "UC" : 100000/currency_table["USDCNH"],
-        "CL" : 1000,
-    }
-    imap = connect_imap()
-    imap.select('Inbox')
-    result, data = imap.search(None, 'FROM "IB Trading Assistant"' )
-    #fetch all trades on the account, store in a csv, and on reruns of the script, just append to the csv instead of recreating the database
-
-    id_list = data[0].split()
-    id_list.reverse()
-    for id in id_list:
-        result, data = imap.fetch(id, '(RFC822)')
-        msg = email.message_from_string(data[0][1].decode('utf-8'))
-
-
-        # remove the english of timezone to input into timezone aware datetime object
-        new_msg = " ".join(msg['Date'].split(" ")[:-1])
-        date_long = datetime.strptime(new_msg, "%a, %d %b %Y %H:%M:%S %z")
-        date_long = date_long.astimezone(pytz.timezone("Asia/Hong_Kong"))
-
-        subject = str(email.header.make_header(email.header.decode_header(msg['Subject'])))
-        if datetime(date_long.year, date_long.month, date_long.day) < start_date:
-            break
-        # create the trade item
-        print(date_long, subject)
-        subject_split = subject.split()
-        quantity = round((1 if subject_split[0] == "BOUGHT" else -1) * float(subject_split[1].replace(",","")),0)
-        ticker = ''
-        for x in range(2, subject_split.index("@")):
-            ticker += subject_split[x] + " "
-        ticker = ticker[:-1]
-        if ticker.split()[0] in contract_size_table:
-            contract_size = contract_size_table[ticker.split()[0]]
-        else:
-            contract_size = 1
-        trade = pd.DataFrame({
-            "date_short": [date_long.strftime("%Y/%m/%d")],
-            "ticker": [ticker],
-            "quantity": [quantity],
-            "price": [float(subject_split[subject_split.index("@") + 1])],
-            "contract_size" : [contract_size],
-            "trade_type": "AUTO",
-        })
-
-        if all_trades is None:
-            all_trades = trade
-        else:
-            all_trades = pd.concat([trade,all_trades], ignore_index = True)
-    all_trades["temp"] = [datetime.strptime(date, "%Y/%m/%d") for date in all_trades.date_short]
-    all_trades = all_trades.sort_values(by=["temp"], ascending=False, ignore_index=True)
-    all_trades = all_trades.drop(columns = ["temp"])
-
-    all_trades.to_csv(file_location + r"\all_trades.csv", index = False)
-    all_trades.to_csv(file_location + r"\backups\all_trades"+f"{datetime.now().strftime("%Y_%m_%d")}"+ ".csv", index=False)
-    return all_trades
-
-def find_trades(file_location):
-    if os.path.isfile(file_location+r"\all_trades.csv"):
-        all_trades = pd.read_csv(file_location+r"\all_trades.csv")
-        last_trade_date = datetime.strptime(all_trades.date_short.iloc[0],"%Y/%m/%d")
-        num_trades = len(all_trades)
-        print(f"trade database found with {num_trades} trades up to {last_trade_date}\n"
+@timed
+def find_trades(store, file_location, connect = connect_imap, accounts = None):
+    # with accounts in credentials.py every source (or only those of accounts) is ingested in its own process, see
+    # ingest.py, otherwise the imap_host mailbox through connect. Returns the trades of every account
+    sources = load_sources(accounts)
+    if [source["account"] for source in sources] != [""]:
+        ingest_sources(store, file_location, sources)
+        with span("load"):
+            return load_table(store.portfolio(), file_location).frame()
+    cache = MailCache(file_location) if MAIL_CACHE else None
+    try:
+        return find_new_trades(store, file_location, connect, cache)
+    finally:
+        if cache is not None:
+            cache.close()
+
+def find_new_trades(store, file_location, connect, cache):
+    start_date = resume_point(store)
+    if start_date is not None:
+        print(f"trade database found with {store.count()} trades up to {store.last_trade_date()}\n"
               f"Checking for new trades")
-
-        all_trades = store_trades(last_trade_date+timedelta(days=1), all_trades, file_location)
-        print(f"found {len(all_trades)-num_trades} new trades")
+        new_trades = store_trades(start_date, store, sync_state = store.get_meta("sync_state"), connect = connect,
+                                  cache = cache)
+        print(f"found {new_trades} new trades")
     else:
         print("no trades found, creating database")
-        all_trades = store_trades(all_trades = None,file_location = file_location)
-        print(f"{len(all_trades)} new trades have been added to the trade database")
-    return all_trades
+        new_trades = store_trades(store = store, parallel = True, connect = connect, cache = cache)
+        print(f"{new_trades} new trades have been added to the trade database")
+    if new_trades:
+        save_trades(store, file_location)
+    with span("load"):
+        # compact memory mapped copy of the store, see trade_table
+        return load_table(store.portfolio(), file_location).frame()
+
+@timed
+def reparse_trades(store, file_location, start_date = START_DATE):
+    # rebuild the AUTO trades of every account from its mail cache without contacting IMAP, e.g. after changing
+    # parse_subjects. Trades of messages that aren't in the cache (ingested before it existed, manual trades) are kept
+    # as they are
+    new_trades = 0
+    for view in store.portfolio().account_views():
+        if view.account and not os.path.isfile(file_location + "\\" + cache_name(view.account) + ".db"):
+            print(f"account {account_label(view.account)} has no mail cache, its trades are kept as they are")
+            continue
+        new_trades += reparse_account(view, file_location, start_date)
+    save_trades(store, file_location)
+    return new_trades
+
+def reparse_account(store, file_location, start_date = START_DATE):
+    # reparse_trades of one account view
+    cache = MailCache(file_location, cache_name(store.account))
+    try:
+        messages = timed_iter("read", cache.messages())
+        decoded = timed_iter("decode", decode_messages(messages, start_date, verbose = False))
+        parsed = timed_iter("parse", parse_subjects(decoded))
+        records = list(timed_iter("normalize", normalize_trades(parsed)))
+        count("trades_parsed", len(records))
+        trades_before = store.count()
+        with span("replace"):
+            new_trades = store.replace_trades(cache.message_ids(), trade_frame(records))
+        stats = cache.stats()
+    finally:
+        cache.close()
+    with span("index_orders"):
+        store.index_orders()
+    print(f"reparsed {stats['messages']} cached messages ({stats['pack_bytes'] / 2**20:.1f} MB packed, "
+          f"{stats['raw_bytes'] / 2**20:.1f} MB raw) into {new_trades} trades")
+    if store.count() != trades_before:
+        # a reparse only rewrites trades, more or fewer of them means the parser or the store dropped or doubled some
+        print(f"the trade store went from {trades_before} to {store.count()} trades, check the reparsed trades")
+    return new_trades
 
 # need to add a way for my script to differentiate between closed positions and open positions, in chronological order
-def analyse_trades(all_trades = None):
-    tickers = all_trades.ticker.unique()
-    tickers = [ticker for ticker in tickers if ticker not in EXCLUSION_LIST]
-    all_tickers, open_pnl, close_pnl, open_quantity, open_price, open_notional, last_price, last_date = [],[],[],[],[],[],[],[]
-    for ticker in tickers:
-        ticker_trades = all_trades.loc[all_trades.ticker == ticker].iloc[::-1].reset_index(drop=True)
-        contract_size = ticker_trades.loc[0, "contract_size"]
-
-        # create PositionKeeper class to compute unrealised/realised PL per trade
-        ticker_position = PositionKeeper(ticker, contract_size)
-        for index, row in ticker_trades.iterrows():
-            # input each trade into PositionKeeper line by line
-            ticker_position.add_trade(row.date_short, row.price, row.quantity)
-            # recompute unrealised and realised pnl based on market value
-            ticker_position.update_stats()
+@timed
+def analyse_trades(all_trades = None, store = None, file_location = export_folder):
+    with span("positions"):
+        if store is not None:
+            # resume each ticker from its checkpoint in the trade store, only trades since the last run are replayed
+            positions = checkpointed_positions(store)
+        else:
+            # every ticker is replayed in one grouped pass, see pnl_engine
+            positions = final_positions(all_trades)
+    report_summary(marked_summary(positions), file_location)
+    return
+
+@timed
+def analyse_accounts(store, file_location = export_folder, accounts = None):
+    # analyse_trades per account into all_summary_<account>.csv and open_summary_<account>.csv, and for the whole store
+    # or more than one account the consolidated all_summary.csv and open_summary.csv. Every account resumes from its own
+    # position snapshots, so an account without new trades is not replayed, and the prices are fetched once for all
+    consolidated = accounts is None or len(accounts) > 1
+    accounts = store.accounts() if accounts is None else accounts
+    with span("positions"):
+        positions = {}
+        for account in accounts:
+            account_positions = checkpointed_positions(store.view(account))
+            positions[account] = account_positions.loc[~account_positions.ticker.isin(EXCLUSION_LIST)]
+    with span("prices"):
+        market_prices = price_service.get_prices(sorted(
+            {ticker for account_positions in positions.values()
+             for ticker in account_positions.loc[account_positions.exposure != 0, "ticker"]}))
+    summaries = []
+    for account in accounts:
+        print(f"account {account_label(account)}")
+        summaries.append(marked_summary(positions[account], market_prices))
+        report_summary(summaries[-1], file_location, "_" + account_label(account))
+    if consolidated:
+        print(f"all accounts ({', '.join(account_label(account) for account in accounts)})")
+        report_summary(consolidate(summaries) if len(summaries) > 1 else summaries[0], file_location)
+
+def marked_summary(positions, market_prices = None):
+    # pnl_summary of final positions marked at market_prices (ticker -> price or None), fetched here if not given
+    positions = positions.loc[~positions.ticker.isin(EXCLUSION_LIST)]
+    if market_prices is None:
+        # one batched price lookup for every open position instead of one download per ticker
+        with span("prices"):
+            market_prices = price_service.get_prices(positions.loc[positions.exposure != 0, "ticker"].tolist())
+    # looking up one of these tickers afterwards marks it with the same price
+    ticker_drilldown.set_marks(market_prices)
+    ticker_positions = []
+    for position in positions.itertuples(index = False):
+        ticker_position = PositionKeeper.restore(position.ticker, position.contract_size, position.exposure,
+                                                 position.avg_price, position.last_price, position.realised_pnl,
+                                                 position.timestamp)
         # for open positions, mark to market
-        if ticker_position.exposure != 0:
-            ticker_position.mark_to_market()
+        if ticker_position.exposure != 0 and market_prices[position.ticker] is not None:
+            ticker_position.mark_to_market(market_prices[position.ticker])
+        ticker_positions.append(ticker_position)
+    return pnl_summary(ticker_positions)
 
+def pnl_summary(ticker_positions):
+    # per ticker PL table of already marked PositionKeepers, sorted by absolute PL
+    all_tickers, open_pnl, close_pnl, open_quantity, open_price, open_notional, last_price, last_date = [],[],[],[],[],[],[],[]
+    for ticker_position in ticker_positions:
         # retrieve the output of PositionKeeper
         ticker_output = ticker_position.get_position_info()
 
         # aggregate the per ticker output of unrealised and realised PL
-        all_tickers.append(ticker)
+        all_tickers.append(ticker_position.ticker)
         open_pnl.append(ticker_output["unrealised_pnl"])
         close_pnl.append(ticker_output["realised_pnl"])
         open_quantity.append(ticker_output["exposure"])
         open_price.append(ticker_output["avg_price"])
-        open_notional.append(ticker_output["market_value"] * contract_size)
+        open_notional.append(ticker_output["market_value"] * ticker_position.contract_size)
         last_price.append(ticker_output["last_price"])
         last_date.append(ticker_output["timestamp"])
 
@@ -257,11 +327,33 @@ def analyse_trades(all_trades = None):
          'last_trade' : last_date
          })
 
+    return rank_pnl(all_pnl)
+
+def rank_pnl(all_pnl):
     # sort by absolute PL
     all_pnl.insert(1, "all_pnl", all_pnl["open_pnl"] + all_pnl["scalp_pnl"])
     all_pnl["abs_all_pnl"] = abs(all_pnl["all_pnl"])
     all_pnl = all_pnl.sort_values(by = "abs_all_pnl", ignore_index = True, ascending = False)
-    all_pnl.to_csv(file_location + r"\all_summary.csv", index=False)
+    return all_pnl
+
+def consolidate(summaries):
+    # one pnl_summary row per ticker over the summaries of several accounts, the open price is the average weighted
+    # by open quantity and the last price and trade come from the account that traded the ticker last
+    all_pnl = pd.concat(summaries, ignore_index = True).sort_values("last_trade", kind = "stable")
+    all_pnl["open_cost"] = all_pnl["open_quantity"] * all_pnl["open_price"]
+    all_pnl = all_pnl.groupby("ticker", sort = False).agg(
+        open_pnl = ("open_pnl", "sum"), scalp_pnl = ("scalp_pnl", "sum"), open_quantity = ("open_quantity", "sum"),
+        open_cost = ("open_cost", "sum"), open_notional = ("open_notional", "sum"),
+        last_price = ("last_price", "last"), last_trade = ("last_trade", "last")).reset_index()
+    quantity = all_pnl["open_quantity"]
+    all_pnl.insert(5, "open_price", (all_pnl["open_cost"] / quantity.where(quantity != 0)).fillna(0.0))
+    return rank_pnl(all_pnl.drop(columns = ["open_cost"]))
+
+@timed
+def report_summary(all_pnl, file_location, suffix = ""):
+    # save and print the all and open summaries and the exposure breakdown of a pnl_summary table, suffix is added to
+    # the file names, e.g. _U1234567 for one account's summary
+    all_pnl.to_csv(file_location + r"\all_summary" + suffix + ".csv", index=False)
     all_pnl = all_pnl.drop(columns=["abs_all_pnl"])
 
     # split into open
@@ -271,212 +363,303 @@ def analyse_trades(all_trades = None):
     exposure_df = exposure_breakdown(open_df)
 
     # save the csv locally
-    open_df.to_csv(file_location + r"\open_summary.csv", index=False)
+    open_df.to_csv(file_location + r"\open_summary" + suffix + ".csv", index=False)
 
     print(open_df, f"\nTotal Open PL is {round(all_pnl["open_pnl"].sum(), 1)}\n"
                    f"Total Scalp PL is {round(all_pnl["scalp_pnl"].sum(), 1)}")
     print(exposure_df)
     print("-----------------------------------------------------------\n")
-    return
+    return open_df, exposure_df
+
+
+@timed
+def daily_pnl(store = None, file_location = export_folder, days = 10):
+    # daily realised, unrealised and total PL and gross and net exposure of the whole portfolio through yesterday,
+    # only the days since the last run are replayed and marked, see equity_curve.py
+    curve = update_curve(store, file_location, price_service.close_history, EXCLUSION_LIST)
+    if days:
+        print(curve.tail(days).to_string(index = False))
+    return curve
 
 
-def manual_trades(file_location):
-    # check for manual trade file, inserting trades into the all_trades csv of trade_type = manual
-    if os.path.isfile(file_location + r"\manual_trades.csv") & os.path.isfile(file_location + r"\all_trades.csv"):
+@timed
+def manual_trades(store, file_location, confirm = None):
+    # check for manual trade file, inserting trades into the trade store of trade_type = manual
+    # confirm = None asks on the terminal, True or False answers for non interactive runs. Returns True if inserted
+    if os.path.isfile(file_location + r"\manual_trades.csv"):
         manual_df = pd.read_csv(file_location + r"\manual_trades.csv")
-        trade_df = pd.read_csv(file_location + r"\all_trades.csv")
         if len(manual_df) == 0:
-            return
+            return False
         print(f"found manual_trades.csv with {len(manual_df)} trades")
-        manual_df["date_short"] = [datetime.strptime(date, "%d/%m/%Y") for date in manual_df["date_short"]]
-        trade_df["date_short"] = [datetime.strptime(date, "%Y/%m/%d") for date in trade_df["date_short"]]
         print(manual_df)
-        if input("manual trades look like this, type y to confirm:\n").lower() == "y":
-            print("inserting into all_trades.csv and removing from manual_trades.csv, rerun program")
-            df = pd.concat([manual_df, trade_df], ignore_index=True).sort_values(by="date_short", ascending=False,                                                              ignore_index=True)
-            df["date_short"] = [x.strftime("%Y/%m/%d") for x in df["date_short"]]
-            df.to_csv(file_location + r"\all_trades.csv", index=False)
-            manual_df.to_csv(file_location + r"\backups\manual_trades" + f"{datetime.now().strftime("%Y_%m_%d")}"+ ".csv", index=False)
-            manual_df = manual_df[0:0]
+        if confirm is None:
+            confirm = input("manual trades look like this, type y to confirm:\n").lower() == "y"
+        if confirm:
+            print("inserting into the trade database and removing from manual_trades.csv")
+            manual_df["timestamp"] = from_date_short(manual_df["date_short"], "%d/%m/%Y")
+            if "trade_type" not in manual_df:
+                manual_df["trade_type"] = "MANUAL"
+            # an optional account column files each trade under its account, the default account otherwise
+            accounts = manual_df["account"].fillna("").astype(str) if "account" in manual_df else ""
+            for account, account_df in manual_df.groupby(pd.Series(accounts, index = manual_df.index)):
+                store.view(account).append(account_df.drop(columns = ["account"], errors = "ignore"))
+                store.view(account).index_orders()
+            save_trades(store, file_location)
+            manual_df.drop(columns = ["timestamp"]).to_csv(
+                file_location + r"\backups\manual_trades" + f"{datetime.now().strftime("%Y_%m_%d")}"+ ".csv", index=False)
+            manual_df = manual_df[0:0].drop(columns = ["timestamp"])
             manual_df.to_csv(file_location + r"\manual_trades.csv", index=False)
-            exit()
+            return True
         else:
             print("nothing done")
-    return
+    return False
 
 
 def exposure_breakdown(df = None):
     # a nice learning point from this line is that direct assignment of dataframes in python does not create a new dataframe,
     # it actually passes the underlying objects of the initial dataframe into the new object
     open_summary = df.copy()
-    exposure_table = {
-        "AMD" : ["US", 1.5],
-        "ARM": ["US", 1.5],
-        "INDA": ["IN", 1],
-        "BABA": ["CH", 1],
-        "SMCI": ["US", 2],
-        "TCEHY": ["CH", 1],
-        "ASPI": ["US", 3],
-        "SOFR3": ["DV01", 1/10000],
-        "GBS" : ["DV01", 1.86/10000],
-        "NVDA" : ["US", 1.5],
-        "SGOV": ["MM fund", 1],
-        "SPY" : ["US", 1],
-        "VOO": ["US", 1],
-        "QQQ": ["US", 1.3],
-        "QQQM": ["US", 1.3],
-        "UC" : ["USDCNH", 1],
-        "ZT": ["DV01", 1.8/10000],
-        "ZF": ["DV01", 3.8/10000],
-        "ZN": ["DV01", 5.8/10000],
-        "TN": ["DV01", 7.7/10000],
-        "ZB": ["DV01", 10.8/10000],
-        "UB": ["DV01", 16.2/10000],
-        "GLD" :["XAU", 1],
-        "CL" : ["CL", 1],
-    }
-    try:
-        open_summary["exposure"] = open_summary.apply(lambda x: exposure_table.get(x.ticker.split()[0])[0], axis=1)
-        open_summary["beta"] = open_summary.apply(lambda x: exposure_table.get(x.ticker.split()[0])[1], axis=1)
-    except TypeError:
-        print("Some ticker not in exposure_table, fix to see exposure breakdown")
+    instruments = instrument_master.lookup(open_summary["ticker"])
+    open_summary["exposure"] = instruments["exposure"].to_numpy()
+    open_summary["beta"] = instruments["beta"].to_numpy()
+    if open_summary["exposure"].isna().any() or open_summary["beta"].isna().any():
+        missing = open_summary.loc[open_summary["exposure"].isna() | open_summary["beta"].isna(), "ticker"]
+        print(f"Some ticker not in instruments.csv ({', '.join(missing.astype(str))}), fix to see exposure breakdown")
         return None
 
-    exposure_list = open_summary.exposure.unique()
-    exposure_notional = []
-    components = []
-    for exposure in exposure_list:
-        temp = open_summary[open_summary["exposure"] == exposure]
-        exposure_notional.append(sum(temp["open_notional"]*temp["beta"]))
-        components.append(temp["ticker"].unique())
-    exposure_df = pd.DataFrame(
-        {
-            "exposure" : exposure_list,
-            "notional" : exposure_notional,
-            "components" : components,
-        }
-    )
+    # buckets in the order they first appear, like the open summary
+    open_summary["beta_notional"] = open_summary["open_notional"] * open_summary["beta"]
+    exposure_df = open_summary.groupby("exposure", sort=False).agg(
+        notional=("beta_notional", "sum"), components=("ticker", "unique")).reset_index()
     return exposure_df
 
+@timed
+def stress_report(open_df = None, grid = None):
+    # PL of the open positions under every scenario of an equity, rates, FX and commodity shock grid (scenarios.py)
+    scenarios, summary = stress_test(open_df, grid)
+    print(f"worst of {len(scenarios)} scenarios (equity, FX, gold, oil in %, rates and twist in bp):")
+    print(scenarios.head(5).round(1).to_string(index = False))
+    print("total PL percentiles: " + ", ".join(
+        f"p{percentile} {round(value, 1)}"
+        for percentile, value in zip(PERCENTILES, np.percentile(scenarios["total_pnl"], PERCENTILES))))
+    print(summary.round(1).to_string(index = False))
+    return scenarios, summary
+
 def get_last_price(ticker = None):
-    # return the most recent closing price of us stock or future
-    ib_yf_mapping = {
-        # "ticker" : ["yfinance=F", carry rate, expiry date]
-        "UC Sep'25": ["USDCNH=X" , -0.028, "2025/9/16"],
-        "ZT": ["ZT=F"],
-        "ZF": ["ZF=F"],
-        "ZN": ["ZN=F"],
-        "TN": ["TN=F"],
-        "ZB": ["ZB=F"],
-        "UB": ["UB=F"],
-        "CL": ["CL=F"],
-    }
-    # default compound factor is 1 because no need to account for interest
-    compound_factor = 1
-    if " " in ticker:
-        ticker_key =  ticker.split()[0] + " " + ticker.split()[1]
-        # if it's a cme future, no need to specify the expiration month due to no efp.
-        if ticker.split()[0] in ib_yf_mapping.keys():
-            ticker = ib_yf_mapping[ticker.split()[0]][0]
-        # if it's a future where interest needs to be accounted for
-        elif ticker_key in ib_yf_mapping.keys():
-            ticker = ib_yf_mapping[ticker_key][0]
-            if len(ib_yf_mapping[ticker_key]) == 3:
-                days_to_expiry = (datetime.strptime(ib_yf_mapping[ticker_key][2], "%Y/%m/%d") - datetime.now()).days
-                compound_factor = (1+ib_yf_mapping[ticker_key][1]/365)**days_to_expiry
-        # no future able to be resolved
-        else:
-            print(f"Future not resolved for {ticker}, not marking to market")
+    # return the most recent closing price of us stock or future, see price_service for the symbol mapping and cache
+    return price_service.get_price(ticker)
+
+class TickerDrilldown:
+    # Session state behind get_ticker_trades: the rows of every ticker in all_trades, found in one sort instead of a
+    # boolean mask over the whole frame per lookup, and the position path of each ticker looked at so far. A path is
+    # kept with the count and trade ids it was replayed from and only replayed again once those change, and so is the
+    # printed lookup, which also changes with the mark.
+    # Marks are the market prices analyse_trades or an earlier lookup used, reused for PRICE_TTL seconds.
+    def __init__(self, ttl = PRICE_TTL):
+        self.ttl = ttl
+        self.trades = None
+        self.rows = {} # ticker -> positions in self.trades, oldest trade first
+        self.paths = {} # ticker -> (signature, path, position info frame)
+        self.rendered = {} # ticker -> ((signature, mark), printed lookup)
+        self.marks = {} # ticker -> (price or None, time it was fetched)
+
+    def index(self, all_trades):
+        # group the rows of all_trades by ticker, once per frame
+        if all_trades is self.trades:
+            return
+        codes, uniques = pd.factorize(all_trades["ticker"])
+        # all_trades is newest first, sorting the reversed codes keeps each ticker oldest first
+        order = np.argsort(codes[::-1], kind = "stable")
+        bounds = np.searchsorted(codes[::-1][order], np.arange(len(uniques) + 1))
+        rows = len(codes) - 1 - order
+        self.rows = {ticker: rows[bounds[code]:bounds[code + 1]] for code, ticker in enumerate(uniques)}
+        self.trades = all_trades
+
+    def signature(self, ticker):
+        rows = self.rows[ticker]
+        if "trade_id" not in self.trades:
             return None
-    stock_data = yf.download(ticker, period="3d", auto_adjust=True)
-    try:
-        return stock_data.tail(1)["Close"].values[0][0]*compound_factor
-    except:
-        print(f"Something went wrong with finding last price for {ticker}, defaulting to open_price")
-        print(stock_data)
-        return None
-
+        trade_ids = self.trades["trade_id"].to_numpy()[rows]
+        return len(rows), int(trade_ids.sum()), int(trade_ids.max())
+
+    @timed
+    def path(self, ticker):
+        # running position after every trade of ticker and its position_info_frame
+        signature = self.signature(ticker)
+        cached = self.paths.get(ticker)
+        if signature is not None and cached is not None and cached[0] == signature:
+            count("ticker_path_hits")
+            return cached[1], cached[2]
+        path = replay_trades(self.trades.iloc[self.rows[ticker][::-1]])
+        info = position_info_frame(path)
+        self.paths[ticker] = (signature, path, info)
+        return path, info
+
+    def clear(self):
+        # forget the memoized paths and printed lookups, e.g. to time a cold lookup
+        self.paths.clear()
+        self.rendered.clear()
+
+    def set_marks(self, market_prices):
+        now = datetime.now().timestamp()
+        self.marks.update({ticker: (price, now) for ticker, price in market_prices.items()})
+
+    @timed
+    def mark(self, ticker):
+        # market price of ticker, fetched only if no recent mark is known
+        price_time = self.marks.get(ticker)
+        if price_time is not None and datetime.now().timestamp() - price_time[1] < self.ttl:
+            count("ticker_mark_hits")
+            return price_time[0]
+        price = get_last_price(ticker)
+        self.set_marks({ticker: price})
+        return price
+
+    def render(self, ticker, market_price, build):
+        # printed lookup of ticker, build() is only called again once its trades or market_price change
+        key = (self.signature(ticker), market_price)
+        cached = self.rendered.get(ticker)
+        if key[0] is not None and cached is not None and cached[0] == key:
+            count("ticker_render_hits")
+            return cached[1]
+        text = build()
+        self.rendered[ticker] = (key, text)
+        return text
+
+ticker_drilldown = TickerDrilldown()
+
+def ticker_lookup_text(ticker, path, ticker_output_df, market_price):
+    # the position path of a ticker with a row marked at market_price for an open position, and its PL totals
+    last = path.iloc[-1]
+    if last.exposure != 0:
+        ticker_position = PositionKeeper.restore(ticker, last.contract_size, last.exposure, last.avg_price,
+                                                 last.last_price, last.realised_pnl, last.timestamp)
+        if market_price is not None:
+            ticker_position.mark_to_market(market_price)
+        # the memoized frame stays as replayed, the marked row goes on a copy
+        ticker_output_df = ticker_output_df.copy()
+        ticker_output_df.loc[len(ticker_output_df)] = ticker_position.get_position_info()
+    return (f"{ticker_output_df}\n"
+            f"\nTotal Open PL is {ticker_output_df["unrealised_pnl"].iloc[-1]}"
+            f"\nTotal Scalp PL is {ticker_output_df["realised_pnl"].iloc[-1]}"
+            f"\nTotal PL is {ticker_output_df["total_pnl"].iloc[-1]}\n")
+
+@timed
 def get_ticker_trades(all_trades = None, ticker = None):
-    unique_tickers = all_trades["ticker"].unique()
+    ticker_drilldown.index(all_trades)
     # first try to resolve the ticker
     if " " not in ticker:
         # ticker is a stock so make it all upper case
         ticker = ticker.upper()
 
-    if ticker in unique_tickers:
-        ticker_trades = all_trades.loc[all_trades.ticker == ticker].iloc[::-1].reset_index(drop=True)
-        contract_size = ticker_trades.loc[0, "contract_size"]
-        # initiate PositionKeeper
-        ticker_position = PositionKeeper(ticker, contract_size)
-        # feed in trades
-        ticker_output = []
-        for index, row in ticker_trades.iterrows():
-            ticker_position.add_trade(row.date_short, row.price, row.quantity)
-            ticker_position.update_stats()
-            ticker_output.append(ticker_position.get_position_info())
+    if ticker in ticker_drilldown.rows:
+        # running position after every trade of the ticker
+        path, ticker_output_df = ticker_drilldown.path(ticker)
         # mark to market for open positions
-        if ticker_position.exposure != 0:
+        market_price = None
+        if path.iloc[-1].exposure != 0:
             print("marking to market for open position")
-            ticker_position.mark_to_market()
-            ticker_output.append(ticker_position.get_position_info())
-        ticker_output_df = pd.DataFrame(ticker_output)
-        print(ticker_output_df)
-        print(f"\nTotal Open PL is {ticker_output_df["unrealised_pnl"].iloc[-1]}"
-              f"\nTotal Scalp PL is {ticker_output_df["realised_pnl"].iloc[-1]}"
-              f"\nTotal PL is {ticker_output_df["total_pnl"].iloc[-1]}\n")
+            market_price = ticker_drilldown.mark(ticker)
+        print(ticker_drilldown.render(ticker, market_price,
+                                      lambda: ticker_lookup_text(ticker, path, ticker_output_df, market_price)))
     else:
         print("Ticker not in unique tickers")
     return
 
-def ticker_history(all_trades = None):
+@timed
+def ticker_history(store = None):
+    # ticker roots traded per month, most recently traded first, from the daily cube instead of the raw trades. Pass
+    # store.portfolio() to cover every account
     print("testing counting trades")
-    df = all_trades.copy()
+    df = store.load_cube(period = "month")
     df = df[~df["ticker"].isin(EXCLUSION_LIST)]
-    df["ticker"] = df.apply(lambda x: x.ticker.split()[0], axis = 1)
-    df["date_long"] = df.apply(lambda x: datetime.strptime(x.date_short, "%Y/%m/%d"), axis =1)
-    df.set_index("date_long", inplace = True, drop = True)
+    df["ticker"] = instrument_master.lookup(df["ticker"])["root"].to_numpy()
+    df = df.sort_values("last_timestamp", ascending = False, kind = "stable")
+    df.set_index(df["date"].rename("date_long"), inplace = True)
     print(df.groupby([df.index.year, df.index.month])["ticker"].unique())
 
+ROLLUP_PERIODS = {"day": "D", "month": "M", "year": "Y"} # cube period -> pandas period
+ROLLUP_FIELDS = ["fills", "volume", "turnover", "realised_pnl"]
+
+@timed
+def trade_rollup(store = None, period = "month", by = ("root", "exposure"), start_date = None, end_date = None):
+    # fills, volume, turnover and realised PL per period and any of ticker, root or exposure bucket, summed from the
+    # daily cube so the cost depends on days traded rather than on trades
+    if period not in ROLLUP_PERIODS:
+        raise ValueError(f"can't roll up by {period}, use one of {list(ROLLUP_PERIODS)}")
+    # replays the trades since the last snapshots of each account, which brings the realised PL in the cube up to date
+    for view in store.account_views():
+        checkpointed_positions(view)
+    cube = store.load_cube(start_date, end_date, period)
+    info = instrument_master.lookup(cube["ticker"])
+    cube["root"] = info["root"].to_numpy()
+    cube["exposure"] = info["exposure"].to_numpy()
+    cube["period"] = cube["date"].dt.to_period(ROLLUP_PERIODS[period])
+    return cube.groupby(["period", *by], dropna = False, observed = True)[ROLLUP_FIELDS].sum().reset_index()
+
+
+def wipe_last_day(store, file_location):
+    # delete most recent day of recorded trades to repull correct trades on next script launch, the journal keeps
+    # the store before the wipe restorable. On store.portfolio() the day goes in every account
+    store.delete_day(store.last_trade_date())
+    backup_store(store, file_location)
+    # the UID watermark is past the wiped day, fall back to a date based resume on the next launch
+    store.set_meta("sync_state", None)
+    all_trades = store.load()
+    print("new trade database looks like this")
+    print(all_trades.head(10))
+    if EXPORT_CSV:
+        store.export_csv(file_location + r"\all_trades.csv")
+    return all_trades
 
-def other_functions(all_trades = None, file_location = None):
-    # at the end of the routine ask the user for other things that they may want to do
+@timed
+def other_functions(all_trades = None, file_location = None, store = None):
+    # at the end of the routine ask the user for other things that they may want to do, store is the portfolio view
+    # (see TradeStore.portfolio) so every account is counted, rolled up and wiped
     unique_tickers = all_trades["ticker"].unique()
     unique_tickers = [x for x in unique_tickers if x not in EXCLUSION_LIST]
     print(unique_tickers)
 
     function_loop = True
     while function_loop:
-        ticker_input = input(
-            "Type ticker to see trades. e.g NVDA\n"
-            "Other functions:\n"
-            "\t1 to count trades in the current month\n"
-            "\t2 to see trade summary per ticker\n"
-            "\t3 to see history of tickers traded\n"
-            "\t4 to wipe the most recent day of recorded trades\n"
-        )
+        with span("waiting_for_input"):
+            ticker_input = input(
+                "Type ticker to see trades. e.g NVDA\n"
+                "Other functions:\n"
+                "\t1 to count trades in the current month\n"
+                "\t2 to see trade summary per ticker\n"
+                "\t3 to see history of tickers traded\n"
+                "\t4 to wipe the most recent day of recorded trades\n"
+                "\t5 to see turnover, fills and scalp PL per month, root and exposure\n"
+                "\t6 to see the daily PL and exposure of the last 30 days\n"
+                "\t7 to stress test the open positions\n"
+            )
         # no command was given so exit
         if ticker_input == "":
             function_loop = False
         # count trades
         elif ticker_input == "1":
-            count_trades()
+            count_trades(store)
         # show scalp summary
         elif ticker_input == "2":
             all_pnl = pd.read_csv(file_location+r"\all_summary.csv")
             print(all_pnl, f"\nTotal Scalp PL is {round(all_pnl["scalp_pnl"].sum(), 1)}")
         # show ticker history
         elif ticker_input == "3":
-            ticker_history(all_trades)
+            ticker_history(store)
         # delete most recent day of recorded trades to repull correct trades on next script launch
         elif ticker_input == "4":
-            last_trade_date = all_trades.date_short.iloc[0]
-            all_trades = all_trades[all_trades["date_short"] != last_trade_date].reset_index(drop = True)
-            print("new trade database looks like this")
-            print(all_trades.head(10))
-            all_trades.to_csv(file_location + r"\all_trades.csv", index=False)
-            all_trades.to_csv(
-                file_location + r"\backups\all_trades" + f"{datetime.now().strftime("%Y_%m_%d")}" + ".csv", index=False)
+            wipe_last_day(store, file_location)
             function_loop = False
+        # monthly rollup from the daily cube
+        elif ticker_input == "5":
+            print(trade_rollup(store))
+        # equity curve
+        elif ticker_input == "6":
+            daily_pnl(store, file_location, 30)
+        # scenario grid over the open summary
+        elif ticker_input == "7":
+            stress_report(pd.read_csv(file_location + r"\open_summary.csv"))
         # show trades associated with the inputed ticker
         else:
             get_ticker_trades(all_trades, ticker_input)
@@ -486,12 +669,26 @@ def other_functions(all_trades = None, file_location = None):
 
 if __name__ in "__main__":
     file_location = export_folder
+    display_options()
+    instrumentation.start(PROFILE)
+    store = open_store(file_location)
 
-    # perform all the analytics
-    all_trades = find_trades(file_location)
-    manual_trades(file_location)
-    analyse_trades(all_trades)
-    other_functions(all_trades, file_location)
+    # perform all the analytics, the run report is written even when manual_trades exits early
+    try:
+        all_trades = find_trades(store, file_location)
+        if manual_trades(store, file_location):
+            print("rerun program")
+            exit()
+        # trades tagged with an account are analysed per account and consolidated, see ingest.py
+        if any(store.accounts()):
+            analyse_accounts(store, file_location)
+        else:
+            analyse_trades(all_trades, store, file_location)
+        if EQUITY_CURVE:
+            daily_pnl(store.portfolio(), file_location)
+        other_functions(all_trades, file_location, store.portfolio())
+    finally:
+        instrumentation.finish(file_location + r"\run_report.json")
 
 
 
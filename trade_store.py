@@ -0,0 +1,716 @@
+import os
+import json
+import sqlite3
+from datetime import datetime, timedelta
+from itertools import repeat
+import pytz
+
+# Trade database storage. Trades are appended instead of rewriting the whole history and reads can be filtered by
+# ticker or date range. The in memory layout returned by load() keeps the all_trades.csv columns (newest first) plus
+# the int64 timestamp so the rest of trade_review works unchanged.
+# pandas and numpy are imported where frames are built so the light cli commands can open a store without them.
+
+TIMEZONE = pytz.timezone("Asia/Hong_Kong")
+# Hong Kong has no daylight saving, so a trade day is a fixed 86400 second bucket of epoch seconds + UTC_OFFSET
+UTC_OFFSET = int(TIMEZONE.utcoffset(datetime(2020, 1, 1)).total_seconds())
+STORE_BACKEND = "sqlite"
+JOURNAL = True # log every change to backups\ before applying it, see store_journal.py
+CSV_COLUMNS = ["date_short", "ticker", "quantity", "price", "contract_size", "trade_type", "message_id"]
+ALL_ACCOUNTS = None # view(ALL_ACCOUNTS) reads the trades of every account as one portfolio
+
+
+def day_start(date):
+    # epoch seconds of Hong Kong midnight for a date or naive datetime, trade days are Hong Kong days
+    return int(TIMEZONE.localize(datetime(date.year, date.month, date.day)).timestamp())
+
+def to_date_short(timestamps):
+    # int64 epoch seconds -> "%Y/%m/%d" strings in Hong Kong time, each distinct day is formatted once and the rows
+    # share its string
+    import numpy as np
+    import pandas as pd
+    days = (np.asarray(timestamps, dtype="int64") + UTC_OFFSET) // 86400
+    unique_days, inverse = np.unique(days, return_inverse=True)
+    labels = pd.to_datetime(unique_days, unit="D").strftime("%Y/%m/%d").to_numpy(dtype=object)
+    return labels[inverse.reshape(-1)]
+
+def from_date_short(dates, date_format = "%Y/%m/%d"):
+    # date strings -> int64 epoch seconds of Hong Kong midnight, used for csv and manual trades which have no time
+    import pandas as pd
+    local = pd.to_datetime(pd.Series(dates), format=date_format).dt.tz_localize(TIMEZONE)
+    return (local - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(seconds=1)
+
+
+class TradeStore:
+    # interface every storage backend implements, trades go in and come out as DataFrames
+    journal = None # store_journal.Journal every change is logged to before it is applied, attached by open_store
+    account = "" # the account whose trades the store reads and writes, see view
+
+    def append(self, trades):
+        # insert trades (timestamp, ticker, quantity, price, contract_size, trade_type, message_id columns)
+        # trades whose message_id is already stored for the account are skipped, returns the number of inserted trades
+        if len(trades) == 0:
+            return 0
+        return self.write({"op": "append", "account": self.account, "trades": trades})
+
+    def replace_trades(self, message_ids, trades):
+        # in one transaction, remove the trades whose message_id is in message_ids and append trades instead,
+        # snapshots and the order index are dropped to be rebuilt. Returns the number of inserted trades
+        return self.write({"op": "replace", "account": self.account, "message_ids": list(message_ids),
+                           "trades": trades})
+
+    def delete_day(self, date):
+        # remove all trades of a Hong Kong day, returns the number of removed trades
+        if self.account is ALL_ACCOUNTS:
+            return sum(view.delete_day(date) for view in self.account_views())
+        return self.write({"op": "wipe", "account": self.account, "date": date})
+
+    def write(self, record):
+        # every change goes through here: logged to the journal, then committed with the journal position
+        if record.get("account", "") is ALL_ACCOUNTS:
+            raise ValueError("the all accounts view is read only, write through view(account)")
+        if self.journal is None:
+            return self.commit(record, None)
+        position = self.journal.write(record)
+        try:
+            return self.commit(record, position)
+        except Exception:
+            self.journal.discard(position)
+            raise
+
+    def commit(self, record, position):
+        # apply an append, replace or wipe record in one transaction that also saves the journal position (unless
+        # None) as the "journal" meta key, then move journal.position to it. Returns the append, replace or wipe count
+        raise NotImplementedError
+
+    def view(self, account):
+        # the store as seen by one account: reads only return its trades, positions and cube rows and writes are
+        # tagged with it. Views share the database and journal, the default account is "". view(ALL_ACCOUNTS) reads
+        # every account, a ticker traded in several of them is one ticker, and only takes delete_day
+        raise NotImplementedError
+
+    def accounts(self):
+        # accounts with trades or tickers in the store
+        raise NotImplementedError
+
+    def account_views(self):
+        # the one account views this view reads
+        if self.account is ALL_ACCOUNTS:
+            return [self.view(account) for account in self.accounts()]
+        return [self]
+
+    def portfolio(self):
+        # the view the analysis reads: every account once trades are tagged with one, otherwise the store itself
+        return self.view(ALL_ACCOUNTS) if any(self.accounts()) else self
+
+    def load(self, ticker = None, start_date = None, end_date = None):
+        # trades newest first, optionally only one ticker and/or the days start_date to end_date inclusive
+        raise NotImplementedError
+
+    def load_since(self, stamps):
+        # trades newest first that come after (timestamp, trade_id) stamps[ticker], every trade of unstamped tickers
+        raise NotImplementedError
+
+    def load_columns(self, after_id = 0):
+        # the trades with an id above after_id oldest first by (timestamp, id) as numpy columns: timestamp, trade_id,
+        # ticker_id, trade_type (strings), quantity, price and contract_size, plus the ticker_id -> ticker mapping
+        raise NotImplementedError
+
+    def generation(self):
+        # bumped whenever trades are removed, so copies of the trades know they can't just append the new ids
+        raise NotImplementedError
+
+    def load_snapshots(self):
+        # ticker -> {"last_timestamp", "last_trade_id", "state"} of the checkpointed PositionKeeper states, kept per
+        # account so view(ALL_ACCOUNTS) has none and can't save them
+        raise NotImplementedError
+
+    def save_snapshots(self, snapshots, realised = ()):
+        # ticker -> (last_timestamp, last_trade_id, state), the stamp is the last trade absorbed into state.
+        # Backends must drop a snapshot when a trade at or before its stamp is added or removed.
+        # realised is (day, ticker, realised PL) of the trades absorbed since the previous snapshot, added to the daily
+        # cube in the same transaction. A ticker without a previous snapshot was replayed from its first trade and its
+        # realised PL in the cube is replaced rather than added to
+        raise NotImplementedError
+
+    def load_cube(self, start_date = None, end_date = None, period = "day"):
+        # daily cube for the days start_date to end_date inclusive summed per period (day, month or year), one row per
+        # period and ticker traded: date (first day of the period), ticker, fills, volume (sum of abs quantity),
+        # net_quantity, turnover (abs notional incl. contract size), realised_pnl and last_timestamp.
+        # Fills, volume and turnover are kept up to date by every insert and removal, realised_pnl covers the trades
+        # absorbed into the position snapshots
+        raise NotImplementedError
+
+    def count(self):
+        raise NotImplementedError
+
+    def index_orders(self):
+        # group fills into orders for every trade added since the last call, consecutive fills (by time) at the same
+        # price, ticker root and day are one order, the grouping count_trades used to do while scanning the mailbox
+        raise NotImplementedError
+
+    def count_orders(self, start_date = None, end_date = None, by = None):
+        # [(key, orders, fills)] for the days start_date to end_date inclusive, key is None, the ticker for
+        # by = "ticker" or the "%Y/%m/%d" day for by = "day"
+        raise NotImplementedError
+
+    def last_trade_date(self):
+        # naive datetime of the most recent trade day, None for an empty store
+        raise NotImplementedError
+
+    def get_meta(self, key, default = None):
+        raise NotImplementedError
+
+    def set_meta(self, key, value):
+        # json serializable value, None removes the key. Keys other than GLOBAL_META are kept per account
+        raise NotImplementedError
+
+    def backup(self, path):
+        raise NotImplementedError
+
+    def export_csv(self, path):
+        # written next to path and renamed over it, a crash can't leave a truncated csv
+        trades = self.load()
+        trades[CSV_COLUMNS].to_csv(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+
+    def close(self):
+        pass
+
+
+class SqliteTradeStore(TradeStore):
+    # tickers are dictionary encoded into their own table, timestamps are int64 epoch seconds.
+    # A ticker id stands for a ticker in one account, so snapshots, the daily cube and the order index keyed by ticker
+    # id are per account and a view only has to limit its queries on trades to its account's ticker ids
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tickers (
+            id INTEGER PRIMARY KEY,
+            ticker TEXT NOT NULL,
+            account TEXT NOT NULL DEFAULT '',
+            UNIQUE (account, ticker)
+        );
+        CREATE TABLE IF NOT EXISTS trades (
+            id INTEGER PRIMARY KEY,
+            timestamp INTEGER NOT NULL,
+            ticker_id INTEGER NOT NULL REFERENCES tickers(id),
+            quantity REAL NOT NULL,
+            price REAL NOT NULL,
+            contract_size REAL NOT NULL,
+            trade_type TEXT NOT NULL,
+            message_id TEXT,
+            order_id INTEGER,
+            account TEXT NOT NULL DEFAULT '',
+            UNIQUE (account, message_id)
+        );
+        CREATE INDEX IF NOT EXISTS trades_timestamp ON trades(timestamp);
+        CREATE INDEX IF NOT EXISTS trades_ticker_timestamp ON trades(ticker_id, timestamp);
+        CREATE TABLE IF NOT EXISTS position_snapshots (
+            ticker_id INTEGER PRIMARY KEY REFERENCES tickers(id),
+            last_timestamp INTEGER NOT NULL,
+            last_trade_id INTEGER NOT NULL,
+            state TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS daily_cube (
+            day INTEGER NOT NULL,
+            ticker_id INTEGER NOT NULL REFERENCES tickers(id),
+            fills INTEGER NOT NULL DEFAULT 0,
+            volume REAL NOT NULL DEFAULT 0,
+            net_quantity REAL NOT NULL DEFAULT 0,
+            turnover REAL NOT NULL DEFAULT 0,
+            realised_pnl REAL NOT NULL DEFAULT 0,
+            last_timestamp INTEGER,
+            PRIMARY KEY (day, ticker_id)
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    # created after the order_id column migration, trades that still need index_orders
+    INDEXES = """
+        CREATE INDEX IF NOT EXISTS trades_unordered ON trades(timestamp) WHERE order_id IS NULL;
+    """
+
+    COLUMNS = "timestamp, ticker_id, quantity, price, contract_size, trade_type, message_id, id"
+
+    # day number of the first day of each period a cube row falls in
+    CUBE_PERIODS = {
+        "day": "day",
+        "month": "CAST(strftime('%s', day * 86400, 'unixepoch', 'start of month') AS INTEGER) / 86400",
+        "year": "CAST(strftime('%s', day * 86400, 'unixepoch', 'start of year') AS INTEGER) / 86400",
+    }
+    # adds the trades with an id above ? to daily_cube, day is the Hong Kong day number
+    FILL_CUBE = f"""
+        INSERT INTO daily_cube (day, ticker_id, fills, volume, net_quantity, turnover, last_timestamp)
+        SELECT (timestamp + {UTC_OFFSET}) / 86400 AS day, ticker_id, COUNT(*), SUM(ABS(quantity)), SUM(quantity),
+               SUM(ABS(quantity) * price * contract_size), MAX(timestamp)
+        FROM trades WHERE id > ? AND {{account}} GROUP BY day, ticker_id
+        ON CONFLICT (day, ticker_id) DO UPDATE SET
+            fills = fills + excluded.fills, volume = volume + excluded.volume,
+            net_quantity = net_quantity + excluded.net_quantity, turnover = turnover + excluded.turnover,
+            last_timestamp = MAX(COALESCE(last_timestamp, 0), excluded.last_timestamp)
+    """
+
+    GLOBAL_META = ["generation", "journal"] # meta keys shared by every account
+
+    def __init__(self, path, account = "", shared = None):
+        self.path = path
+        self.account = account
+        # condition every query on trades, daily_cube and position_snapshots of the view carries
+        self.in_account = "1"
+        if account is not ALL_ACCOUNTS:
+            self.in_account = "ticker_id IN (SELECT id FROM tickers WHERE account = '{}')".format(
+                account.replace("'", "''"))
+        self.owner = shared is None
+        if shared is not None:
+            self.conn, self.views, self.journal = shared.conn, shared.views, shared.journal
+        else:
+            self.conn = sqlite3.connect(path)
+            self.views = {}
+            self.migrate()
+        self.views[account] = self
+        self.ticker_ids = dict(self.conn.execute("SELECT ticker, id FROM tickers WHERE account = ?", (account,)))
+
+    def migrate(self):
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        new_cube = self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'daily_cube'").fetchone() is None
+        self.conn.executescript(self.SCHEMA)
+        if "order_id" not in [column[1] for column in self.conn.execute("PRAGMA table_info(trades)")]:
+            # stores from before the order index, every trade gets grouped by the next index_orders
+            with self.conn:
+                self.conn.execute("ALTER TABLE trades ADD COLUMN order_id INTEGER")
+        if "account" not in [column[1] for column in self.conn.execute("PRAGMA table_info(tickers)")]:
+            # stores from before accounts, the tickers keep their ids and belong to the default account
+            with self.conn:
+                self.conn.execute("BEGIN")
+                self.conn.execute("CREATE TABLE tickers_accounts (id INTEGER PRIMARY KEY, ticker TEXT NOT NULL, "
+                                  "account TEXT NOT NULL DEFAULT '', UNIQUE (account, ticker))")
+                self.conn.execute("INSERT INTO tickers_accounts (id, ticker) SELECT id, ticker FROM tickers")
+                self.conn.execute("DROP TABLE tickers")
+                self.conn.execute("ALTER TABLE tickers_accounts RENAME TO tickers")
+        if "account" not in [column[1] for column in self.conn.execute("PRAGMA table_info(trades)")]:
+            # stores with a message_id unique over every account, a confirmation that reaches two accounts is kept in
+            # both. The trades keep their ids and take the account of their ticker
+            with self.conn:
+                self.conn.execute("BEGIN")
+                self.conn.execute(
+                    "CREATE TABLE trades_accounts (id INTEGER PRIMARY KEY, timestamp INTEGER NOT NULL, "
+                    "ticker_id INTEGER NOT NULL REFERENCES tickers(id), quantity REAL NOT NULL, price REAL NOT NULL, "
+                    "contract_size REAL NOT NULL, trade_type TEXT NOT NULL, message_id TEXT, order_id INTEGER, "
+                    "account TEXT NOT NULL DEFAULT '', UNIQUE (account, message_id))")
+                self.conn.execute(
+                    "INSERT INTO trades_accounts SELECT trades.id, timestamp, ticker_id, quantity, price, "
+                    "contract_size, trade_type, message_id, order_id, account "
+                    "FROM trades JOIN tickers ON tickers.id = ticker_id")
+                self.conn.execute("DROP TABLE trades")
+                self.conn.execute("ALTER TABLE trades_accounts RENAME TO trades")
+            # the indexes went with the old table
+            self.conn.executescript(self.SCHEMA)
+        self.conn.executescript(self.INDEXES)
+        if new_cube:
+            # stores from before the daily cube, built from the trades and the snapshots dropped so the next
+            # checkpointed replay fills in the realised PL from the first trade
+            with self.conn:
+                self.rebuild_cube("1")
+
+    def view(self, account):
+        if account not in self.views:
+            SqliteTradeStore(self.path, account, self)
+        return self.views[account]
+
+    def accounts(self):
+        return [account for account, in self.conn.execute("SELECT DISTINCT account FROM tickers ORDER BY account")]
+
+    def names(self):
+        # ticker_id -> ticker of every ticker the view reads, several ids share a ticker in view(ALL_ACCOUNTS)
+        if self.account is ALL_ACCOUNTS:
+            return dict(self.conn.execute("SELECT id, ticker FROM tickers"))
+        return {ticker_id: ticker for ticker, ticker_id in self.ticker_ids.items()}
+
+    def ticker_id(self, ticker):
+        if ticker not in self.ticker_ids:
+            cursor = self.conn.execute("INSERT INTO tickers (ticker, account) VALUES (?, ?)", (ticker, self.account))
+            self.ticker_ids[ticker] = cursor.lastrowid
+        return self.ticker_ids[ticker]
+
+    def commit(self, record, position):
+        if record.get("account", "") != self.account:
+            return self.view(record["account"]).commit(record, position)
+        with self.conn:
+            if record["op"] == "append":
+                result = self.insert(record["trades"])
+            elif record["op"] == "replace":
+                result = self.replace(record["message_ids"], record["trades"])
+            elif record["op"] == "wipe":
+                result = self.wipe(record["date"])
+            else:
+                raise ValueError(f"unknown journal record {record['op']}")
+            if position is not None:
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('journal', ?)",
+                                  (json.dumps(position),))
+        if position is not None:
+            self.journal.position = position
+        return result
+
+    def insert(self, trades):
+        # append without the transaction, shared by append and replace_trades
+        import pandas as pd
+        message_ids = trades["message_id"] if "message_id" in trades else pd.Series(None, index=trades.index)
+        trade_types = trades["trade_type"] if "trade_type" in trades else pd.Series("AUTO", index=trades.index)
+        ticker_ids = [self.ticker_id(ticker) for ticker in trades["ticker"].astype(str)]
+        last_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM trades").fetchone()[0]
+        before = self.conn.total_changes
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO trades (timestamp, ticker_id, quantity, price, contract_size, trade_type, "
+            "message_id, account) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            zip(trades["timestamp"].astype("int64").tolist(), ticker_ids,
+                trades["quantity"].astype(float).tolist(), trades["price"].astype(float).tolist(),
+                trades["contract_size"].astype(float).tolist(), trade_types.astype(str).tolist(),
+                message_ids.astype(object).where(message_ids.notna(), None).tolist(), repeat(self.account)))
+        inserted = self.conn.total_changes - before
+        if inserted:
+            # new rows get ids above the old maximum. A new trade older than a snapshot's last trade would have been
+            # replayed before it, the snapshot is stale. Duplicates INSERT OR IGNORE skipped leave the snapshots alone
+            oldest = self.conn.execute("SELECT ticker_id, MIN(timestamp) FROM trades WHERE id > ? GROUP BY ticker_id",
+                                       (last_id,)).fetchall()
+            self.conn.executemany("DELETE FROM position_snapshots WHERE ticker_id = ? AND last_timestamp > ?", oldest)
+            self.conn.execute(self.FILL_CUBE.format(account = self.in_account), (last_id,))
+        return inserted
+
+    def rebuild_cube(self, scope = None):
+        # daily cube from all trades of the account (scope = "1" for every account), inside the caller's transaction.
+        # Realised PL restarts from the first trade of every ticker, so the snapshots go with it
+        scope = scope or self.in_account
+        self.conn.execute(f"DELETE FROM daily_cube WHERE {scope}")
+        self.conn.execute(f"DELETE FROM position_snapshots WHERE {scope}")
+        self.conn.execute(self.FILL_CUBE.format(account = scope), (0,))
+
+    def replace(self, message_ids, trades):
+        # replace_trades without the transaction
+        self.bump_generation()
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS replaced (message_id TEXT PRIMARY KEY)")
+        self.conn.execute("DELETE FROM replaced")
+        self.conn.executemany("INSERT OR IGNORE INTO replaced VALUES (?)", ((message_id,) for message_id in message_ids))
+        self.conn.execute("DELETE FROM trades WHERE message_id IN (SELECT message_id FROM replaced) AND account = ?",
+                          (self.account,))
+        self.conn.execute("DELETE FROM replaced")
+        self.delete_unkeyed(trades)
+        self.rebuild_cube()
+        self.conn.execute(f"UPDATE trades SET order_id = NULL WHERE {self.in_account}")
+        return self.insert(trades) if len(trades) else 0
+
+    def delete_unkeyed(self, trades):
+        # trades migrated from all_trades.csv have no message_id and only their day, so a reparse of their messages
+        # would add them again. One unkeyed AUTO trade of the same day, ticker, quantity and price is removed for every
+        # trade of trades, inside the caller's transaction. Returns the number removed
+        if not len(trades):
+            return 0
+        timestamps = trades["timestamp"].astype("int64")
+        wanted = {}
+        for key in zip(((timestamps + UTC_OFFSET) // 86400).tolist(), trades["ticker"].astype(str).tolist(),
+                       trades["quantity"].astype(float).tolist(), trades["price"].astype(float).tolist()):
+            wanted[key] = wanted.get(key, 0) + 1
+        rows = self.conn.execute(
+            "SELECT trades.id, timestamp, ticker, quantity, price FROM trades JOIN tickers ON tickers.id = ticker_id "
+            "WHERE message_id IS NULL AND trade_type = 'AUTO' AND timestamp >= ? AND timestamp <= ? "
+            f"AND {self.in_account}",
+            (int(timestamps.min()) - 86400, int(timestamps.max()))).fetchall()
+        removed = []
+        for trade_id, timestamp, ticker, quantity, price in rows:
+            key = ((timestamp + UTC_OFFSET) // 86400, ticker, quantity, price)
+            if wanted.get(key, 0):
+                wanted[key] -= 1
+                removed.append((trade_id,))
+        self.conn.executemany("DELETE FROM trades WHERE id = ?", removed)
+        return len(removed)
+
+    def load(self, ticker = None, start_date = None, end_date = None):
+        conditions, params = [self.in_account], []
+        if ticker is not None:
+            ticker_ids = [ticker_id for ticker_id, name in self.names().items() if name == ticker]
+            if not ticker_ids:
+                return self.frame([])
+            conditions.append(f"ticker_id IN ({', '.join('?' * len(ticker_ids))})")
+            params += ticker_ids
+        if start_date is not None:
+            conditions.append("timestamp >= ?")
+            params.append(day_start(start_date))
+        if end_date is not None:
+            conditions.append("timestamp < ?")
+            params.append(day_start(end_date + timedelta(days=1)))
+        rows = self.conn.execute(f"SELECT {self.COLUMNS} FROM trades WHERE {' AND '.join(conditions)} "
+                                 "ORDER BY timestamp DESC, id DESC", params).fetchall()
+        return self.frame(rows)
+
+    def load_since(self, stamps):
+        rows = []
+        for ticker_id, ticker in self.names().items():
+            if ticker in stamps:
+                # (timestamp, id) after the stamp, the ticker_id/timestamp index limits the scan to the new trades
+                last_timestamp, last_trade_id = stamps[ticker]
+                rows += self.conn.execute(
+                    f"SELECT {self.COLUMNS} FROM trades WHERE ticker_id = ? AND timestamp >= ? "
+                    "AND (timestamp > ? OR id > ?)", (ticker_id, last_timestamp, last_timestamp, last_trade_id)).fetchall()
+            else:
+                rows += self.conn.execute(f"SELECT {self.COLUMNS} FROM trades WHERE ticker_id = ?", (ticker_id,)).fetchall()
+        # newest first like load()
+        rows.sort(key=lambda row: (row[0], row[7]), reverse=True)
+        return self.frame(rows)
+
+    def frame(self, rows):
+        import numpy as np
+        import pandas as pd
+        columns = list(zip(*rows)) if rows else [[]] * 8
+        timestamps = np.array(columns[0], dtype="int64")
+        # ticker ids -> categorical codes without building one python string per row
+        names = self.names()
+        categories = list(dict.fromkeys(names[ticker_id] for ticker_id in sorted(names)))
+        codes = {ticker: code for code, ticker in enumerate(categories)}
+        lookup = np.zeros(max(names, default=0) + 1, dtype="int32")
+        lookup[list(names)] = [codes[ticker] for ticker in names.values()]
+        return pd.DataFrame({
+            "date_short": to_date_short(timestamps),
+            "ticker": pd.Categorical.from_codes(lookup[np.array(columns[1], dtype="int64")], categories=categories),
+            "quantity": np.array(columns[2], dtype="float64"),
+            "price": np.array(columns[3], dtype="float64"),
+            "contract_size": np.array(columns[4], dtype="float64"),
+            "trade_type": pd.Categorical(columns[5]),
+            "message_id": np.array(columns[6], dtype=object),
+            "timestamp": timestamps,
+            "trade_id": np.array(columns[7], dtype="int64"),
+        })
+
+    def wipe(self, date):
+        # delete_day without the transaction
+        start, end = day_start(date), day_start(date + timedelta(days=1))
+        self.bump_generation()
+        # snapshots that absorbed any of the removed trades are stale
+        self.conn.execute("DELETE FROM position_snapshots WHERE last_timestamp >= ? AND ticker_id IN "
+                          "(SELECT ticker_id FROM trades WHERE timestamp >= ? AND timestamp < ? "
+                          f"AND {self.in_account})",
+                          (start, start, end))
+        cursor = self.conn.execute(f"DELETE FROM trades WHERE timestamp >= ? AND timestamp < ? AND {self.in_account}",
+                                   (start, end))
+        # realised PL of the tickers whose snapshot was dropped is replaced on their next replay
+        self.conn.execute(f"DELETE FROM daily_cube WHERE day = ? AND {self.in_account}",
+                          ((start + UTC_OFFSET) // 86400,))
+        return cursor.rowcount
+
+    def load_columns(self, after_id = 0):
+        import numpy as np
+        rows = self.conn.execute("SELECT timestamp, id, ticker_id, trade_type, quantity, price, contract_size FROM trades "
+                                 f"WHERE id > ? AND {self.in_account} ORDER BY timestamp, id", (after_id,)).fetchall()
+        columns = list(zip(*rows)) if rows else [[]] * 7
+        return {
+            "timestamp": np.array(columns[0], dtype="int64"),
+            "trade_id": np.array(columns[1], dtype="int64"),
+            "ticker_id": np.array(columns[2], dtype="int64"),
+            "trade_type": np.array(columns[3], dtype=object),
+            "quantity": np.array(columns[4], dtype="float64"),
+            "price": np.array(columns[5], dtype="float64"),
+            "contract_size": np.array(columns[6], dtype="float64"),
+        }, self.names()
+
+    def generation(self):
+        return self.get_meta("generation", 0)
+
+    def bump_generation(self):
+        # inside the caller's transaction
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('generation', ?)",
+                          (json.dumps(self.generation() + 1),))
+
+    def load_snapshots(self):
+        if self.account is ALL_ACCOUNTS:
+            return {}
+        tickers = self.names()
+        return {tickers[ticker_id]: {"last_timestamp": last_timestamp, "last_trade_id": last_trade_id,
+                                     "state": json.loads(state)}
+                for ticker_id, last_timestamp, last_trade_id, state in
+                self.conn.execute("SELECT ticker_id, last_timestamp, last_trade_id, state FROM position_snapshots "
+                                  f"WHERE {self.in_account}")}
+
+    def save_snapshots(self, snapshots, realised = ()):
+        if self.account is ALL_ACCOUNTS:
+            raise ValueError("position snapshots are kept per account, save them through view(account)")
+        with self.conn:
+            # tickers replayed from their first trade
+            self.conn.executemany("UPDATE daily_cube SET realised_pnl = 0 WHERE ticker_id = ? AND NOT EXISTS "
+                                  "(SELECT 1 FROM position_snapshots WHERE ticker_id = ?)",
+                                  [(self.ticker_ids[ticker],) * 2 for ticker in snapshots])
+            self.conn.executemany(
+                "INSERT INTO daily_cube (day, ticker_id, realised_pnl) VALUES (?, ?, ?) "
+                "ON CONFLICT (day, ticker_id) DO UPDATE SET realised_pnl = realised_pnl + excluded.realised_pnl",
+                [(int(day), self.ticker_ids[ticker], float(realised_pnl)) for day, ticker, realised_pnl in realised])
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO position_snapshots (ticker_id, last_timestamp, last_trade_id, state) VALUES (?, ?, ?, ?)",
+                [(self.ticker_ids[ticker], last_timestamp, last_trade_id, json.dumps(state))
+                 for ticker, (last_timestamp, last_trade_id, state) in snapshots.items()])
+
+    def load_cube(self, start_date = None, end_date = None, period = "day"):
+        import numpy as np
+        import pandas as pd
+        conditions, params = [self.in_account], []
+        if start_date is not None:
+            conditions.append("day >= ?")
+            params.append((day_start(start_date) + UTC_OFFSET) // 86400)
+        if end_date is not None:
+            conditions.append("day <= ?")
+            params.append((day_start(end_date) + UTC_OFFSET) // 86400)
+        where = "WHERE " + " AND ".join(conditions)
+        if period not in self.CUBE_PERIODS:
+            raise ValueError(f"can't load the cube by {period}, use one of {list(self.CUBE_PERIODS)}")
+        rows = self.conn.execute(
+            f"SELECT {self.CUBE_PERIODS[period]} AS period, ticker_id, SUM(fills), SUM(volume), SUM(net_quantity), "
+            f"SUM(turnover), SUM(realised_pnl), MAX(last_timestamp) FROM daily_cube {where} "
+            "GROUP BY period, ticker_id ORDER BY period, ticker_id", params).fetchall()
+        columns = list(zip(*rows)) if rows else [[]] * 8
+        tickers = self.names()
+        cube = pd.DataFrame({
+            "date": pd.to_datetime(np.array(columns[0], dtype="int64"), unit="D"),
+            "ticker": pd.Categorical([tickers[ticker_id] for ticker_id in columns[1]]),
+            "fills": np.array(columns[2], dtype="int64"),
+            "volume": np.array(columns[3], dtype="float64"),
+            "net_quantity": np.array(columns[4], dtype="float64"),
+            "turnover": np.array(columns[5], dtype="float64"),
+            "realised_pnl": np.array(columns[6], dtype="float64"),
+            "last_timestamp": np.array([0 if value is None else value for value in columns[7]], dtype="int64"),
+        })
+        if self.account is ALL_ACCOUNTS:
+            # a ticker traded in several accounts is one row per period
+            cube = cube.groupby(["date", "ticker"], sort = True, observed = True).agg(
+                fills = ("fills", "sum"), volume = ("volume", "sum"), net_quantity = ("net_quantity", "sum"),
+                turnover = ("turnover", "sum"), realised_pnl = ("realised_pnl", "sum"),
+                last_timestamp = ("last_timestamp", "max")).reset_index()
+        return cube
+
+    def count(self):
+        return self.conn.execute(f"SELECT COUNT(*) FROM trades WHERE {self.in_account}").fetchone()[0]
+
+    def index_orders(self):
+        if self.account is ALL_ACCOUNTS:
+            # orders never span accounts
+            return sum(view.index_orders() for view in self.account_views())
+        since = self.conn.execute(f"SELECT MIN(timestamp) FROM trades WHERE order_id IS NULL AND {self.in_account}"
+                                  ).fetchone()[0]
+        if since is None:
+            return 0
+        roots = {ticker_id: ticker.split()[0] for ticker_id, ticker in self.names().items()}
+        # the trade just before the new ones, its order can continue into them
+        previous = self.conn.execute("SELECT timestamp, ticker_id, price, order_id FROM trades WHERE timestamp < ? "
+                                     f"AND {self.in_account} ORDER BY timestamp DESC, id DESC LIMIT 1",
+                                     (since,)).fetchone()
+        last = None
+        if previous is not None:
+            last = ((previous[0] + UTC_OFFSET) // 86400, roots[previous[1]], previous[2], previous[3])
+        updates = []
+        # an insert can split or join the orders after it, so everything from the first new trade on is regrouped
+        for trade_id, timestamp, ticker_id, price, order_id in self.conn.execute(
+                "SELECT id, timestamp, ticker_id, price, order_id FROM trades WHERE timestamp >= ? "
+                f"AND {self.in_account} ORDER BY timestamp, id", (since,)):
+            key = ((timestamp + UTC_OFFSET) // 86400, roots[ticker_id], price)
+            new_order_id = last[3] if last is not None and last[:3] == key else trade_id
+            if new_order_id != order_id:
+                updates.append((new_order_id, trade_id))
+            last = (*key, new_order_id)
+        with self.conn:
+            self.conn.executemany("UPDATE trades SET order_id = ? WHERE id = ?", updates)
+        return len(updates)
+
+    def count_orders(self, start_date = None, end_date = None, by = None):
+        self.index_orders()
+        conditions, params = [self.in_account], []
+        if start_date is not None:
+            conditions.append("timestamp >= ?")
+            params.append(day_start(start_date))
+        if end_date is not None:
+            conditions.append("timestamp < ?")
+            params.append(day_start(end_date + timedelta(days=1)))
+        where = "WHERE " + " AND ".join(conditions)
+        if by is None:
+            orders, fills = self.conn.execute(f"SELECT COUNT(DISTINCT order_id), COUNT(*) FROM trades {where}",
+                                              params).fetchone()
+            return [(None, orders, fills)]
+        if by == "ticker":
+            tickers = self.names()
+            totals = {}
+            # the order ids of different accounts never match, so the counts of a ticker's ids add up
+            for ticker_id, orders, fills in self.conn.execute(
+                    f"SELECT ticker_id, COUNT(DISTINCT order_id), COUNT(*) FROM trades {where} GROUP BY ticker_id",
+                    params):
+                total = totals.get(tickers[ticker_id], (0, 0))
+                totals[tickers[ticker_id]] = (total[0] + orders, total[1] + fills)
+            return sorted((ticker, orders, fills) for ticker, (orders, fills) in totals.items())
+        if by == "day":
+            rows = self.conn.execute(f"SELECT (timestamp + {UTC_OFFSET}) / 86400 AS day, COUNT(DISTINCT order_id), "
+                                     f"COUNT(*) FROM trades {where} GROUP BY day ORDER BY day", params).fetchall()
+            return [((datetime(1970, 1, 1) + timedelta(days=day)).strftime("%Y/%m/%d"), orders, fills)
+                    for day, orders, fills in rows]
+        raise ValueError(f"can't count orders by {by}, use None, ticker or day")
+
+    def last_trade_date(self):
+        timestamp = self.conn.execute(f"SELECT MAX(timestamp) FROM trades WHERE {self.in_account}").fetchone()[0]
+        if timestamp is None:
+            return None
+        return datetime.fromtimestamp(timestamp, TIMEZONE).replace(hour=0, minute=0, second=0, tzinfo=None)
+
+    def meta_key(self, key):
+        if self.account is ALL_ACCOUNTS and key not in self.GLOBAL_META:
+            raise ValueError(f"{key} is kept per account, read it through view(account)")
+        return key if self.account == "" or key in self.GLOBAL_META else f"{key}:{self.account}"
+
+    def get_meta(self, key, default = None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (self.meta_key(key),)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def set_meta(self, key, value):
+        if self.account is ALL_ACCOUNTS and key not in self.GLOBAL_META:
+            for view in self.account_views():
+                view.set_meta(key, value)
+            return
+        key = self.meta_key(key)
+        with self.conn:
+            if value is None:
+                self.conn.execute("DELETE FROM meta WHERE key = ?", (key,))
+            else:
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def backup(self, path):
+        destination = sqlite3.connect(path)
+        with destination:
+            self.conn.backup(destination)
+        destination.close()
+
+    def close(self):
+        # views share the connection of the store they came from, which closes it
+        if self.owner:
+            self.conn.close()
+
+
+STORE_BACKENDS = {
+    "sqlite": (SqliteTradeStore, r"\trades.db"),
+}
+
+def import_csv(store, path):
+    # load a legacy all_trades.csv (newest first, date only) into a store, oldest trade first so ids stay chronological
+    import pandas as pd
+    trades = pd.read_csv(path).iloc[::-1].reset_index(drop=True)
+    trades["timestamp"] = from_date_short(trades["date_short"])
+    return store.append(trades)
+
+def open_store(file_location, backend = STORE_BACKEND, journal = JOURNAL):
+    store_class, file_name = STORE_BACKENDS[backend]
+    store = store_class(file_location + file_name)
+    # first launch on a csv database, migrate all_trades.csv and the UID watermark into the store
+    if store.count() == 0 and os.path.isfile(file_location + r"\all_trades.csv"):
+        print(f"migrating all_trades.csv into {file_location + file_name}")
+        import_csv(store, file_location + r"\all_trades.csv")
+        if os.path.isfile(file_location + r"\sync_state.json"):
+            with open(file_location + r"\sync_state.json") as f:
+                store.set_meta("sync_state", json.load(f))
+    if journal:
+        # brings the store up to the journal after a crash, or starts the journal with a snapshot of the store
+        from store_journal import Journal
+        store.journal = Journal(file_location + r"\backups")
+        store.journal.attach(store)
+    return store
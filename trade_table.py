@@ -0,0 +1,160 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from trade_store import to_date_short
+
+# Compact copy of the trade store for analysis: one typed array per column, oldest first by (timestamp, trade_id),
+# tickers and trade types dictionary encoded. The columns are kept next to the store as raw binary files and opened with
+# np.memmap, so loading millions of trades maps them instead of reading and converting every row out of sqlite.
+# load_table brings the files up to date first, new trades are appended to them and only a removal (wipe, reparse)
+# or an insert in the middle of the history rewrites them.
+# A trade is 8 + 8 + 4 + 1 + 3 * 8 = 45 bytes here against several hundred in an object column DataFrame.
+
+COLUMNS = {
+    "timestamp": "int64", # epoch seconds
+    "trade_id": "int64", # id in the trade store
+    "ticker": "int32", # index into TradeTable.tickers
+    "trade_type": "int8", # index into TradeTable.trade_types
+    "quantity": "float64",
+    "price": "float64",
+    "contract_size": "float64",
+}
+TRADE_TYPES = ["AUTO", "MANUAL"]
+
+
+class TradeTable:
+    def __init__(self, columns, tickers, trade_types):
+        self.columns = columns # column name -> array of len(self) values
+        self.tickers = tickers
+        self.trade_types = trade_types
+
+    def __len__(self):
+        return len(self.columns["timestamp"])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns.values())
+
+    def frame(self):
+        # newest first DataFrame in the store.load() layout (without message_id), the numeric columns are reversed
+        # views of the arrays rather than copies
+        columns = {name: column[::-1] for name, column in self.columns.items()}
+        return pd.DataFrame({
+            "date_short": to_date_short(columns["timestamp"]),
+            "ticker": pd.Categorical.from_codes(columns["ticker"], categories=self.tickers),
+            "quantity": columns["quantity"],
+            "price": columns["price"],
+            "contract_size": columns["contract_size"],
+            "trade_type": pd.Categorical.from_codes(columns["trade_type"], categories=self.trade_types),
+            "timestamp": columns["timestamp"],
+            "trade_id": columns["trade_id"],
+        }, copy=False)
+
+
+def encode(store_columns, store_tickers, tickers, trade_types):
+    # load_columns output -> table columns, tickers and trade types that are new get the next codes
+    ticker_ids = store_columns["ticker_id"]
+    codes = {ticker: code for code, ticker in enumerate(tickers)}
+    lookup = np.zeros(max(store_tickers, default=0) + 1, dtype="int32")
+    for ticker_id in np.unique(ticker_ids).tolist():
+        ticker = store_tickers[ticker_id]
+        if ticker not in codes:
+            codes[ticker] = len(tickers)
+            tickers.append(ticker)
+        lookup[ticker_id] = codes[ticker]
+    type_names, type_index = np.unique(store_columns["trade_type"].astype(str), return_inverse=True)
+    for name in type_names.tolist():
+        if name not in trade_types:
+            trade_types.append(name)
+    type_codes = np.array([trade_types.index(name) for name in type_names.tolist()], dtype="int8")
+    columns = {name: store_columns[name] for name in ("timestamp", "trade_id", "quantity", "price", "contract_size")}
+    columns["ticker"] = lookup[ticker_ids]
+    columns["trade_type"] = type_codes[type_index.reshape(-1)] if len(type_index) else np.zeros(0, dtype="int8")
+    return {name: columns[name].astype(dtype, copy=False) for name, dtype in COLUMNS.items()}
+
+def column_path(file_location, version, name):
+    return file_location + r"\trade_table_" + f"{version}_{name}.bin"
+
+def read_meta(file_location):
+    path = file_location + r"\trade_table.json"
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def write_meta(file_location, meta):
+    # the meta file is the commit point, columns beyond meta["rows"] are ignored until it is written
+    path = file_location + r"\trade_table.json"
+    with open(path + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(path + ".tmp", path)
+
+def open_table(file_location, meta):
+    columns = {}
+    for name, dtype in COLUMNS.items():
+        if meta["rows"]:
+            columns[name] = np.memmap(column_path(file_location, meta["version"], name), dtype=dtype, mode="r",
+                                      shape=(meta["rows"],))
+        else:
+            columns[name] = np.zeros(0, dtype=dtype)
+    return TradeTable(columns, meta["tickers"], meta["trade_types"])
+
+def write_table(file_location, table, meta, store):
+    # all columns under a new version, then the files of the old one are removed
+    version = meta["version"] + 1 if meta else 1
+    for name in COLUMNS:
+        with open(column_path(file_location, version, name), "wb") as f:
+            f.write(np.ascontiguousarray(table[name]).tobytes())
+    new_meta = {"version": version, "rows": len(table), "generation": store.generation(),
+                "max_id": int(table["trade_id"].max()) if len(table) else 0,
+                "tickers": table.tickers, "trade_types": table.trade_types}
+    write_meta(file_location, new_meta)
+    if meta:
+        for name in COLUMNS:
+            try:
+                os.remove(column_path(file_location, meta["version"], name))
+            except OSError:
+                # still mapped by an open table on windows, it goes with the next rewrite
+                pass
+    return new_meta
+
+def append_table(file_location, columns, meta, tickers, trade_types):
+    for name in COLUMNS:
+        path = column_path(file_location, meta["version"], name)
+        with open(path, "r+b" if os.path.isfile(path) else "wb") as f:
+            # drop anything an interrupted append left past the committed rows
+            f.truncate(meta["rows"] * np.dtype(COLUMNS[name]).itemsize)
+            f.seek(0, os.SEEK_END)
+            f.write(np.ascontiguousarray(columns[name]).tobytes())
+    meta = dict(meta, rows=meta["rows"] + len(columns["timestamp"]), tickers=tickers, trade_types=trade_types,
+                max_id=max(meta["max_id"], int(columns["trade_id"].max())))
+    write_meta(file_location, meta)
+    return meta
+
+def load_table(store, file_location):
+    # TradeTable of every trade in store, memory mapped from the column files after bringing them up to date
+    meta = read_meta(file_location)
+    if meta is not None and meta["generation"] == store.generation():
+        store_columns, store_tickers = store.load_columns(meta["max_id"])
+        tickers, trade_types = list(meta["tickers"]), list(meta["trade_types"])
+        new = encode(store_columns, store_tickers, tickers, trade_types)
+        if meta["rows"] + len(new["timestamp"]) == store.count():
+            if len(new["timestamp"]) == 0:
+                return open_table(file_location, meta)
+            table = open_table(file_location, meta)
+            if len(table) == 0 or (new["timestamp"][0], new["trade_id"][0]) > (table["timestamp"][-1], table["trade_id"][-1]):
+                return open_table(file_location, append_table(file_location, new, meta, tickers, trade_types))
+            # trades from before the end of the history (manual trades, a late confirmation), merged back in order
+            columns = {name: np.concatenate([table[name], new[name]]) for name in COLUMNS}
+            order = np.lexsort((columns["trade_id"], columns["timestamp"]))
+            merged = TradeTable({name: column[order] for name, column in columns.items()}, tickers, trade_types)
+            del table
+            return open_table(file_location, write_table(file_location, merged, meta, store))
+    # first run or trades were removed, rebuilt from the store
+    store_columns, store_tickers = store.load_columns()
+    tickers, trade_types = [], list(TRADE_TYPES)
+    table = TradeTable(encode(store_columns, store_tickers, tickers, trade_types), tickers, trade_types)
+    return open_table(file_location, write_table(file_location, table, meta, store))
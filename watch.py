@@ -0,0 +1,270 @@
+import asyncio
+import re
+import ssl
+import time
+from functools import partial
+import pandas as pd
+from credentials import export_folder, imap_host, imap_user, imap_pass
+from trade_counter import connect_imap, message_set, parse_header, HEADER_FETCH, MESSAGE_FETCH, SENDER
+from trade_store import open_store
+from trade_review import (PositionKeeper, display_options, find_trades, pnl_summary, report_summary, price_service,
+                          EXCLUSION_LIST)
+from ingest import (parse_subjects, normalize_trades, trade_frame, save_trades, load_sources, MAIL_CACHE,
+                    CACHE_FULL_MESSAGES)
+from mail_cache import MailCache, cached_entry
+from pnl_engine import checkpointed_positions, final_positions
+from price_service import PRICE_TTL
+
+# Live watch mode: keeps an IMAP IDLE connection open on the Inbox and, when a new IB Trading Assistant confirmation
+# arrives, appends it to the trade store, applies it to the in memory PositionKeeper of its ticker and reprints the open
+# summary and exposure breakdown. Nothing is replayed, only the new trades are applied.
+# run with: python watch.py (or python watch.py --host 127.0.0.1 --port 1143 --no-ssl against fake_imap.py)
+
+IDLE_RENEW = 25 * 60 # gmail ends an IDLE after 29 minutes, so it is restarted before that
+RECONNECT_DELAY = 5 # seconds to wait before reconnecting after the connection drops
+LITERAL = re.compile(rb"\{(\d+)\}\r\n$")
+
+
+class AsyncImap:
+    # the few IMAP4rev1 commands the watcher needs over asyncio streams, imaplib blocks so it can't wait on IDLE
+    def __init__(self, host = imap_host, port = None, use_ssl = True):
+        self.host = host
+        self.port = port or (993 if use_ssl else 143)
+        self.use_ssl = use_ssl
+        self.tag = 0
+
+    async def connect(self, user = imap_user, password = imap_pass):
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, ssl=ssl.create_default_context() if self.use_ssl else None)
+        await self.read_response() # greeting
+        await self.command(f'LOGIN "{user}" "{password}"')
+
+    async def read_response(self):
+        # one response line with its literals inlined as separate bytes, e.g. (b'* 3 FETCH (UID 7 BODY[...] )', [header])
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("imap connection closed")
+        text, literals = b"", []
+        while (literal := LITERAL.search(line)) is not None:
+            text += line[:literal.start()]
+            literals.append(await self.reader.readexactly(int(literal.group(1))))
+            line = await self.reader.readline()
+        return text + line.rstrip(b"\r\n"), literals
+
+    async def command(self, command):
+        # send a command and collect the untagged responses until its tagged completion
+        self.tag += 1
+        tag = f"W{self.tag}".encode()
+        self.writer.write(tag + b" " + command.encode() + b"\r\n")
+        await self.writer.drain()
+        untagged = []
+        while True:
+            line, literals = await self.read_response()
+            if line.startswith(tag + b" "):
+                if not line.startswith(tag + b" OK"):
+                    raise ConnectionError(f"{command.split()[0]} failed: {line.decode(errors='replace')}")
+                return untagged
+            untagged.append((line, literals))
+
+    async def select(self, mailbox = "Inbox"):
+        # returns the UIDVALIDITY of the mailbox
+        untagged = await self.command(f"SELECT {mailbox}")
+        return int(next(re.search(rb"UIDVALIDITY (\d+)", line).group(1)
+                        for line, literals in untagged if b"UIDVALIDITY" in line))
+
+    async def idle(self, timeout = IDLE_RENEW):
+        # wait until the server reports new mail (True) or timeout passes (False)
+        self.tag += 1
+        tag = f"W{self.tag}".encode()
+        self.writer.write(tag + b" IDLE\r\n")
+        await self.writer.drain()
+        while not (await self.read_response())[0].startswith(b"+"):
+            pass
+        arrived = False
+        deadline = time.monotonic() + timeout
+        try:
+            while not arrived:
+                line, literals = await asyncio.wait_for(self.read_response(), max(deadline - time.monotonic(), 0))
+                arrived = line.endswith(b"EXISTS")
+        except asyncio.TimeoutError:
+            pass
+        self.writer.write(b"DONE\r\n")
+        await self.writer.drain()
+        while not (await self.read_response())[0].startswith(tag + b" "):
+            pass
+        return arrived
+
+    async def new_headers(self, last_uid, items = HEADER_FETCH):
+        # (uid, raw bytes) of the SENDER messages above last_uid in UID order
+        untagged = await self.command(f'UID SEARCH UID {last_uid + 1}:* FROM "{SENDER}"')
+        # n:* always matches the newest message even if its UID is below n
+        uids = sorted(int(uid) for line, literals in untagged if line.startswith(b"* SEARCH")
+                      for uid in line.split()[2:] if int(uid) > last_uid)
+        if not uids:
+            return []
+        untagged = await self.command(f"UID FETCH {message_set(uids)} {items}")
+        headers = {int(re.search(rb"UID (\d+)", line).group(1)): literals[0] for line, literals in untagged if literals}
+        return [(uid, headers[uid]) for uid in uids if uid in headers]
+
+    async def logout(self):
+        try:
+            await asyncio.wait_for(self.command("LOGOUT"), 2)
+        except (ConnectionError, OSError, asyncio.TimeoutError):
+            pass
+        self.writer.close()
+
+
+class LiveBook:
+    # one PositionKeeper per ticker, seeded from the trade store checkpoints and then advanced trade by trade
+    def __init__(self, store, file_location):
+        self.store = store
+        self.file_location = file_location
+        self.reload()
+
+    def reload(self):
+        # brings the snapshots up to date and seeds the book from them
+        checkpointed_positions(self.store)
+        snapshots = self.store.load_snapshots()
+        self.positions = {ticker: PositionKeeper.from_dict(snapshot["state"]) for ticker, snapshot in snapshots.items()}
+        self.last_timestamp = {ticker: snapshot["last_timestamp"] for ticker, snapshot in snapshots.items()}
+        self.market_prices = {}
+        self.set_prices(price_service.get_prices(self.open_tickers()))
+
+    def open_tickers(self):
+        return [ticker for ticker, position in self.positions.items()
+                if position.exposure != 0 and ticker not in EXCLUSION_LIST]
+
+    def set_prices(self, market_prices):
+        # remark the positions with a price_service.get_prices result
+        self.market_prices.update(market_prices)
+        for ticker in market_prices:
+            self.mark(ticker)
+
+    def mark(self, ticker):
+        position = self.positions[ticker]
+        if position.exposure != 0 and self.market_prices.get(ticker) is not None:
+            position.mark_to_market(self.market_prices[ticker])
+
+    def apply(self, trade):
+        # trade is a normalize_trades record that was just added to the store, returns False if it needs a price
+        ticker = trade["ticker"]
+        if trade["timestamp"] < self.last_timestamp.get(ticker, trade["timestamp"]):
+            # arrived out of order, replay the ticker from the store so the book matches a full analyse_trades
+            position = final_positions(self.store.load(ticker = ticker)).iloc[0]
+            self.positions[ticker] = PositionKeeper.restore(ticker, position.contract_size, position.exposure,
+                                                            position.avg_price, position.last_price,
+                                                            position.realised_pnl, position.timestamp)
+        else:
+            if ticker not in self.positions:
+                self.positions[ticker] = PositionKeeper(ticker, trade["contract_size"])
+            self.positions[ticker].add_trade(trade["date_short"], trade["price"], trade["quantity"])
+            self.positions[ticker].update_stats()
+            self.last_timestamp[ticker] = trade["timestamp"]
+        self.mark(ticker)
+        return ticker in self.market_prices or ticker in EXCLUSION_LIST or self.positions[ticker].exposure == 0
+
+    def report(self):
+        return report_summary(pnl_summary([position for ticker, position in self.positions.items()
+                                           if ticker not in EXCLUSION_LIST]), self.file_location)
+
+
+async def ingest(imap, store, book, sync_state, cache = None):
+    # store and apply everything above the UID watermark, returns the new sync_state
+    started = time.perf_counter()
+    fetched = await imap.new_headers(sync_state["last_uid"], MESSAGE_FETCH if CACHE_FULL_MESSAGES else HEADER_FETCH)
+    if not fetched:
+        return sync_state
+    entries = [cached_entry(uid, raw) for uid, raw in fetched]
+    if cache is not None:
+        cache.put_many(sync_state["uidvalidity"], [entry for entry, msg in entries])
+    messages = [(entry[0], msg) for entry, msg in entries]
+    decoded = ((*parse_header(msg), msg["Message-ID"]) for uid, msg in messages)
+    unpriced, new_trades = [], 0
+    for trade in trade_frame(list(normalize_trades(parse_subjects(decoded)))).to_dict("records"):
+        # one row at a time so a message that is already in the store is not applied twice
+        if store.append(pd.DataFrame([trade])):
+            new_trades += 1
+            if not book.apply(trade):
+                unpriced.append(trade["ticker"])
+    store.index_orders()
+    sync_state = {"uidvalidity": sync_state["uidvalidity"], "last_uid": messages[-1][0]}
+    store.set_meta("sync_state", sync_state)
+    if new_trades:
+        book.report()
+        print(f"applied {new_trades} new trades in {time.perf_counter() - started:.2f}s")
+        save_trades(store, book.file_location)
+    if unpriced:
+        # a ticker without a cached price costs a download, done after the summary so it doesn't hold it up
+        book.set_prices(await asyncio.to_thread(price_service.get_prices, sorted(set(unpriced))))
+        book.report()
+    return sync_state
+
+async def refresh_loop(book, interval = PRICE_TTL):
+    while True:
+        await asyncio.sleep(interval)
+        # the download runs in a thread, the positions are only touched from the event loop
+        book.set_prices(await asyncio.to_thread(price_service.get_prices, book.open_tickers()))
+        book.report()
+
+async def watch(store, file_location, host = imap_host, port = None, use_ssl = True, idle_renew = IDLE_RENEW):
+    # the watcher follows the default account's Inbox, its watermark and positions and writes the consolidated
+    # summaries, which would drop the trades of named accounts
+    accounts = sorted(({source["account"] for source in load_sources()} | set(store.accounts())) - {""})
+    if accounts:
+        raise ValueError(f"watch.py only follows the default account and this set up has the accounts "
+                         f"{', '.join(accounts)}, run python cli.py sync on a schedule instead")
+    connect = partial(connect_imap, host, port = port, ssl = use_ssl)
+    # catch up with the one shot path first so the watcher always starts from a UID watermark, this blocks but nothing
+    # else is running yet and the store connection can only be used from this thread
+    find_trades(store, file_location, connect)
+    book = LiveBook(store, file_location)
+    book.report()
+    cache = MailCache(file_location) if MAIL_CACHE else None
+    refresher = asyncio.create_task(refresh_loop(book))
+    try:
+        while True:
+            imap = AsyncImap(host, port, use_ssl)
+            try:
+                await imap.connect()
+                uidvalidity = await imap.select("Inbox")
+                sync_state = store.get_meta("sync_state")
+                if sync_state is None or sync_state["uidvalidity"] != uidvalidity:
+                    print("UIDVALIDITY changed, resyncing the trade store")
+                    find_trades(store, file_location, connect)
+                    book.reload()
+                    sync_state = store.get_meta("sync_state")
+                # anything that arrived while disconnected
+                sync_state = await ingest(imap, store, book, sync_state, cache)
+                print(f"watching Inbox from UID {sync_state['last_uid']}, Ctrl+C to stop")
+                while True:
+                    if await imap.idle(idle_renew):
+                        sync_state = await ingest(imap, store, book, sync_state, cache)
+            except (ConnectionError, OSError, asyncio.IncompleteReadError) as error:
+                print(f"imap connection lost ({error!r}), reconnecting in {RECONNECT_DELAY}s")
+                await asyncio.sleep(RECONNECT_DELAY)
+            finally:
+                if hasattr(imap, "writer"):
+                    await imap.logout()
+    finally:
+        refresher.cancel()
+        if cache is not None:
+            cache.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=imap_host)
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--no-ssl", action="store_true", help="plain IMAP, e.g. for fake_imap.py")
+    args = parser.parse_args()
+    display_options()
+    store = open_store(export_folder)
+    try:
+        asyncio.run(watch(store, export_folder, args.host, args.port, not args.no_ssl))
+    except KeyboardInterrupt:
+        print("watch stopped")
+    except ValueError as error:
+        print(error)
+    finally:
+        store.close()